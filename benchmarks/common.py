@@ -0,0 +1,167 @@
+import contextlib
+import dataclasses
+import pathlib
+import random
+import statistics
+import sys
+import time
+
+SRC_DIR = pathlib.Path(__file__).parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+import sqlalchemy  # noqa: E402
+import sqlalchemy.exc  # noqa: E402
+
+from db import models  # noqa: E402
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 2**20
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+    if len(values) == 1:
+        return {"p50": values[0], "p99": values[0], "max": values[0]}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p99": quantiles[98], "max": max(values)}
+
+
+class SqlCounter:
+    def __init__(self, engine: sqlalchemy.Engine):
+        self.count = 0
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+@dataclasses.dataclass
+class Result:
+    scenario: str
+    params: dict
+    operations: int = 0
+    duration_s: float = 0.0
+    latencies_s: list[float] = dataclasses.field(default_factory=list)
+    sql_statements: int = 0
+    extra: dict = dataclasses.field(default_factory=dict)
+
+    @contextlib.contextmanager
+    def measure(self, sql_counter: SqlCounter):
+        sql_before = sql_counter.count
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.duration_s += time.perf_counter() - start
+            self.sql_statements += sql_counter.count - sql_before
+
+    def to_json(self) -> dict:
+        latency_ms = {k: v * 1000 for k, v in percentiles(self.latencies_s).items()}
+        return {
+            "scenario": self.scenario,
+            "params": self.params,
+            "operations": self.operations,
+            "duration_s": self.duration_s,
+            "throughput_per_s": (
+                self.operations / self.duration_s if self.duration_s else 0.0
+            ),
+            "latency_ms": latency_ms,
+            "sql_statements": self.sql_statements,
+            "peak_rss_mb": peak_rss_mb(),
+            **self.extra,
+        }
+
+
+def table_sizes(engine: sqlalchemy.Engine) -> dict[str, int] | None:
+    """Bytes used by every table and index, None if not supported"""
+    if engine.dialect.name != "sqlite":
+        return None
+    with engine.connect() as connection:
+        try:
+            return dict(
+                connection.execute(
+                    sqlalchemy.text(
+                        "SELECT name, sum(pgsize) FROM dbstat GROUP BY name"
+                    )
+                ).all()
+            )
+        except sqlalchemy.exc.OperationalError:
+            # sqlite built without SQLITE_ENABLE_DBSTAT_VTAB
+            return None
+
+
+# words of generated quotes, frequent words repeat like in real texts
+WORDS = (
+    "the a of and is not to in that who what never always only every man we "
+    "you be have life lives truth time times love work way mind world heart "
+    "day days people nothing everything wise fool happiness fear hope dream "
+    "courage power freedom silence knowledge friend enemy war peace death "
+    "beginning end success failure change future past moment word words"
+).split()
+
+
+def phrase_text(i: int, words: int) -> str:
+    if not words:
+        return f"phrase {i} " + "x" * (i % 200)
+    rng = random.Random(i)
+    return f"{i}. " + " ".join(rng.choice(WORDS) for _ in range(words)) + "."
+
+
+def populate(
+    engine: sqlalchemy.Engine,
+    *,
+    users: int,
+    phrases: int,
+    history: int,
+    phrase_words: int = 0,
+    batch_size: int = 50000,
+):
+    """Adds subscribers, phrases and history of history phrases per user.
+    phrase_words makes phrases quotes of that many random words."""
+    with sqlalchemy.orm.Session(engine) as session:
+        for begin in range(0, users, batch_size):
+            session.execute(
+                sqlalchemy.insert(models.User),
+                [
+                    {"chat_id": chat_id, "_send_phrases": True}
+                    for chat_id in range(begin, min(users, begin + batch_size))
+                ],
+            )
+        session.execute(
+            sqlalchemy.insert(models.Phrase),
+            [{"text": phrase_text(i, phrase_words)} for i in range(phrases)],
+        )
+        session.commit()
+        if not history:
+            models.run_data_migrations(engine)
+            return
+        phrase_ids = session.scalars(sqlalchemy.select(models.Phrase.id)).all()
+        history = min(history, len(phrase_ids))
+        batch = []
+        user_ids = session.scalars(sqlalchemy.select(models.User.id)).all()
+        for n, user_id in enumerate(user_ids):
+            for i in range(history):
+                batch.append(
+                    {
+                        "user_id": user_id,
+                        "phrase_id": phrase_ids[(n + i) % len(phrase_ids)],
+                    }
+                )
+            if len(batch) >= batch_size:
+                session.execute(sqlalchemy.insert(models.UsedPhrases), batch)
+                batch = []
+        if batch:
+            session.execute(sqlalchemy.insert(models.UsedPhrases), batch)
+        session.commit()
+    # phrase ordinals and sent bitmaps
+    models.run_data_migrations(engine)
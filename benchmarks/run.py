@@ -0,0 +1,145 @@
+"""Benchmarks of the bot on top of test.bot.MockTelebot.
+
+Examples:
+    python benchmarks/run.py commands --users 1000 --commands 3
+    python benchmarks/run.py broadcast --users 100000 --phrases 1000 --history 30
+    python benchmarks/run.py upload --phrases 2000 --uploads 5
+    python benchmarks/run.py broadcast_http --users 1000 --latency-ms 50
+    python benchmarks/run.py broadcast_http --users 3000 --rate-limit 200
+    python benchmarks/run.py broadcast --output new.json --baseline old.json
+    python benchmarks/run.py broadcast --selection bitmap
+    python benchmarks/run.py broadcast --phrase-words 60 --compression
+    python benchmarks/run.py search --phrases 1000000 --commands 10
+    python benchmarks/run.py sent_tracking --users 100000 --phrases 2000 --history 1000
+
+Results are printed as JSON. With --baseline the run fails if throughput
+dropped or p99 latency grew by more than --tolerance.
+"""
+
+import argparse
+import json
+import logging
+import pathlib
+import sys
+import tempfile
+
+import common  # noqa: F401, adds src to sys.path
+import scenarios
+
+from db import models
+from main import PHRASE_SELECTIONS
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if result["throughput_per_s"] < baseline["throughput_per_s"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {result['throughput_per_s']:.1f}/s, "
+            f"baseline {baseline['throughput_per_s']:.1f}/s"
+        )
+    p99, baseline_p99 = result["latency_ms"]["p99"], baseline["latency_ms"]["p99"]
+    if p99 > baseline_p99 * (1 + tolerance):
+        regressions.append(f"p99 latency {p99:.2f}ms, baseline {baseline_p99:.2f}ms")
+    if result["sql_statements"] > baseline["sql_statements"] * (1 + tolerance):
+        regressions.append(
+            f"{result['sql_statements']} sql statements, "
+            f"baseline {baseline['sql_statements']}"
+        )
+    return regressions
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as working_dir:
+        working_dir = pathlib.Path(working_dir)
+        if args.in_memory:
+            engine = models.init_db_for_testing()
+        else:
+            engine = models.init_db(f"sqlite:///{working_dir / 'iv.db'}")
+        try:
+            result = scenarios.SCENARIOS[args.scenario](
+                engine,
+                users=args.users,
+                commands=args.commands,
+                phrases=args.phrases,
+                history=args.history,
+                uploads=args.uploads,
+                latency_ms=args.latency_ms,
+                error_rate=args.error_rate,
+                rate_limit=args.rate_limit,
+                selection=args.selection,
+                compression=args.compression,
+                phrase_words=args.phrase_words,
+                max_concurrency=args.max_concurrency,
+                working_dir=working_dir,
+            )
+        finally:
+            engine.dispose()
+    return result.to_json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("scenario", choices=sorted(scenarios.SCENARIOS))
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--commands", type=int, default=3)
+    parser.add_argument("--phrases", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=10)
+    parser.add_argument("--uploads", type=int, default=5)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="fake Bot API latency"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fake Bot API 500 errors share"
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, help="fake Bot API requests per second"
+    )
+    parser.add_argument(
+        "--selection",
+        choices=PHRASE_SELECTIONS,
+        default="queue",
+        help="broadcast.selection of the broadcasts",
+    )
+    parser.add_argument(
+        "--compression",
+        action="store_true",
+        help="phrases.compression, existing phrases are compressed first",
+    )
+    parser.add_argument(
+        "--phrase-words",
+        type=int,
+        default=0,
+        help="phrases are quotes of this many words instead of short strings",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=16,
+        help="broadcast.max_concurrency, upper bound of the adaptive send window",
+    )
+    parser.add_argument(
+        "--in-memory", action="store_true", help="use in-memory sqlite database"
+    )
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--baseline", type=pathlib.Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        args.output.write_text(text)
+    if args.baseline:
+        regressions = compare(
+            result, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
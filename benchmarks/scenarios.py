@@ -0,0 +1,388 @@
+import datetime as dt
+import json
+import pathlib
+import time
+import tracemalloc
+
+import sqlalchemy
+import telebot
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+
+import common
+from common import Result
+from common import SqlCounter
+
+import bot as B
+import main
+import outbox
+import phrases_service as PS
+import test.bot
+from test.fake_telegram import FakeTelegramConfig
+from test.fake_telegram import FakeTelegramServer
+import user_service as US
+from db import models
+
+
+def _create_bot(engine):
+    mock_bot = test.bot.MockTelebot()
+    create_session = scoped_session(sessionmaker(engine))
+    B.Bot(mock_bot, create_session, US.UserService(), PS.PhrasesService())
+    return mock_bot
+
+
+def commands(engine, *, users: int, commands: int, **_) -> Result:
+    """Every user sends commands (/start, /help, /stop in turn)"""
+    mock_bot = _create_bot(engine)
+    sql_counter = SqlCounter(engine)
+    result = Result("commands", {"users": users, "commands": commands})
+    sequence = ["start", "help", "stop"]
+    messages = [
+        (chat_id, sequence[i % len(sequence)])
+        for i in range(commands)
+        for chat_id in range(users)
+    ]
+    with result.measure(sql_counter):
+        for chat_id, command in messages:
+            start = time.perf_counter()
+            mock_bot.user_message(chat_id, command)
+            result.latencies_s.append(time.perf_counter() - start)
+    result.operations = len(messages)
+    return result
+
+
+def upload(engine, *, phrases: int, uploads: int, **_) -> Result:
+    """Admin uploads CSV files, every file shares half of the phrases
+    with the previous one"""
+    admin = 1
+    with sqlalchemy.orm.Session(engine) as session:
+        session.add(models.User(chat_id=admin, _is_admin=True))
+        session.commit()
+    mock_bot = _create_bot(engine)
+    sql_counter = SqlCounter(engine)
+    result = Result("upload", {"phrases": phrases, "uploads": uploads})
+    for i in range(uploads):
+        first = i * phrases // 2
+        # quotes, numbered strings would be near-duplicates of each other
+        rows = [f'"{common.phrase_text(n, 12)}"' for n in range(first, first + phrases)]
+        content = "\n".join(["Цитаты"] + rows).encode("utf-8")
+        mock_bot.add_file(f"phrases{i}.csv", content)
+        mock_bot.user_message(admin, "edit")
+        with result.measure(sql_counter):
+            start = time.perf_counter()
+            mock_bot.user_message(
+                admin,
+                reply_to=mock_bot.full_chats[admin][-1],
+                file=test.bot.File(f"phrases{i}.csv"),
+            )
+            result.latencies_s.append(time.perf_counter() - start)
+    result.operations = uploads
+    with sqlalchemy.orm.Session(engine) as session:
+        result.extra["stored_phrases"] = session.query(models.Phrase).count()
+    return result
+
+
+class _SendTimes(test.bot.MockTelebotObserver):
+    def __init__(self):
+        self.times = []
+
+    def on_message(self, sent_by_bot, message):
+        self.times.append(time.perf_counter())
+
+
+def _create_app(engine, working_dir: pathlib.Path, create_bot, **config):
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: engine
+    factories.create_bot = create_bot
+    config = {
+        "token": "1:benchmark",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "23:59:59",
+        },
+        "working_dir": str(working_dir),
+        **config,
+    }
+    config_path = working_dir / "config.json"
+    config_path.write_text(json.dumps(config))
+    return main.App(factories, config_path)
+
+
+def broadcast(
+    engine,
+    *,
+    users: int,
+    phrases: int,
+    history: int,
+    selection: str,
+    compression: bool,
+    phrase_words: int,
+    working_dir: pathlib.Path,
+    **_,
+) -> Result:
+    """Full broadcast through App._send_phrases to every subscriber"""
+    common.populate(
+        engine,
+        users=users,
+        phrases=phrases,
+        history=history,
+        phrase_words=phrase_words,
+    )
+    mock_bot = test.bot.MockTelebot()
+    send_times = _SendTimes()
+    mock_bot.add_observer(send_times)
+    app = _create_app(
+        engine,
+        working_dir,
+        lambda *args, **kwargs: mock_bot,
+        broadcast={"selection": selection},
+        phrases={"compression": compression},
+    )
+    extra = {}
+    if compression:
+        start = time.perf_counter()
+        with sqlalchemy.orm.Session(engine) as session:
+            app._phrases_service.migrate_storage(session, phrases)
+        extra["compression_s"] = time.perf_counter() - start
+    sizes = common.table_sizes(engine)
+    if sizes is not None:
+        extra["phrase_storage_bytes"] = sum(
+            size
+            for name, size in sizes.items()
+            if name in ("phrase", "phrase_part", "phrase_dictionary")
+            or name.startswith("sqlite_autoindex_phrase_")
+        )
+
+    sql_counter = SqlCounter(engine)
+    result = Result(
+        "broadcast",
+        {
+            "users": users,
+            "phrases": phrases,
+            "history": history,
+            "selection": selection,
+            "compression": compression,
+            "phrase_words": phrase_words,
+        },
+        extra=extra,
+    )
+    mock_bot.chats.clear()
+    send_times.times.clear()
+    with result.measure(sql_counter):
+        start = time.perf_counter()
+        app._send_phrases(dt.datetime.now(dt.UTC))
+        app._outbox_sender.drain()
+    times = [start] + send_times.times
+    result.latencies_s = [b - a for a, b in zip(times, times[1:])]
+    result.operations = sum(len(messages) for messages in mock_bot.chats.values())
+    # first message waits for the phrase selection
+    result.extra["time_to_first_message_s"] = result.latencies_s[0] if times[1:] else 0
+    return result
+
+
+class _TimedTeleBot(telebot.TeleBot):
+    latencies = []
+
+    def send_message(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().send_message(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def broadcast_http(
+    engine,
+    *,
+    users: int,
+    phrases: int,
+    history: int,
+    latency_ms: float,
+    error_rate: float,
+    rate_limit: float | None,
+    selection: str,
+    max_concurrency: int,
+    working_dir: pathlib.Path,
+    **_,
+) -> Result:
+    """Broadcast through real telebot to the fake Bot API server"""
+    common.populate(engine, users=users, phrases=phrases, history=history)
+    params = {
+        "users": users,
+        "phrases": phrases,
+        "history": history,
+        "latency_ms": latency_ms,
+        "error_rate": error_rate,
+        "rate_limit": rate_limit,
+        "selection": selection,
+        "max_concurrency": max_concurrency,
+    }
+    config = FakeTelegramConfig(
+        latency=latency_ms / 1000, error_rate=error_rate, rate_limit=rate_limit
+    )
+    api_url = telebot.apihelper.API_URL
+    with FakeTelegramServer(config) as server:
+        app = _create_app(
+            engine,
+            working_dir,
+            _TimedTeleBot,
+            api_url=server.api_url,
+            broadcast={"selection": selection, "max_concurrency": max_concurrency},
+        )
+        sql_counter = SqlCounter(engine)
+        result = Result("broadcast_http", params)
+        _TimedTeleBot.latencies = result.latencies_s
+        try:
+            with result.measure(sql_counter):
+                app._send_phrases(dt.datetime.now(dt.UTC))
+                app._outbox_sender.drain()
+        finally:
+            telebot.apihelper.API_URL = api_url
+        result.operations = server.requests["sendMessage"]
+        result.extra["delivered"] = sum(len(m) for m in server.chats.values())
+        result.extra["errors"] = dict(server.errors)
+        result.extra["connections"] = server.connections
+        result.extra["send_window"] = outbox.SEND_WINDOW.get()
+    return result
+
+
+def sent_tracking(engine, *, users: int, phrases: int, history: int, **_) -> Result:
+    """Storage and lookup cost of sent phrases, UsedPhrases rows against
+    SentBitmap. Operations are bitmap lookups, one per subscriber."""
+    common.populate(engine, users=users, phrases=phrases, history=history)
+    service = PS.PhrasesService()
+    sql_counter = SqlCounter(engine)
+    result = Result(
+        "sent_tracking", {"users": users, "phrases": phrases, "history": history}
+    )
+    with sqlalchemy.orm.Session(engine) as session:
+        with result.measure(sql_counter):
+            start = time.perf_counter()
+            service.pick_phrases_by_bitmap(session)
+            result.latencies_s.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        service.plan_phrases_vectorized(session)
+        result.extra["vectorized_selection_s"] = time.perf_counter() - start
+        start = time.perf_counter()
+        service.pick_phrases_by_permutation(session, seed=0)
+        result.extra["permutation_selection_s"] = time.perf_counter() - start
+        start = time.perf_counter()
+        service.fill_queues(session, 1)
+        service.get_next_phrases(session)
+        result.extra["queue_selection_s"] = time.perf_counter() - start
+        deliveries = session.query(models.UsedPhrases).count()
+    result.operations = users
+    result.extra["deliveries"] = deliveries
+
+    sizes = common.table_sizes(engine)
+    if sizes is not None and deliveries:
+        storage = {
+            "used_phrases": sum(
+                size for name, size in sizes.items() if "used_phrases" in name
+            ),
+            "sent_bitmap": sum(
+                size for name, size in sizes.items() if "sent_bitmap" in name
+            ),
+        }
+        result.extra["storage_bytes"] = storage
+        result.extra["projected_mb_at_100m_deliveries"] = {
+            name: size / deliveries * 100_000_000 / 2**20
+            for name, size in storage.items()
+        }
+    return result
+
+
+def search(engine, *, phrases: int, commands: int, phrase_words: int, **_) -> Result:
+    """Full-text phrase search of /find, commands searches per word of the
+    generated quotes"""
+    common.populate(
+        engine, users=1, phrases=phrases, history=0, phrase_words=phrase_words or 10
+    )
+    service = PS.PhrasesService()
+    sql_counter = SqlCounter(engine)
+    result = Result(
+        "search",
+        {"phrases": phrases, "commands": commands, "phrase_words": phrase_words},
+    )
+    queries = [word for word in common.WORDS for _ in range(commands)]
+    queries += [f'"{a} {b}"' for a, b in zip(common.WORDS, common.WORDS[1:])]
+    with sqlalchemy.orm.Session(engine) as session:
+        with result.measure(sql_counter):
+            for query in queries:
+                start = time.perf_counter()
+                service.find_phrases(session, query, 11)
+                result.latencies_s.append(time.perf_counter() - start)
+    result.operations = len(queries)
+    return result
+
+
+def broadcast_memory(
+    engine,
+    *,
+    users: int,
+    phrases: int,
+    history: int,
+    selection: str,
+    working_dir: pathlib.Path,
+    **_,
+) -> Result:
+    """Python memory allocated by a broadcast of one shard, traced with
+    tracemalloc: the phrase selection and the whole shard up to the commit
+    of its outbox messages. Peaks are per 100k recipients."""
+    common.populate(engine, users=users, phrases=phrases, history=history)
+    app = _create_app(
+        engine,
+        working_dir,
+        lambda *args, **kwargs: test.bot.MockTelebot(),
+        broadcast={"selection": selection},
+    )
+    sql_counter = SqlCounter(engine)
+    result = Result(
+        "broadcast_memory",
+        {
+            "users": users,
+            "phrases": phrases,
+            "history": history,
+            "selection": selection,
+        },
+    )
+    scale = 100000 / max(users, 1) / 2**20
+    with app._create_session() as session:
+        # texts and ordinals are cached by the first broadcast
+        app._select_phrases(session, 0, 1)
+        session.rollback()
+        tracemalloc.start()
+        start = time.perf_counter()
+        plan = app._select_phrases(session, 0, 1)
+        result.latencies_s.append(time.perf_counter() - start)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        session.rollback()
+    result.extra["plan_mb_per_100k"] = current * scale
+    result.extra["plan_peak_mb_per_100k"] = peak * scale
+    del plan
+    wakeup_time = dt.datetime.now(dt.UTC)
+    with app._create_session() as session:
+        app._shard_service.create_run(session, wakeup_time, 1)
+        shard = app._shard_service.claim_shard(session, wakeup_time, "benchmark")
+    tracemalloc.start()
+    with result.measure(sql_counter):
+        start = time.perf_counter()
+        app._send_shard_phrases(shard)
+        result.latencies_s.append(time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result.extra["shard_peak_mb_per_100k"] = peak * scale
+    result.operations = users
+    return result
+
+
+SCENARIOS = {
+    "commands": commands,
+    "upload": upload,
+    "broadcast": broadcast,
+    "broadcast_http": broadcast_http,
+    "sent_tracking": sent_tracking,
+    "search": search,
+    "broadcast_memory": broadcast_memory,
+}
@@ -17,12 +17,29 @@ def start(args):
     if args.config:
         env["IVANOV_CONFIG"] = args.config
     main_script = pathlib.Path(args.cwd) / "src" / "main.py"
+    # additional processes only take part in broadcasts,
+    # shards are distributed between them through the database
+    worker_env = dict(env, IVANOV_BROADCAST_WORKER="1")
+    for _ in range(args.workers - 1):
+        subprocess.Popen([sys.executable, main_script], cwd=args.cwd, env=worker_env)
     executor = subprocess.check_call
     if args.background:
         executor = subprocess.Popen
     executor([sys.executable, main_script], cwd=args.cwd, env=env)
 
 
+def vacuum(args):
+    # the full VACUUM locks the database, the bot must be stopped
+    if find_processes():
+        print("stop the bot first")
+        return
+    env = dict(os.environ, IVANOV_ENABLE_INCREMENTAL_VACUUM="1")
+    if args.config:
+        env["IVANOV_CONFIG"] = args.config
+    main_script = pathlib.Path(args.cwd) / "src" / "main.py"
+    subprocess.check_call([sys.executable, main_script], cwd=args.cwd, env=env)
+
+
 def check_if_target(command_line, cwd):
     if not command_line or len(command_line) <= 1:
         return False
@@ -74,13 +91,29 @@ def main():
     )
     start_parser.add_argument("--background", action="store_true")
     start_parser.add_argument("--config")
+    start_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes sending phrases, see broadcast.shards in config",
+    )
 
     stop_parser = subparsers.add_parser("stop")
 
+    vacuum_parser = subparsers.add_parser(
+        "vacuum", help="switch an old database to incremental vacuum, offline"
+    )
+    vacuum_parser.add_argument(
+        "-C", default=pathlib.Path(__file__).parent.parent, dest="cwd"
+    )
+    vacuum_parser.add_argument("--config")
+
     args = parser.parse_args()
 
     if args.command == "start":
         start(args)
+    elif args.command == "vacuum":
+        vacuum(args)
     else:
         stop(args)
 
@@ -0,0 +1,40 @@
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "benchmarks"))
+
+import run  # noqa: E402
+import scenarios  # noqa: E402
+from db import models  # noqa: E402
+
+
+@pytest.mark.parametrize("scenario", sorted(scenarios.SCENARIOS))
+def test_benchmark_scenarios(tmp_path, scenario):
+    engine = models.init_db_for_testing()
+    result = scenarios.SCENARIOS[scenario](
+        engine,
+        users=5,
+        commands=3,
+        phrases=10,
+        history=2,
+        uploads=2,
+        latency_ms=1,
+        error_rate=0,
+        rate_limit=None,
+        selection="queue",
+        compression=True,
+        phrase_words=5,
+        max_concurrency=4,
+        working_dir=tmp_path,
+    ).to_json()
+    assert result["scenario"] == scenario
+    assert result["operations"] > 0
+    assert result["sql_statements"] > 0
+    assert result["latency_ms"]["p99"] >= result["latency_ms"]["p50"]
+    assert result["peak_rss_mb"] > 0
+
+    assert not run.compare(result, result, tolerance=0.1)
+    slower = dict(result, throughput_per_s=result["throughput_per_s"] / 2)
+    assert run.compare(slower, result, tolerance=0.1)
@@ -0,0 +1,67 @@
+"""Sets of small non-negative integers stored as little-endian bitmaps,
+bit i % 8 of byte i // 8 is set if i is in the set"""
+
+import random
+
+
+def set_bits(bits: bytes, positions) -> bytes:
+    positions = list(positions)
+    if not positions:
+        return bits
+    result = bytearray(bits)
+    size = max(positions) // 8 + 1
+    if len(result) < size:
+        result.extend(bytes(size - len(result)))
+    for position in positions:
+        result[position // 8] |= 1 << (position % 8)
+    return bytes(result)
+
+
+def clear_bits(bits: bytes, positions) -> bytes:
+    result = bytearray(bits)
+    for position in positions:
+        if position // 8 < len(result):
+            result[position // 8] &= ~(1 << (position % 8)) & 0xFF
+    return bytes(result.rstrip(b"\0"))
+
+
+def is_set(bits: bytes, position: int) -> bool:
+    index = position // 8
+    return index < len(bits) and bool(bits[index] & (1 << (position % 8)))
+
+
+def count(bits: bytes) -> int:
+    return int.from_bytes(bits, "little").bit_count()
+
+
+def unset_positions(bits: bytes, size: int) -> list[int]:
+    """Positions below size which aren't set, full bytes are skipped"""
+    positions = []
+    for index, byte in enumerate(bits[: (size + 7) // 8]):
+        if byte == 0xFF:
+            continue
+        for bit in range(8):
+            if not byte & (1 << bit):
+                positions.append(index * 8 + bit)
+    while positions and positions[-1] >= size:
+        positions.pop()
+    positions.extend(range(len(bits) * 8, size))
+    return positions
+
+
+def pick_unset(
+    bits: bytes, size: int, rng: random.Random, probes: int = 8
+) -> int | None:
+    """Uniformly random position below size which isn't set.
+
+    Random positions are probed first, it's enough while the set is sparse,
+    the bitmap is scanned otherwise.
+    """
+    if size <= 0:
+        return None
+    for _ in range(probes):
+        position = rng.randrange(size)
+        if not is_set(bits, position):
+            return position
+    positions = unset_positions(bits, size)
+    return rng.choice(positions) if positions else None
@@ -0,0 +1,51 @@
+import collections
+import random
+
+import bitset
+
+
+def test_set_bits():
+    bits = bitset.set_bits(b"", [0, 9])
+    assert bits == bytes([0b1, 0b10])
+    assert bitset.set_bits(bits, []) is bits
+    bits = bitset.set_bits(bits, [1, 23])
+    assert bits == bytes([0b11, 0b10, 0b10000000])
+    assert [p for p in range(30) if bitset.is_set(bits, p)] == [0, 1, 9, 23]
+    assert bitset.count(bits) == 4
+    assert bitset.count(b"") == 0
+
+
+def test_unset_positions():
+    bits = bitset.set_bits(b"", [p for p in range(20) if p != 3 and p != 17])
+    assert bitset.unset_positions(bits, 20) == [3, 17]
+    assert bitset.unset_positions(bits, 10) == [3]
+    assert bitset.unset_positions(bits, 26) == [3, 17, 20, 21, 22, 23, 24, 25]
+    assert bitset.unset_positions(b"", 3) == [0, 1, 2]
+    assert bitset.unset_positions(b"", 0) == []
+
+
+def test_pick_unset():
+    rng = random.Random(1)
+    assert bitset.pick_unset(b"", 0, rng) is None
+    full = bitset.set_bits(b"", range(16))
+    assert bitset.pick_unset(full, 16, rng) is None
+    assert bitset.pick_unset(full, 17, rng) == 16
+
+    # dense set, found by scan
+    bits = bitset.set_bits(b"", [p for p in range(1000) if p not in (5, 500)])
+    freq = collections.Counter(bitset.pick_unset(bits, 1000, rng) for _ in range(2000))
+    assert set(freq) == {5, 500}
+    assert abs(freq[5] / 2000 - 0.5) < 0.05
+
+    # sparse set, found by probes
+    bits = bitset.set_bits(b"", [1])
+    freq = collections.Counter(bitset.pick_unset(bits, 4, rng) for _ in range(3000))
+    assert set(freq) == {0, 2, 3}
+    assert all(abs(n / 3000 - 1 / 3) < 0.05 for n in freq.values())
+
+
+def test_clear_bits():
+    bits = bitset.set_bits(b"", [0, 3, 9])
+    assert bitset.clear_bits(bits, [3]) == bytes([0b1, 0b10])
+    assert bitset.clear_bits(bits, [9, 100]) == bytes([0b1001])
+    assert bitset.clear_bits(bits, [0, 3, 9]) == b""
@@ -1,46 +1,89 @@
 from io import BytesIO
+import re
+import threading
 import telebot
 from db import models
 import exceptions
+import metrics
+import outbox
+import outbox_service as OS
+import profiler
+import telegram_text
+import tracing
 import user_service as US
 import phrases_service as PS
 import pandas as pd
 
+DEFAULT_PROFILE_DURATION = 10
+MAX_PROFILE_DURATION = 60
+PROFILE_TOP = 20
+FIND_PAGE_SIZE = 10
+# "/find words page:2" is the second page
+FIND_PAGE = re.compile(r"\s*\bpage:(\d+)$")
+# phrases are shortened to this in search results and reports
+PREVIEW_LENGTH = 300
+
+HANDLER_DURATION = metrics.REGISTRY.histogram(
+    "ivanov_handler_duration_seconds", "Duration of bot command handlers"
+)
+
+
+def _preview(text: str) -> str:
+    if len(text) > PREVIEW_LENGTH:
+        return text[:PREVIEW_LENGTH] + "…"
+    return text
+
+
+def _first_message(text: str) -> str:
+    """The text cut to one message, between paragraphs if possible"""
+    return telegram_text.split(text)[0]
+
 
 def _with_user(*, create: bool, require_roles: set[models.Role] | None = None):
     require_roles = require_roles or []
 
     def _decorator(f):
         def _impl(self: "Bot", message: telebot.types.Message, *args, **kwargs):
-            try:
-                with self._create_session() as session:
-                    user_service: US.UserService = self._user_service
-                    user = user_service.get_user(session, message.chat.id)
-                    username = None
-                    if message.from_user:
-                        username = message.from_user.username
-                    if not user and create:
-                        user = user_service.create_user(
-                            session, message.chat.id, username
-                        )
-                    if username is not None and user.username is None:
-                        user.username = username
-                        session.commit()
-                        session.refresh(user)
-                    if require_roles:
-                        if not user:
-                            raise exceptions.RolesAreRequired(require_roles)
-                        absent_roles = set()
-                        for role in require_roles:
-                            if not user.has_role(role):
-                                absent_roles.add(role)
-                        if absent_roles:
-                            raise exceptions.RolesAreRequired(list(absent_roles))
+            with (
+                HANDLER_DURATION.time(handler=f.__name__),
+                tracing.span(f"Bot.{f.__name__}", chat_id=message.chat.id),
+                self._create_session() as session,
+            ):
+                try:
+                    with tracing.span("_with_user"):
+                        user_service: US.UserService = self._user_service
+                        username = None
+                        if message.from_user:
+                            username = message.from_user.username
+                        if create:
+                            user = user_service.get_or_create_user(
+                                session, message.chat.id, username
+                            )
+                        else:
+                            user = user_service.get_user(session, message.chat.id)
+                        if (
+                            user is not None
+                            and username is not None
+                            and user.username is None
+                        ):
+                            user.username = username
+                            session.commit()
+                            session.refresh(user)
+                        if require_roles:
+                            if not user:
+                                raise exceptions.RolesAreRequired(require_roles)
+                            absent_roles = set()
+                            for role in require_roles:
+                                if not user.has_role(role):
+                                    absent_roles.add(role)
+                            if absent_roles:
+                                raise exceptions.RolesAreRequired(list(absent_roles))
                     kwargs["user"] = user
                     kwargs["session"] = session
                     f(self, message, *args, **kwargs)
-            except exceptions.RolesAreRequired:
-                self._bot.send_message(message.chat.id, "The action is forbidden")
+                except exceptions.RolesAreRequired:
+                    session.rollback()
+                    self._reply(session, message.chat.id, "The action is forbidden")
 
         return _impl
 
@@ -54,17 +97,25 @@ class Bot:
         create_session,
         user_service: US.UserService,
         phrases_service: PS.PhrasesService,
+        outbox: outbox.OutboxSender | None = None,
+        queue_size: int | None = None,
     ):
+        """Replies go through the outbox if it's given. If queue_size is
+        given phrase queues of new subscribers are filled to it."""
         self._bot = bot
+        self._outbox = outbox
         self._create_session = create_session
         self._user_service = user_service
         self._phrases_service = phrases_service
+        self._queue_size = queue_size
 
         message_handlers = (
             (self._start, {"start"}),
             (self._help, {"help"}),
             (self._stop, {"stop"}),
             (self._edit, {"edit"}),
+            (self._profile, {"profile"}),
+            (self._find, {"find"}),
         )
         for handler, commands in message_handlers:
             self._bot.message_handler(commands=list(commands))(handler)
@@ -72,6 +123,21 @@ class Bot:
             self._document_handler
         )
         self.wait_for_file = {}
+        self._profiling = threading.Lock()
+        self._profile_thread = None
+
+    def _reply(self, session, chat_id: int, text: str):
+        """Commits the session with the reply, so changes of the handler
+        aren't committed without it"""
+        if self._outbox is None:
+            session.commit()
+            self._bot.send_message(chat_id, text)
+            return
+        self._outbox.enqueue(
+            session, [OS.Message(chat_id, text)], OS.Priority.INTERACTIVE
+        )
+        session.commit()
+        self._outbox.wake(OS.Priority.INTERACTIVE)
 
     def start_bot(self):
         # set error handler
@@ -84,20 +150,27 @@ class Bot:
     def _start(self, message: telebot.types.Message, *, session, user):
         self._user_service.change_role(session, user, models.Role.SEND_PHRASES, True)
         if user.is_admin():
-            self._bot.send_message(
-                message.chat.id, "Hello! You're subscribed now.\nAnd you're an admin"
+            self._reply(
+                session,
+                message.chat.id,
+                "Hello! You're subscribed now.\nAnd you're an admin",
             )
         else:
-            self._bot.send_message(message.chat.id, "Hello! You're subscribed now")
+            self._reply(session, message.chat.id, "Hello! You're subscribed now")
+        if self._queue_size:
+            # otherwise the queue is empty until the next fill between broadcasts
+            self._phrases_service.fill_queues(
+                session, self._queue_size, user_id=user.id
+            )
 
     @_with_user(create=True)
     def _stop(self, message: telebot.types.Message, *, session, user):
         self._user_service.change_role(session, user, models.Role.SEND_PHRASES, False)
-        self._bot.send_message(message.chat.id, "You're unsubscribed now")
+        self._reply(session, message.chat.id, "You're unsubscribed now")
 
     @_with_user(create=False)
     def _help(self, message: telebot.types.Message, *, session, user):
-        self._bot.send_message(message.chat.id, "Help")
+        self._reply(session, message.chat.id, "Help")
 
     @_with_user(create=False, require_roles={models.Role.ADMIN})
     def _edit(self, message: telebot.types.Message, *, session, user):
@@ -106,6 +179,78 @@ class Bot:
         )
         self.wait_for_file[message.chat.id] = sent_message.id
 
+    @_with_user(create=False, require_roles={models.Role.ADMIN})
+    def _profile(self, message: telebot.types.Message, *, session, user):
+        args = (message.text or "").split()[1:]
+        try:
+            duration = float(args[0]) if args else DEFAULT_PROFILE_DURATION
+        except ValueError:
+            self._reply(session, message.chat.id, "Usage: /profile [seconds]")
+            return
+        duration = min(max(duration, 0.1), MAX_PROFILE_DURATION)
+        if not self._profiling.acquire(blocking=False):
+            self._reply(session, message.chat.id, "Profiling is already running")
+            return
+        self._reply(session, message.chat.id, f"Profiling for {duration:g}s")
+        self._profile_thread = threading.Thread(
+            target=self._run_profile,
+            args=(message.chat.id, duration),
+            name="Profiler",
+            daemon=True,
+        )
+        self._profile_thread.start()
+
+    @_with_user(create=False, require_roles={models.Role.ADMIN})
+    def _find(self, message: telebot.types.Message, *, session, user):
+        args = (message.text or "").split(maxsplit=1)[1:]
+        query = args[0] if args else ""
+        page = 1
+        match = FIND_PAGE.search(query)
+        if match:
+            page = max(int(match.group(1)), 1)
+            query = query[: match.start()]
+        if not query.strip():
+            self._reply(
+                session,
+                message.chat.id,
+                'Usage: /find words or "a phrase" [page:N]',
+            )
+            return
+        found = self._phrases_service.find_phrases(
+            session, query, FIND_PAGE_SIZE + 1, (page - 1) * FIND_PAGE_SIZE
+        )
+        if not found:
+            self._reply(
+                session,
+                message.chat.id,
+                "No phrases found" if page == 1 else "No more phrases found",
+            )
+            return
+        lines = [f"Phrases matching {query}, page {page}:"]
+        first = (page - 1) * FIND_PAGE_SIZE + 1
+        for n, (_, text) in enumerate(found[:FIND_PAGE_SIZE], start=first):
+            lines.append(f"{n}. {_preview(text)}")
+        if len(found) > FIND_PAGE_SIZE:
+            lines.append(f"Next page: /find {query} page:{page + 1}")
+        self._reply(session, message.chat.id, _first_message("\n\n".join(lines)))
+
+    def _run_profile(self, chat_id, duration: float):
+        try:
+            profile = profiler.SamplingProfiler().run(duration)
+            summary = profile.summary(top=PROFILE_TOP)
+            with self._create_session() as session:
+                self._reply(session, chat_id, _first_message(summary))
+            # the outbox has no documents
+            self._bot.send_document(
+                chat_id,
+                telebot.types.InputFile(
+                    BytesIO(profile.collapsed().encode("utf-8")),
+                    "profile.collapsed.txt",
+                ),
+            )
+        finally:
+            self._profiling.release()
+
     @_with_user(create=False)
     def _document_handler(self, message: telebot.types.Message, *, session, user):
         if not user.is_admin():
@@ -114,19 +259,22 @@ class Bot:
             return
         message_id = self.wait_for_file.get(message.chat.id)
         if message_id is None:
-            self._bot.send_message(
-                message.chat.id, "Has no active edit request, send /edit command again"
+            self._reply(
+                session,
+                message.chat.id,
+                "Has no active edit request, send /edit command again",
             )
             return
         if message_id != message.reply_to_message.id:
-            self._bot.send_message(
+            self._reply(
+                session,
                 message.chat.id,
                 "Active edit request is bound to another message, send /edit command again",
             )
             return
         file_info = self._bot.get_file(message.document.file_id)
         if file_info.file_size > 200 * 1024:
-            self._bot.send_message(message.chat.id, "File is too big")
+            self._reply(session, message.chat.id, "File is too big")
             return
         # TODO: maybe replace with database UI
         file = self._bot.download_file(file_info.file_path)
@@ -134,23 +282,31 @@ class Bot:
             try:
                 df = pd.read_csv(BytesIO(file), dtype=str)
             except pd.errors.EmptyDataError as e:
-                self._bot.send_message(message.chat.id, "Empty file")
+                self._reply(session, message.chat.id, "Empty file")
                 return
             except Exception as e:
-                self._bot.send_message(
-                    message.chat.id, "Bad file format, unknown error"
-                )
+                self._reply(session, message.chat.id, "Bad file format, unknown error")
                 return
         else:
-            self._bot.send_message(message.chat.id, "Bad file format")
+            self._reply(session, message.chat.id, "Bad file format")
             return
         column = "Цитаты"
         if df.columns.shape != (1,) or df.columns != [column]:
-            self._bot.send_message(
-                message.chat.id, f"Bad file format, expected 1 column '{column}'"
+            self._reply(
+                session,
+                message.chat.id,
+                f"Bad file format, expected 1 column '{column}'",
             )
             return
         df = df.fillna("")
         phrases = df["Цитаты"].tolist()
-        self._phrases_service.add_phrases(session, phrases)
+        added = self._phrases_service.add_phrases(session, phrases)
         self.wait_for_file[message.chat.id] = None
+        if added.near_duplicates:
+            lines = [
+                f"Added {added.added} phrases, skipped "
+                f"{len(added.near_duplicates)} near-duplicates:"
+            ]
+            for skipped, similar in added.near_duplicates:
+                lines.append(f"{_preview(skipped)}\nis similar to\n{_preview(similar)}")
+            self._reply(session, message.chat.id, _first_message("\n\n".join(lines)))
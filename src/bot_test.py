@@ -5,6 +5,7 @@ import dataclasses
 from db import models
 import user_service as US
 import phrases_service as PS
+import telegram_text
 import test.bot
 
 
@@ -19,6 +20,7 @@ class BotEnvironment:
     bot: test.bot.MockTelebot
     user_service: US.UserService
     phrases_service: US.UserService
+    bot_impl: B.Bot
 
 
 @pytest.fixture
@@ -26,8 +28,8 @@ def bot_environment(testing_db):
     bot_impl = test.bot.MockTelebot()
     user_service = US.UserService()
     phrases_service = PS.PhrasesService()
-    B.Bot(bot_impl, testing_db.session, user_service, phrases_service)
-    yield BotEnvironment(bot_impl, user_service, phrases_service)
+    impl = B.Bot(bot_impl, testing_db.session, user_service, phrases_service)
+    yield BotEnvironment(bot_impl, user_service, phrases_service, impl)
 
 
 def test_bot_commands(testing_db, bot_environment):
@@ -137,9 +139,7 @@ def test_bot_add_phrases(testing_db, bot_environment):
 2
 3
 ""
-""".encode(
-            "utf-8"
-        ),
+""".encode("utf-8"),
     )
     bot.add_file(
         "phrases2.csv",
@@ -151,9 +151,7 @@ def test_bot_add_phrases(testing_db, bot_environment):
 ""
 ""
 5
-""".encode(
-            "utf-8"
-        ),
+""".encode("utf-8"),
     )
 
     admin = 1000
@@ -310,3 +308,148 @@ def test_bot_add_phrases_no_phrases(testing_db, bot_environment):
         n_messages += 1
         assert len(bot.chats[admin]) == n_messages
         assert not session.query(models.Phrase).all()
+
+
+def test_bot_profile(testing_db, bot_environment):
+    bot = bot_environment.bot
+    admin = 1000
+    user = 2000
+    session = testing_db.session()
+    session.add(models.User(chat_id=admin, _is_admin=True, _send_phrases=False))
+    session.add(models.User(chat_id=user, _send_phrases=True))
+    session.commit()
+
+    bot.user_message(user, "profile")
+    assert bot.chats[user] == ["The action is forbidden"]
+    assert not bot.documents[user]
+
+    bot.user_message(admin, "profile abc")
+    assert bot.chats[admin] == ["Usage: /profile [seconds]"]
+
+    bot.user_message(admin, "profile 0.2")
+    bot.user_message(admin, "profile 0.2")
+    assert bot.chats[admin][1:] == [
+        "Profiling for 0.2s",
+        "Profiling is already running",
+    ]
+    bot_environment.bot_impl._profile_thread.join()
+
+    assert "samples in" in bot.chats[admin][-1]
+    assert "Top 20 by own time:" in bot.chats[admin][-1]
+    assert len(bot.documents[admin]) == 1
+    document = bot.documents[admin][0]
+    assert document.file_name == "profile.collapsed.txt"
+    assert document.file.read()
+
+
+def test_bot_find(testing_db, bot_environment):
+    bot = bot_environment.bot
+    admin = 1000
+    user = 2000
+    session = testing_db.session()
+    session.add(models.User(chat_id=admin, _is_admin=True, _send_phrases=False))
+    session.add(models.User(chat_id=user, _send_phrases=True))
+    session.commit()
+    bot_environment.phrases_service.add_phrases(
+        session, [f"quote {i} about time" for i in range(15)] + ["x" * 1000]
+    )
+
+    bot.user_message(user, "find time")
+    assert bot.chats[user] == ["The action is forbidden"]
+
+    bot.user_message(admin, "find")
+    assert bot.chats[admin] == ['Usage: /find words or "a phrase" [page:N]']
+
+    bot.user_message(admin, "find time")
+    lines = bot.chats[admin][-1].split("\n\n")
+    assert lines[0] == "Phrases matching time, page 1:"
+    assert len(lines) == 2 + B.FIND_PAGE_SIZE
+    assert lines[-1] == "Next page: /find time page:2"
+
+    bot.user_message(admin, "find time page:2")
+    lines = bot.chats[admin][-1].split("\n\n")
+    assert lines[0] == "Phrases matching time, page 2:"
+    assert len(lines) == 1 + 15 - B.FIND_PAGE_SIZE
+    assert lines[1].startswith(f"{B.FIND_PAGE_SIZE + 1}. quote ")
+
+    bot.user_message(admin, "find time page:3")
+    assert bot.chats[admin][-1] == "No more phrases found"
+
+    bot.user_message(admin, "find xxx")
+    assert bot.chats[admin][-1] == "No phrases found"
+    bot.user_message(admin, "find " + "x" * 1000)
+    assert bot.chats[admin][-1].endswith("x" * B.PREVIEW_LENGTH + "…")
+    # a leading number is a word of the query
+    bot.user_message(admin, "find 3 about")
+    assert bot.chats[admin][-1].startswith("Phrases matching 3 about, page 1:")
+    bot.user_message(admin, "find page:2")
+    assert bot.chats[admin][-1] == 'Usage: /find words or "a phrase" [page:N]'
+
+
+def test_bot_find_long_reply(testing_db, bot_environment):
+    bot = bot_environment.bot
+    admin = 1000
+    session = testing_db.session()
+    session.add(models.User(chat_id=admin, _is_admin=True, _send_phrases=False))
+    session.commit()
+    # 2 UTF-16 code units each
+    emoji = "\U0001f600"
+    bot_environment.phrases_service.add_phrases(
+        session, [f"smile {i} " + emoji * 500 for i in range(B.FIND_PAGE_SIZE)]
+    )
+
+    bot.user_message(admin, "find smile")
+    reply = bot.chats[admin][-1]
+    assert telegram_text.length(reply) <= telegram_text.MAX_MESSAGE_LENGTH
+    assert reply.startswith("Phrases matching smile, page 1:")
+    # cut between the results
+    assert reply.endswith("…")
+    assert 1 < len(reply.split("\n\n")) < 1 + B.FIND_PAGE_SIZE
+
+
+def test_bot_add_near_duplicates(testing_db, bot_environment):
+    bot = bot_environment.bot
+    admin = 1000
+    session = testing_db.session()
+    session.add(models.User(chat_id=admin, _is_admin=True, _send_phrases=False))
+    session.commit()
+    bot_environment.phrases_service.add_phrases(
+        session, ["The only thing we have to fear is fear itself"]
+    )
+    bot.add_file(
+        "phrases.csv",
+        'Цитаты\n"The only thing we have to fear is fear itself!"\nNew one\n'.encode(
+            "utf-8"
+        ),
+    )
+
+    bot.user_message(admin, "edit")
+    bot.user_message(
+        admin, reply_to=bot.full_chats[admin][-1], file=test.bot.File("phrases.csv")
+    )
+    assert bot.chats[admin][-1] == (
+        "Added 1 phrases, skipped 1 near-duplicates:\n\n"
+        "The only thing we have to fear is fear itself!\n"
+        "is similar to\n"
+        "The only thing we have to fear is fear itself"
+    )
+
+
+def test_bot_start_fills_queue(testing_db):
+    bot = test.bot.MockTelebot()
+    phrases_service = PS.PhrasesService()
+    B.Bot(bot, testing_db.session, US.UserService(), phrases_service, queue_size=2)
+    session = testing_db.session()
+    phrases_service.add_phrases(session, ["p1", "p2", "p3"])
+
+    bot.user_message(100, "start")
+    plan = phrases_service.get_next_phrases(session)
+    assert [(chat_id, phrase_id is not None) for _, chat_id, phrase_id in plan] == [
+        (100, True)
+    ]
+    assert session.query(models.QueuedPhrase).count() == 2
+    # other subscribers are left to the fill between broadcasts
+    session.add(models.User(chat_id=200, _send_phrases=True))
+    session.commit()
+    bot.user_message(100, "start")
+    assert session.query(models.QueuedPhrase).count() == 2
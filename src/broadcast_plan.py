@@ -0,0 +1,113 @@
+import array
+import typing
+import uuid
+
+# phrase index of recipients without a phrase
+NO_PHRASE = -1
+
+
+class BroadcastPlan:
+    """(user_id, chat_id, phrase_id) of every recipient of a broadcast,
+    stored by column.
+
+    A row of a plan of a million users was a tuple or a Row, with its own
+    chat id int, 100+ bytes each. Here chat ids are machine integers in an
+    array and phrase ids are interned, every recipient stores an index of
+    its phrase in phrase_ids, so a recipient costs its user id reference
+    and 12 bytes. Iterating yields the rows as tuples.
+
+    phrase_ordinals keeps Phrase.ordinal of every phrase of phrase_ids, or
+    None if the planner didn't know it, mark_sent() sets sent bits by them.
+    """
+
+    __slots__ = (
+        "user_ids",
+        "chat_ids",
+        "phrase_indexes",
+        "phrase_ids",
+        "phrase_ordinals",
+        "_indexes",
+    )
+
+    def __init__(
+        self,
+        phrase_ids: typing.Iterable[uuid.UUID | None] = (),
+        phrase_ordinals: typing.Iterable[int | None] | None = None,
+    ):
+        """phrase_ids presets the interned phrases for extend_indexed(),
+        they may have gaps of None"""
+        self.user_ids: list[uuid.UUID] = []
+        self.chat_ids = array.array("q")
+        self.phrase_indexes = array.array("i")
+        self.phrase_ids = list(phrase_ids)
+        if phrase_ordinals is None:
+            self.phrase_ordinals = [None] * len(self.phrase_ids)
+        else:
+            self.phrase_ordinals = list(phrase_ordinals)
+        assert len(self.phrase_ordinals) == len(self.phrase_ids)
+        self._indexes = {p: i for i, p in enumerate(self.phrase_ids) if p is not None}
+
+    @classmethod
+    def from_rows(
+        cls, rows: typing.Iterable[tuple[uuid.UUID, int, uuid.UUID | None]]
+    ) -> "BroadcastPlan":
+        plan = cls()
+        for user_id, chat_id, phrase_id in rows:
+            plan.append(user_id, chat_id, phrase_id)
+        return plan
+
+    def append(
+        self,
+        user_id: uuid.UUID,
+        chat_id: int,
+        phrase_id: uuid.UUID | None,
+        ordinal: int | None = None,
+    ):
+        self.user_ids.append(user_id)
+        self.chat_ids.append(chat_id)
+        self.phrase_indexes.append(
+            NO_PHRASE if phrase_id is None else self._intern(phrase_id, ordinal)
+        )
+
+    def extend_indexed(
+        self,
+        user_ids: typing.Iterable[uuid.UUID],
+        chat_ids: typing.Iterable[int],
+        phrase_indexes: typing.Iterable[int],
+    ):
+        """Adds recipients by indexes in phrase_ids, NO_PHRASE for none"""
+        self.user_ids.extend(user_ids)
+        self.chat_ids.extend(chat_ids)
+        self.phrase_indexes.extend(phrase_indexes)
+        assert len(self.user_ids) == len(self.chat_ids) == len(self.phrase_indexes)
+
+    def phrase_id(self, index: int) -> uuid.UUID | None:
+        """Phrase of the recipient at index"""
+        phrase_index = self.phrase_indexes[index]
+        return None if phrase_index == NO_PHRASE else self.phrase_ids[phrase_index]
+
+    def ordinals(self) -> dict[uuid.UUID, int]:
+        """Known ordinals of the planned phrases"""
+        return {
+            p: o
+            for p, o in zip(self.phrase_ids, self.phrase_ordinals)
+            if p is not None and o is not None
+        }
+
+    def _intern(self, phrase_id: uuid.UUID, ordinal: int | None) -> int:
+        index = self._indexes.get(phrase_id)
+        if index is None:
+            index = self._indexes[phrase_id] = len(self.phrase_ids)
+            self.phrase_ids.append(phrase_id)
+            self.phrase_ordinals.append(ordinal)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __iter__(self) -> typing.Iterator[tuple[uuid.UUID, int, uuid.UUID | None]]:
+        phrase_ids = self.phrase_ids
+        for user_id, chat_id, index in zip(
+            self.user_ids, self.chat_ids, self.phrase_indexes
+        ):
+            yield user_id, chat_id, None if index == NO_PHRASE else phrase_ids[index]
@@ -0,0 +1,38 @@
+import uuid
+
+import broadcast_plan as BP
+
+
+def test_append():
+    users = [uuid.uuid4() for _ in range(4)]
+    phrases = [uuid.uuid4() for _ in range(2)]
+    rows = [
+        (users[0], 10, phrases[0]),
+        (users[1], -100500, phrases[1]),
+        (users[2], 2**40, None),
+        (users[3], 13, phrases[0]),
+    ]
+    plan = BP.BroadcastPlan.from_rows(rows)
+    assert len(plan) == 4
+    assert list(plan) == rows
+    # phrases are stored once
+    assert plan.phrase_ids == phrases
+    assert list(plan.phrase_indexes) == [0, 1, BP.NO_PHRASE, 0]
+    assert [plan.phrase_id(i) for i in range(4)] == [r[2] for r in rows]
+    assert list(BP.BroadcastPlan()) == []
+
+
+def test_extend_indexed():
+    users = [uuid.uuid4() for _ in range(3)]
+    phrases = [uuid.uuid4(), None, uuid.uuid4()]
+    plan = BP.BroadcastPlan(phrases)
+    plan.extend_indexed(users[:2], [1, 2], [2, 0])
+    plan.extend_indexed(users[2:], [3], [BP.NO_PHRASE])
+    plan.append(users[0], 4, phrases[2])
+    assert list(plan) == [
+        (users[0], 1, phrases[2]),
+        (users[1], 2, phrases[0]),
+        (users[2], 3, None),
+        (users[0], 4, phrases[2]),
+    ]
+    assert plan.phrase_ids == phrases
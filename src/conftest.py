@@ -1 +1,3 @@
 from test.helpers import testing_db as testing_db
+from test.helpers import portable_db as portable_db
+from test.helpers import app_db as app_db
@@ -1,22 +1,38 @@
+import itertools
 import logging
 import typing
 import uuid
 import enum
 import datetime as dt
+import zlib
+import sqlalchemy
 from sqlalchemy import PrimaryKeyConstraint, func
+from sqlalchemy import BigInteger
 from sqlalchemy import StaticPool
 from sqlalchemy import create_engine
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import LargeBinary
 from sqlalchemy import String
 from sqlalchemy import Uuid
 from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 
+import bitset
+import minhash
+import phrase_compression
+import telegram_text
+
 logger = logging.getLogger(__name__)
 
+# bound parameters of an IN clause, sqlite limits their number
+_IN_BATCH_SIZE = 500
+
 ChatId = typing.NewType("ChatId", int)
 
 
@@ -29,19 +45,40 @@ class Role(enum.Enum):
     SEND_PHRASES = "SEND_PHRASES"
 
 
+def get_shard_key(user_id: uuid.UUID) -> int:
+    return zlib.crc32(user_id.bytes) & 0x7FFFFFFF
+
+
+def _default_shard_key(context):
+    return get_shard_key(context.get_current_parameters()["id"])
+
+
 class User(Base):
     __tablename__ = "user_account"
 
     id: Mapped[uuid.UUID] = mapped_column(
         Uuid(), primary_key=True, default=uuid.uuid4, index=True
     )
-    chat_id: Mapped[int] = mapped_column(unique=True, nullable=False, index=True)
+    # supergroup and channel ids don't fit into 32 bits
+    chat_id: Mapped[int] = mapped_column(
+        BigInteger, unique=True, nullable=False, index=True
+    )
     username: Mapped[str] = mapped_column(String(100), nullable=True)
     time_created: Mapped[dt.datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
     _is_admin: Mapped[bool] = mapped_column(default=False, nullable=False)
     _send_phrases: Mapped[bool] = mapped_column(default=False, nullable=False)
+    # hash of id, broadcasts are partitioned by shard_key % n_shards
+    shard_key: Mapped[int] = mapped_column(
+        default=_default_shard_key, nullable=True, index=True
+    )
+    # number of phrases sent with the permutation selection
+    phrase_position: Mapped[int] = mapped_column(nullable=True)
+    # number of times the history was compacted after all phrases were sent
+    cycle: Mapped[int] = mapped_column(nullable=True)
+    # broadcasts in a row which failed because the chat is unreachable
+    delivery_failures: Mapped[int] = mapped_column(nullable=True)
 
     def is_admin(self):
         return self._is_admin
@@ -61,6 +98,8 @@ class User(Base):
             self._is_admin = state
         elif role == Role.SEND_PHRASES:
             self._send_phrases = state
+            if state:
+                self.delivery_failures = None
         else:
             assert False, f"{role} <- {state}"
 
@@ -82,6 +121,80 @@ class Phrase(Base):
         Uuid(), primary_key=True, default=uuid.uuid4, nullable=False, index=True
     )
     text: Mapped[str] = mapped_column(String(100000), unique=True, nullable=False)
+    # dense number of the phrase, position in SentBitmap.bits
+    ordinal: Mapped[int] = mapped_column(nullable=True, unique=True, index=True)
+    # first ordinal of the phrases numbered together with this one
+    batch_start: Mapped[int] = mapped_column(nullable=True)
+    # text compressed with the dictionary, text is phrase_compression.key()
+    # of the original then
+    compressed: Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
+    dictionary_id = mapped_column(ForeignKey("phrase_dictionary.id"), nullable=True)
+
+
+class PhraseDictionary(Base):
+    """zlib preset dictionary trained on phrases, shared by the compressed
+    phrases"""
+
+    __tablename__ = "phrase_dictionary"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    time_created: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+
+class PhrasePart(Base):
+    """Messages a phrase longer than a Telegram message is sent as, split
+    when the phrase is added. Phrases which fit into one message have none."""
+
+    __tablename__ = "phrase_part"
+    phrase_id = mapped_column(ForeignKey("phrase.id"), nullable=False)
+    position: Mapped[int] = mapped_column(nullable=False)
+    text: Mapped[str] = mapped_column(
+        String(telegram_text.MAX_MESSAGE_LENGTH), nullable=False
+    )
+    __table_args__ = (
+        PrimaryKeyConstraint("phrase_id", "position", name="phrase_part"),
+    )
+
+
+class PhraseSignature(Base):
+    """MinHash of a phrase by Phrase.ordinal, see minhash.signature()"""
+
+    __tablename__ = "phrase_signature"
+    ordinal: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    signature: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+class PhraseBucket(Base):
+    """LSH buckets of phrase signatures, phrases sharing a bucket are
+    candidate near-duplicates"""
+
+    __tablename__ = "phrase_bucket"
+    bucket: Mapped[int] = mapped_column(nullable=False)
+    ordinal: Mapped[int] = mapped_column(nullable=False)
+    __table_args__ = (PrimaryKeyConstraint("bucket", "ordinal", name="phrase_bucket"),)
+
+
+class PhraseSearch(Base):
+    """Full-text index of phrases by Phrase.ordinal for postgres, sqlite
+    has the FTS5 table phrase_fts instead and leaves this one empty"""
+
+    __tablename__ = "phrase_search"
+    ordinal: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    document: Mapped[str] = mapped_column(
+        String().with_variant(postgresql.TSVECTOR(), "postgresql"), nullable=False
+    )
+    __table_args__ = (
+        Index("ix_phrase_search_document", "document", postgresql_using="gin").ddl_if(
+            dialect="postgresql"
+        ),
+    )
+
+
+# postgres text search configuration of phrase_search, words aren't stemmed
+# like in phrase_fts, but diacritics are kept
+SEARCH_CONFIG = "'simple'"
 
 
 class UsedPhrases(Base):
@@ -96,18 +209,398 @@ class UsedPhrases(Base):
     )
 
 
+class SentBitmap(Base):
+    """Phrases sent to a user as a bitmap indexed by Phrase.ordinal, the
+    same information as UsedPhrases in 1 bit per phrase"""
+
+    __tablename__ = "sent_bitmap"
+    user_id = mapped_column(ForeignKey("user_account.id"), primary_key=True)
+    bits: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+class QueuedPhrase(Base):
+    """Phrases precomputed for the next broadcasts of a user, the one with
+    the lowest position is sent first"""
+
+    __tablename__ = "phrase_queue"
+    user_id = mapped_column(ForeignKey("user_account.id"), nullable=False)
+    position: Mapped[int] = mapped_column(nullable=False)
+    phrase_id = mapped_column(ForeignKey("phrase.id"), nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint("user_id", "position", name="phrase_queue"),
+        Index("phrase_queue_user_phrase", "user_id", "phrase_id", unique=True),
+    )
+
+
+class OutboxMessage(Base):
+    """Message waiting to be sent, written in the same transaction as the
+    change it's about. Messages are sent by priority, then in order."""
+
+    __tablename__ = "outbox"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    priority: Mapped[int] = mapped_column(nullable=False)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # recipient of a broadcast, delivery failures are counted for the user
+    user_id = mapped_column(ForeignKey("user_account.id"), nullable=True)
+    text: Mapped[str] = mapped_column(String(100000), nullable=False)
+    attempts: Mapped[int] = mapped_column(default=0, nullable=False)
+    time_created: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    # claimed messages and messages waiting for a retry are hidden until then
+    time_available: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    __table_args__ = (Index("outbox_priority_id", "priority", "id"),)
+
+
+class BroadcastShard(Base):
+    __tablename__ = "broadcast_shard"
+    run_time: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True
+    )
+    shard: Mapped[int] = mapped_column(primary_key=True)
+    n_shards: Mapped[int] = mapped_column(nullable=False)
+    owner: Mapped[str] = mapped_column(String(200), nullable=True)
+    time_claimed: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    time_finished: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+
+
+class Lease(Base):
+    __tablename__ = "lease"
+    name: Mapped[str] = mapped_column(String(100), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(200), nullable=False)
+    time_heartbeat: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    time_expires: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+
+
+def dialect_insert(session):
+    """Returns dialect specific insert() which supports ON CONFLICT clauses"""
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
 def _common_db_init(engine):
     def _fk_pragma_on_connect(dbapi_con, con_record):
         dbapi_con.execute("pragma foreign_keys=ON")
 
-    event.listen(engine, "connect", _fk_pragma_on_connect)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _fk_pragma_on_connect)
+
+    with engine.begin() as connection:
+        existing = set(sqlalchemy.inspect(connection).get_table_names())
+        if engine.dialect.name == "sqlite" and not existing:
+            # set before the first table, later only a full VACUUM
+            # switches the database
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        Base.metadata.create_all(connection)
+        if existing:
+            for table, migration in _TABLE_MIGRATIONS.items():
+                if table not in existing:
+                    migration(connection)
+    _add_missing_columns(engine)
+    _widen_integer_columns(engine)
+    run_data_migrations(engine)
+
+
+def run_data_migrations(engine):
+    with engine.begin() as connection:
+        for migration in _DATA_MIGRATIONS:
+            migration(connection)
+
+
+def _add_missing_columns(engine):
+    # create_all() doesn't touch existing tables, so columns introduced after
+    # a table was created are added here. Such columns must be nullable.
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                assert column.nullable, column
+                logger.info(f"Adding column {table.name}.{column.name}")
+                column_type = column.type.compile(engine.dialect)
+                connection.execute(
+                    sqlalchemy.text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+                for index in table.indexes:
+                    if column.name in index.columns:
+                        index.create(connection, checkfirst=True)
 
-    Base.metadata.create_all(engine)
 
+def _widen_integer_columns(engine):
+    # columns declared INTEGER before they became BigInteger, sqlite integers
+    # are 64-bit anyway
+    if engine.dialect.name == "sqlite":
+        return
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"]: c["type"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if not isinstance(column.type, BigInteger) or isinstance(
+                    existing.get(column.name), BigInteger
+                ):
+                    continue
+                logger.info(f"Widening column {table.name}.{column.name}")
+                connection.execute(
+                    sqlalchemy.text(
+                        f"ALTER TABLE {table.name} ALTER COLUMN {column.name} "
+                        f"TYPE {column.type.compile(engine.dialect)}"
+                    )
+                )
 
-def init_db(db_path):
-    logger.info(f"Using database {db_path}")
-    engine = create_engine(db_path)
+
+def _fill_shard_keys(connection):
+    stmt = sqlalchemy.select(User.id).where(User.shard_key.is_(None))
+    values = [
+        {"b_id": user_id, "shard_key": get_shard_key(user_id)}
+        for user_id in connection.scalars(stmt)
+    ]
+    if values:
+        connection.execute(
+            sqlalchemy.update(User.__table__)
+            .where(User.__table__.c.id == sqlalchemy.bindparam("b_id"))
+            .values(shard_key=sqlalchemy.bindparam("shard_key")),
+            values,
+        )
+
+
+def fill_phrase_ordinals(connection):
+    """Numbers phrases without ordinal after the existing ones, in order of
+    creation. Also used for phrases inserted after the migration.
+
+    Phrases numbered by one call form a batch with contiguous ordinals.
+    """
+    phrase = Phrase.__table__
+    # numbered before batches were introduced
+    connection.execute(
+        sqlalchemy.update(phrase)
+        .where(phrase.c.ordinal.is_not(None), phrase.c.batch_start.is_(None))
+        .values(batch_start=0)
+    )
+    ids = connection.scalars(
+        sqlalchemy.select(phrase.c.id)
+        .where(phrase.c.ordinal.is_(None))
+        .order_by(phrase.c.time_created, phrase.c.id)
+    ).all()
+    if not ids:
+        return
+    first = connection.scalar(
+        sqlalchemy.select(
+            sqlalchemy.func.coalesce(sqlalchemy.func.max(phrase.c.ordinal) + 1, 0)
+        )
+    )
+    connection.execute(
+        sqlalchemy.update(phrase)
+        .where(phrase.c.id == sqlalchemy.bindparam("b_id"))
+        .values(ordinal=sqlalchemy.bindparam("ordinal"), batch_start=first),
+        [{"b_id": id, "ordinal": first + n} for n, id in enumerate(ids)],
+    )
+
+
+def _fill_sent_bitmaps(connection, batch_size: int = 10000):
+    used = UsedPhrases.__table__
+    phrase = Phrase.__table__
+    bitmap = SentBitmap.__table__
+    rows = connection.execute(
+        sqlalchemy.select(used.c.user_id, phrase.c.ordinal)
+        .join(phrase, phrase.c.id == used.c.phrase_id)
+        .where(~sqlalchemy.exists().where(bitmap.c.user_id == used.c.user_id))
+        .order_by(used.c.user_id)
+        .execution_options(yield_per=batch_size)
+    )
+    batch = []
+    for user_id, user_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        bits = bitset.set_bits(b"", [ordinal for _, ordinal in user_rows])
+        batch.append({"user_id": user_id, "bits": bits})
+        if len(batch) >= batch_size:
+            connection.execute(sqlalchemy.insert(bitmap), batch)
+            batch = []
+    if batch:
+        connection.execute(sqlalchemy.insert(bitmap), batch)
+
+
+def split_long_phrases(connection, phrase_ids: typing.Iterable | None = None):
+    """Stores parts of the given phrases longer than a message which don't
+    have them yet. All phrases are scanned only when phrase_part is created
+    for an existing database."""
+    phrase = Phrase.__table__
+    part = PhrasePart.__table__
+    stmt = sqlalchemy.select(phrase.c.id, phrase.c.text).where(
+        # a cheap filter, the length in UTF-16 units is at least that
+        func.length(phrase.c.text) > telegram_text.MAX_MESSAGE_LENGTH // 2,
+        ~sqlalchemy.exists().where(part.c.phrase_id == phrase.c.id),
+    )
+    if phrase_ids is None:
+        rows = connection.execute(stmt).all()
+    else:
+        phrase_ids = list(phrase_ids)
+        rows = []
+        for begin in range(0, len(phrase_ids), _IN_BATCH_SIZE):
+            rows += connection.execute(
+                stmt.where(phrase.c.id.in_(phrase_ids[begin : begin + _IN_BATCH_SIZE]))
+            ).all()
+    values = []
+    for phrase_id, text in rows:
+        parts = telegram_text.split(text)
+        if len(parts) > 1:
+            values += [
+                {"phrase_id": phrase_id, "position": position, "text": part_text}
+                for position, part_text in enumerate(parts)
+            ]
+    if values:
+        connection.execute(sqlalchemy.insert(part), values)
+
+
+def index_phrases(connection, batch_size: int = 10000):
+    """Adds phrases to the full-text index by ordinal, compressed phrases
+    are decompressed. sqlite has the FTS5 table phrase_fts, other databases
+    PhraseSearch. Also used for phrases inserted after the migration."""
+    if connection.dialect.name == "sqlite":
+        # contentless, texts are only kept in phrase
+        connection.execute(
+            sqlalchemy.text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS phrase_fts USING fts5"
+                "(text, content='', tokenize='unicode61 remove_diacritics 2')"
+            )
+        )
+        # ordinals of new phrases are after the indexed ones
+        last = connection.scalar(
+            sqlalchemy.text("SELECT rowid FROM phrase_fts ORDER BY rowid DESC LIMIT 1")
+        )
+        insert = sqlalchemy.text(
+            "INSERT INTO phrase_fts (rowid, text) VALUES (:ordinal, :text)"
+        )
+    else:
+        last = connection.scalar(sqlalchemy.select(func.max(PhraseSearch.ordinal)))
+        insert = sqlalchemy.text(
+            "INSERT INTO phrase_search (ordinal, document) "
+            f"VALUES (:ordinal, to_tsvector({SEARCH_CONFIG}, :text))"
+        )
+    dictionaries = dict(
+        connection.execute(
+            sqlalchemy.select(PhraseDictionary.id, PhraseDictionary.data)
+        ).all()
+    )
+    phrase = Phrase.__table__
+    rows = connection.execute(
+        sqlalchemy.select(
+            phrase.c.ordinal,
+            phrase.c.text,
+            phrase.c.compressed,
+            phrase.c.dictionary_id,
+        )
+        .where(phrase.c.ordinal > (-1 if last is None else last))
+        .execution_options(yield_per=batch_size)
+    )
+    for batch in rows.partitions():
+        connection.execute(
+            insert,
+            [
+                {
+                    "ordinal": ordinal,
+                    "text": _decompressed(
+                        text, compressed, dictionary_id, dictionaries
+                    ),
+                }
+                for ordinal, text, compressed, dictionary_id in batch
+            ],
+        )
+
+
+def fill_phrase_signatures(connection, batch_size: int = 10000):
+    """Stores signatures and LSH buckets of phrases which don't have them.
+    Also used for phrases inserted after the migration."""
+    phrase = Phrase.__table__
+    signature = PhraseSignature.__table__
+    dictionaries = dict(
+        connection.execute(
+            sqlalchemy.select(PhraseDictionary.id, PhraseDictionary.data)
+        ).all()
+    )
+    rows = connection.execute(
+        sqlalchemy.select(
+            phrase.c.ordinal, phrase.c.text, phrase.c.compressed, phrase.c.dictionary_id
+        )
+        .where(
+            phrase.c.ordinal.is_not(None),
+            ~sqlalchemy.exists().where(signature.c.ordinal == phrase.c.ordinal),
+        )
+        .execution_options(yield_per=batch_size)
+    )
+    for batch in rows.partitions():
+        signatures = []
+        buckets = []
+        for ordinal, text, compressed, dictionary_id in batch:
+            value = minhash.signature(
+                _decompressed(text, compressed, dictionary_id, dictionaries)
+            )
+            signatures.append(
+                {"ordinal": ordinal, "signature": minhash.to_bytes(value)}
+            )
+            # bands of a phrase may share a bucket
+            buckets += [
+                {"bucket": bucket, "ordinal": ordinal}
+                for bucket in set(minhash.bands(value))
+            ]
+        connection.execute(sqlalchemy.insert(signature), signatures)
+        connection.execute(sqlalchemy.insert(PhraseBucket.__table__), buckets)
+
+
+def _decompressed(text, compressed, dictionary_id, dictionaries) -> str:
+    if compressed is None:
+        return text
+    return phrase_compression.decompress(compressed, dictionaries[dictionary_id])
+
+
+# idempotent functions which fill columns added by _add_missing_columns
+_DATA_MIGRATIONS = [
+    _fill_shard_keys,
+    fill_phrase_ordinals,
+    _fill_sent_bitmaps,
+    index_phrases,
+    fill_phrase_signatures,
+]
+
+# functions which fill a table from existing rows once, when the table is
+# created for an existing database
+_TABLE_MIGRATIONS = {
+    PhrasePart.__tablename__: split_long_phrases,
+}
+
+
+def init_db(
+    db_url,
+    *,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30,
+    pool_recycle: int = 1800,
+):
+    logger.info(f"Using database {db_url}")
+    engine = create_engine(
+        db_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        # server side databases may drop idle connections
+        pool_pre_ping=not db_url.startswith("sqlite"),
+    )
     _common_db_init(engine)
     return engine
 
@@ -1,9 +1,12 @@
+import sqlite3
 import uuid
 
 import pytest
 import sqlalchemy
 import sqlalchemy.exc
+import sqlalchemy.orm
 
+import bitset
 from . import models
 
 
@@ -107,3 +110,87 @@ def test_used_phrases_table(testing_db):
                 )
             )
             session.commit()
+
+
+def test_add_missing_columns(tmp_path):
+    db_path = tmp_path / "iv.db"
+    user_id = uuid.uuid4()
+    with sqlite3.connect(db_path) as connection:
+        connection.execute("""CREATE TABLE user_account (
+                id CHAR(32) NOT NULL,
+                chat_id INTEGER NOT NULL,
+                username VARCHAR(100),
+                time_created DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+                _is_admin BOOLEAN NOT NULL,
+                _send_phrases BOOLEAN NOT NULL,
+                PRIMARY KEY (id)
+            )""")
+        connection.execute(
+            "INSERT INTO user_account (id, chat_id, _is_admin, _send_phrases) "
+            "VALUES (?, 1, 0, 1)",
+            (user_id.hex,),
+        )
+
+    engine = models.init_db(f"sqlite:///{db_path}")
+    with sqlalchemy.orm.Session(engine) as session:
+        user = session.scalars(sqlalchemy.select(models.User)).one()
+        assert user.id == user_id
+        assert user.shard_key == models.get_shard_key(user_id)
+    indexes = sqlalchemy.inspect(engine).get_indexes("user_account")
+    assert "ix_user_account_shard_key" in {i["name"] for i in indexes}
+    engine.dispose()
+
+
+def test_sent_bitmaps_migration(tmp_path):
+    db_path = tmp_path / "iv.db"
+    engine = models.init_db(f"sqlite:///{db_path}")
+    with sqlalchemy.orm.Session(engine) as session:
+        users = [models.User(chat_id=1), models.User(chat_id=2)]
+        phrases = [models.Phrase(text=str(i)) for i in range(10)]
+        session.add_all(users + phrases)
+        session.commit()
+        used = [(users[0], phrases[i]) for i in (1, 9)] + [(users[1], phrases[3])]
+        session.execute(
+            sqlalchemy.insert(models.UsedPhrases),
+            [{"user_id": u.id, "phrase_id": p.id} for u, p in used],
+        )
+        session.commit()
+        assert session.query(models.SentBitmap).count() == 0
+    engine.dispose()
+
+    # a database before ordinals and bitmaps were introduced
+    engine = models.init_db(f"sqlite:///{db_path}")
+    with sqlalchemy.orm.Session(engine) as session:
+        phrases = session.scalars(sqlalchemy.select(models.Phrase)).all()
+        assert sorted(p.ordinal for p in phrases) == list(range(10))
+        ordinals = {p.text: p.ordinal for p in phrases}
+        bitmaps = {
+            b.user_id: b.bits
+            for b in session.scalars(sqlalchemy.select(models.SentBitmap))
+        }
+        users = {
+            u.chat_id: u.id for u in session.scalars(sqlalchemy.select(models.User))
+        }
+        for chat_id, texts in [(1, ["1", "9"]), (2, ["3"])]:
+            bits = bitmaps[users[chat_id]]
+            set_ordinals = [o for o in range(10) if bitset.is_set(bits, o)]
+            assert set_ordinals == sorted(ordinals[t] for t in texts)
+
+        # idempotent
+        session.add(models.Phrase(text="10"))
+        session.commit()
+    engine.dispose()
+    engine = models.init_db(f"sqlite:///{db_path}")
+    with sqlalchemy.orm.Session(engine) as session:
+        assert (
+            session.scalar(
+                sqlalchemy.select(models.Phrase.ordinal).where(
+                    models.Phrase.text == "10"
+                )
+            )
+            == 10
+        )
+        assert session.scalars(sqlalchemy.select(models.SentBitmap.bits)).all() == list(
+            bitmaps.values()
+        )
+    engine.dispose()
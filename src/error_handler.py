@@ -12,9 +12,15 @@ import threading
 import traceback
 
 import mail
+import metrics
 
 logger = logging.getLogger(__name__)
 
+NOTIFICATIONS_IN_PROGRESS = metrics.REGISTRY.gauge(
+    "ivanov_error_notifications_in_progress",
+    "Error notifications which are being delivered by handlers",
+)
+
 
 @dataclasses.dataclass
 class ExceptionInfo:
@@ -95,11 +101,12 @@ class ErrorHandlersService:
     def notify(self, e: ExceptionInfo):
         e._command_line = shlex.join(sys.argv)
         e._thread_name = threading.current_thread().name
-        for handler in self._handlers:
-            try:
-                handler.notify(e)
-            except Exception:
-                traceback.print_exc()
+        with NOTIFICATIONS_IN_PROGRESS.track_in_progress():
+            for handler in self._handlers:
+                try:
+                    handler.notify(e)
+                except Exception:
+                    traceback.print_exc()
 
     @contextlib.contextmanager
     def notify_about_exceptions(
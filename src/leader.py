@@ -0,0 +1,99 @@
+import datetime as dt
+import logging
+import threading
+import time
+import typing
+
+import lease_service as LS
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_LEASE = "broadcast"
+
+
+class LeaderThread:
+    """Keeps renewing the lease, the holder of the lease is the leader.
+
+    The lease is renewed 3 times per timeout, so a leader which stopped
+    renewing it is replaced within the timeout. A leader whose renewals
+    stall stops considering itself the leader when the lease expires.
+    """
+
+    def __init__(
+        self,
+        create_session,
+        lease_service: LS.LeaseService,
+        owner: str,
+        timeout: dt.timedelta,
+        on_acquired: typing.Callable[[], None] = lambda: None,
+        name: str = BROADCAST_LEASE,
+    ):
+        self._create_session = create_session
+        self._lease_service = lease_service
+        self._owner = owner
+        self._timeout = timeout
+        self._on_acquired = on_acquired
+        self._name = name
+        self._is_leader = False
+        # time.monotonic() when the last renewed lease expires
+        self._expires_at = 0.0
+        self._exited = threading.Event()
+        self._thread = None
+
+    def start(self):
+        assert not self._exited.is_set()
+        self._thread = threading.Thread(target=self._do_start, name="Leader")
+        self._thread.start()
+
+    def stop(self):
+        self._exited.set()
+        self._thread.join()
+
+    def python_thread(self):
+        return self._thread
+
+    def is_leader(self) -> bool:
+        return self._is_leader and time.monotonic() < self._expires_at
+
+    def _do_start(self):
+        try:
+            while not self._exited.is_set():
+                self._heartbeat()
+                self._exited.wait(self._timeout.total_seconds() / 3)
+        finally:
+            self._release()
+            self._create_session.remove()
+
+    def _heartbeat(self):
+        # the lease may have been written at any time after this
+        start = time.monotonic()
+        try:
+            with self._create_session() as session:
+                is_leader = self._lease_service.acquire(
+                    session, self._name, self._owner, self._timeout
+                )
+            if is_leader:
+                self._expires_at = start + self._timeout.total_seconds()
+        except Exception:
+            logger.exception("Failed to renew lease %s", self._name)
+            is_leader = False
+        if is_leader != self._is_leader:
+            logger.info(
+                "%s lease %s",
+                "Acquired" if is_leader else "Lost",
+                self._name,
+            )
+            self._is_leader = is_leader
+            if is_leader:
+                self._on_acquired()
+
+    def _release(self):
+        if not self._is_leader:
+            return
+        self._is_leader = False
+        try:
+            with self._create_session() as session:
+                self._lease_service.release(session, self._name, self._owner)
+            logger.info("Released lease %s", self._name)
+        except Exception:
+            logger.exception("Failed to release lease %s", self._name)
@@ -0,0 +1,24 @@
+import datetime as dt
+import time
+
+import leader
+import lease_service as LS
+
+
+def test_lease_expires_without_renewal(testing_db):
+    timeout = dt.timedelta(seconds=0.2)
+    thread = leader.LeaderThread(testing_db.session, LS.LeaseService(), "a", timeout)
+    assert not thread.is_leader()
+    thread._heartbeat()
+    assert thread.is_leader()
+    other = leader.LeaderThread(testing_db.session, LS.LeaseService(), "b", timeout)
+    other._heartbeat()
+    assert not other.is_leader()
+
+    # renewals of the leader stalled, another process takes the lease
+    time.sleep(0.25)
+    assert not thread.is_leader()
+    other._heartbeat()
+    assert other.is_leader()
+    thread._heartbeat()
+    assert not thread.is_leader()
@@ -0,0 +1,52 @@
+import datetime as dt
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from db import models
+
+
+class LeaseService:
+    """Named leases stored in the database, a lease is held by one owner
+    until it's released or not renewed before it expires"""
+
+    def acquire(
+        self, session: Session, name: str, owner: str, timeout: dt.timedelta
+    ) -> bool:
+        """Acquires or renews the lease, returns whether owner holds it"""
+        now = dt.datetime.now(dt.UTC)
+        insert = models.dialect_insert(session)
+        stmt = insert(models.Lease).values(
+            name=name, owner=owner, time_heartbeat=now, time_expires=now + timeout
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.Lease.name],
+            set_={
+                "owner": stmt.excluded.owner,
+                "time_heartbeat": stmt.excluded.time_heartbeat,
+                "time_expires": stmt.excluded.time_expires,
+            },
+            where=sqlalchemy.or_(
+                models.Lease.owner == stmt.excluded.owner,
+                models.Lease.time_expires < now,
+            ),
+        ).returning(models.Lease.owner)
+        acquired = session.execute(stmt).one_or_none() is not None
+        session.commit()
+        return acquired
+
+    def release(self, session: Session, name: str, owner: str):
+        session.execute(
+            sqlalchemy.delete(models.Lease)
+            .where(models.Lease.name == name)
+            .where(models.Lease.owner == owner)
+        )
+        session.commit()
+
+    def get_owner(self, session: Session, name: str) -> str | None:
+        now = dt.datetime.now(dt.UTC)
+        return session.scalars(
+            sqlalchemy.select(models.Lease.owner)
+            .where(models.Lease.name == name)
+            .where(models.Lease.time_expires >= now)
+        ).one_or_none()
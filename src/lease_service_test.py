@@ -0,0 +1,31 @@
+import datetime as dt
+import time
+
+import lease_service as LS
+
+
+def test_lease(portable_db):
+    session = portable_db.session()
+    lease_service = LS.LeaseService()
+    timeout = dt.timedelta(seconds=0.5)
+
+    assert lease_service.get_owner(session, "lease") is None
+    assert lease_service.acquire(session, "lease", "a", timeout)
+    assert not lease_service.acquire(session, "lease", "b", timeout)
+    # renewal by the holder
+    assert lease_service.acquire(session, "lease", "a", timeout)
+    assert lease_service.get_owner(session, "lease") == "a"
+    # other leases are independent
+    assert lease_service.acquire(session, "other", "b", timeout)
+
+    time.sleep(timeout.total_seconds() * 1.5)
+    assert lease_service.get_owner(session, "lease") is None
+    assert lease_service.acquire(session, "lease", "b", timeout)
+    assert not lease_service.acquire(session, "lease", "a", timeout)
+
+    # release by a non holder is ignored
+    lease_service.release(session, "lease", "a")
+    assert lease_service.get_owner(session, "lease") == "b"
+    lease_service.release(session, "lease", "b")
+    assert lease_service.get_owner(session, "lease") is None
+    assert lease_service.acquire(session, "lease", "a", timeout)
@@ -0,0 +1,187 @@
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import pathlib
+import queue
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, an open file can't be removed there anyway
+    fcntl = None
+
+FORMAT = (
+    "%(asctime)s [%(levelname)s][%(threadName)s] %(filename)s:%(lineno)d: %(message)s"
+)
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Log file rotated when it grows over max_bytes or it's older than
+    interval_s.
+
+    Rotated files are {stem}.{n}.log, gzipped if compress is set, the file
+    itself keeps its name. After a rotation the oldest files of the
+    directory, of any process, are removed while there are more than
+    max_files of them or they take more than max_total_bytes. The file is
+    locked while it's open, files locked by other processes aren't removed.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        *,
+        max_bytes: int,
+        interval_s: float,
+        compress: bool,
+        max_total_bytes: int,
+        max_files: int,
+    ):
+        # names of rotated files don't depend on backupCount, it only has to
+        # be positive for the base class to roll over
+        super().__init__(path, "a", max_bytes, backupCount=1, encoding="utf-8")
+        self._interval_s = interval_s
+        self._compress = compress
+        self._max_total_bytes = max_total_bytes
+        self._max_files = max_files
+        self._n_rotated = 0
+        self._rollover_at = time.time() + interval_s
+        self.remove_old_files()
+
+    def _open(self):
+        stream = super()._open()
+        if fcntl is not None:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+        return stream
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self._rollover_at:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.stream.tell():
+                return True
+            # an empty file isn't rotated, its time starts again
+            self._rollover_at = time.time() + self._interval_s
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        path = pathlib.Path(self.baseFilename)
+        self._n_rotated += 1
+        rotated = path.with_name(f"{path.stem}.{self._n_rotated}{path.suffix}")
+        os.replace(path, rotated)
+        if self._compress:
+            with (
+                open(rotated, "rb") as source,
+                gzip.open(rotated.with_name(rotated.name + ".gz"), "wb") as target,
+            ):
+                shutil.copyfileobj(source, target)
+            rotated.unlink()
+        self.stream = self._open()
+        self._rollover_at = time.time() + self._interval_s
+        self.remove_old_files()
+
+    def remove_old_files(self):
+        path = pathlib.Path(self.baseFilename)
+        files = []
+        for other in path.parent.iterdir():
+            if other == path or not other.name.endswith((".log", ".log.gz")):
+                continue
+            try:
+                stat = other.stat()
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            files.append((stat.st_mtime, other, stat.st_size))
+        files.sort()
+        n_files = len(files) + 1
+        total_bytes = sum(size for _, _, size in files)
+        if self.stream is not None:
+            total_bytes += self.stream.tell()
+        for _, other, size in files:
+            if n_files <= self._max_files and total_bytes <= self._max_total_bytes:
+                break
+            if _is_locked(other):
+                continue
+            try:
+                other.unlink(missing_ok=True)
+            except PermissionError:
+                # open on Windows
+                continue
+            n_files -= 1
+            total_bytes -= size
+
+
+def _is_locked(path: pathlib.Path) -> bool:
+    """Whether the log file is open by a RotatingFileHandler"""
+    if fcntl is None:
+        return False
+    try:
+        with open(path, "rb") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except FileNotFoundError:
+        pass
+    return False
+
+
+class LogPipeline:
+    """Logging of the process through a queue.
+
+    The root logger gets a QueueHandler, a record is put into the queue by
+    the logging thread and written to the handlers by the listener thread,
+    so a slow disk or terminal doesn't hold the broadcast or bot threads.
+    The remaining records are written at exit.
+    """
+
+    def __init__(self, handlers: list[logging.Handler]):
+        self._queue = queue.SimpleQueue()
+        self.handler = logging.handlers.QueueHandler(self._queue)
+        self.listener = logging.handlers.QueueListener(
+            self._queue, *handlers, respect_handler_level=True
+        )
+        # logging.config sets it since python 3.12, handlers() relies on it
+        self.handler.listener = self.listener
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self, level: int = logging.INFO):
+        with self._lock:
+            assert not self._started
+            self.listener.start()
+            self._started = True
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(level)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Writes queued records and closes the handlers"""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        atexit.unregister(self.stop)
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def handlers(logger: logging.Logger) -> list[logging.Handler]:
+    """Handlers of the logger, the ones of a pipeline replace its queue"""
+    result = []
+    for handler in logger.handlers:
+        listener = getattr(handler, "listener", None)
+        if isinstance(handler, logging.handlers.QueueHandler) and listener:
+            result += listener.handlers
+        else:
+            result.append(handler)
+    return result
@@ -0,0 +1,117 @@
+import gzip
+import logging
+import os
+import threading
+
+import log_pipeline
+
+
+def _record(message: str) -> logging.LogRecord:
+    return logging.LogRecord("test", logging.INFO, __file__, 1, message, None, None)
+
+
+def _handler(path, **kwargs) -> log_pipeline.RotatingFileHandler:
+    options = dict(
+        max_bytes=0,
+        interval_s=float("inf"),
+        compress=True,
+        max_total_bytes=2**20,
+        max_files=100,
+    )
+    options.update(kwargs)
+    return log_pipeline.RotatingFileHandler(path, **options)
+
+
+def test_rotate_by_size(tmp_path):
+    handler = _handler(tmp_path / "1.log", max_bytes=100)
+    for i in range(5):
+        handler.handle(_record(f"{i} " + "x" * 60))
+    handler.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "1.1.log.gz",
+        "1.2.log.gz",
+        "1.3.log.gz",
+        "1.4.log.gz",
+        "1.log",
+    ]
+    with gzip.open(tmp_path / "1.2.log.gz", "rt") as f:
+        assert f.read() == "1 " + "x" * 60 + "\n"
+    assert (tmp_path / "1.log").read_text().startswith("4 ")
+
+
+def test_rotate_by_time(tmp_path):
+    handler = _handler(tmp_path / "1.log", interval_s=0, compress=False)
+    handler.handle(_record("first"))
+    handler.handle(_record("second"))
+    handler.close()
+    assert (tmp_path / "1.1.log").read_text() == "first\n"
+    assert (tmp_path / "1.log").read_text() == "second\n"
+
+
+def test_remove_old_files(tmp_path):
+    for i, name in enumerate(["old.log", "0.1.log.gz", "0.2.log.gz", "other.txt"]):
+        (tmp_path / name).write_text("x" * 100)
+        os.utime(tmp_path / name, (i, i))
+    handler = _handler(tmp_path / "1.log", max_files=3)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "0.1.log.gz",
+        "0.2.log.gz",
+        "1.log",
+        "other.txt",
+    ]
+    handler.handle(_record("x" * 100))
+    handler.doRollover()
+    handler.close()
+    # the rotated file counts too
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "0.2.log.gz",
+        "1.1.log.gz",
+        "1.log",
+        "other.txt",
+    ]
+    handler = _handler(tmp_path / "2.log", max_total_bytes=50)
+    handler.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "1.1.log.gz",
+        "1.log",
+        "2.log",
+        "other.txt",
+    ]
+
+
+def test_keep_open_files(tmp_path):
+    # of another process
+    active = _handler(tmp_path / "1.log")
+    active.handle(_record("x" * 100))
+    (tmp_path / "0.log").write_text("x" * 100)
+    os.utime(tmp_path / "0.log", (0, 0))
+    os.utime(tmp_path / "1.log", (1, 1))
+    handler = _handler(tmp_path / "2.log", max_files=1)
+    handler.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["1.log", "2.log"]
+    active.close()
+
+
+def test_pipeline(tmp_path):
+    handler = _handler(tmp_path / "1.log")
+    handler.setFormatter(logging.Formatter("%(threadName)s %(message)s"))
+    root = logging.getLogger()
+    level = root.level
+    pipeline = log_pipeline.LogPipeline([handler])
+    pipeline.start(logging.INFO)
+    try:
+        assert handler in log_pipeline.handlers(root)
+        assert pipeline.handler not in log_pipeline.handlers(root)
+        thread = threading.Thread(
+            target=lambda: logging.getLogger("test").info("from %s", "thread"),
+            name="Worker",
+        )
+        thread.start()
+        thread.join()
+        logging.getLogger("test").debug("not logged")
+    finally:
+        pipeline.stop()
+        root.setLevel(level)
+    pipeline.stop()
+    assert pipeline.handler not in root.handlers
+    assert (tmp_path / "1.log").read_text() == "Worker from thread\n"
@@ -7,9 +7,12 @@ import json
 import logging
 import os
 import pathlib
+import socket
 import sys
+import time
 import traceback
 import typing
+import uuid
 import telebot
 import threading
 import queue
@@ -20,20 +23,60 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
 
 import bot
+import broadcast_plan as BP
 import error_handler
+import leader
+import log_pipeline
+import metrics
 import timer
+import tracing
 from db import models
 import user_service as US
 import phrases_service as PS
+import shard_service as SS
+import lease_service as LS
+import retention_service as RS
+import send_window
+import outbox
+import outbox_service as OS
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_WORKING_DIR = pathlib.Path.home() / ".ivanov"
 
+# queue: PhrasesService.get_next_phrases, queues are filled between broadcasts
+# bitmap: PhrasesService.pick_phrases_by_bitmap
+# vectorized: PhrasesService.plan_phrases_vectorized
+# permutation: PhrasesService.pick_phrases_by_permutation
+PHRASE_SELECTIONS = ("queue", "bitmap", "vectorized", "permutation")
+# recipients whose outbox messages are built and inserted at once
+ENQUEUE_BATCH_SIZE = 5000
+NO_PHRASES_TEXT = "We do not have phrases for you :("
+# seconds between checks for expired shard claims of other processes
+SHARD_POLL_INTERVAL = 5
+
+BROADCAST_DURATION = metrics.REGISTRY.histogram(
+    "ivanov_broadcast_duration_seconds",
+    "Duration of broadcasts",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+BROADCAST_MESSAGES = metrics.REGISTRY.gauge(
+    "ivanov_broadcast_messages", "Messages of the last broadcast by result"
+)
+BROADCAST_MESSAGES_TOTAL = metrics.REGISTRY.counter(
+    "ivanov_broadcast_messages_total", "Messages of all broadcasts by result"
+)
+ARCHIVED_PHRASES = metrics.REGISTRY.counter(
+    "ivanov_archived_used_phrases_total", "Used phrases moved to the archive"
+)
+ARCHIVED_CYCLES = metrics.REGISTRY.counter(
+    "ivanov_history_cycles_total", "Users who got every phrase and started over"
+)
+
 
 def expected_exception(exception: Exception):
     logs = []
-    for handler in logger.root.handlers:
+    for handler in log_pipeline.handlers(logger.root):
         if isinstance(handler, logging.FileHandler):
             try:
                 with open(handler.baseFilename, "rb") as f:
@@ -70,11 +113,107 @@ class Config:
         password: str
         to_addr: str
 
+    @dataclasses.dataclass
+    class Database:
+        url: str
+        pool_size: int = 5
+        max_overflow: int = 10
+        pool_timeout: float = 30
+        pool_recycle: int = 1800
+
+    @dataclasses.dataclass
+    class Broadcast:
+        # users are partitioned into shards, every process taking part in
+        # the broadcast claims shards until none are left
+        shards: int = 1
+        # phrases precomputed per subscriber between broadcasts
+        queue_size: int = 10
+        # how phrases are picked, one of PHRASE_SELECTIONS
+        selection: str = "queue"
+        # positions of users refer to the permutations, keep it once set
+        permutation_seed: int = 0
+        # users are unsubscribed after this many broadcasts in a row failed
+        # because their chat is unreachable
+        max_delivery_failures: int = 3
+        # messages in flight grow up to this while Telegram keeps up
+        max_concurrency: int = 16
+        # latency over this times the lowest observed one shrinks the window
+        latency_tolerance: float = 2.0
+        # seconds, a shard not finished by then is sent by another process
+        shard_claim_timeout: float = SS.CLAIM_TIMEOUT.total_seconds()
+
+        def __post_init__(self):
+            if self.selection not in PHRASE_SELECTIONS:
+                raise RuntimeError(
+                    f"Unknown broadcast selection {self.selection}, "
+                    f"expected one of {PHRASE_SELECTIONS}"
+                )
+
+    @dataclasses.dataclass
+    class Phrases:
+        # texts are stored compressed with a zlib dictionary trained on them,
+        # existing phrases are migrated between broadcasts
+        compression: bool = False
+        # phrases compressed or decompressed between two broadcasts
+        migration_batch_size: int = 10000
+
+    @dataclasses.dataclass
+    class Metrics:
+        port: int
+        host: str = "127.0.0.1"
+
+    @dataclasses.dataclass
+    class Tracing:
+        # share of traced handler calls and broadcasts
+        sample_rate: float = 1.0
+        buffer_size: int = 100000
+
+    @dataclasses.dataclass
+    class Retention:
+        # used phrases older than this are archived and may be sent again
+        max_age_days: float | None = None
+        # archive history of users who got every phrase and start over
+        compact_cycles: bool = True
+        # rows (or users for cycles) archived between two broadcasts
+        batch_size: int = 10000
+        # pages returned to the OS by sqlite incremental vacuum, 0 disables
+        # vacuum and ANALYZE
+        vacuum_pages: int = 1000
+        # default is working_dir/archive
+        archive_dir: str | None = None
+
+    @dataclasses.dataclass
+    class Logging:
+        # the log file is rotated when it grows over this, 0 disables
+        max_file_bytes: int = 10 * 2**20
+        # or when it's older than this, 0 disables
+        rotate_hours: float = 24
+        # rotated files are gzipped
+        compress: bool = True
+        # the oldest files of working_dir/logs are removed beyond these
+        max_total_bytes: int = 500 * 2**20
+        max_files: int = 100
+
+    @dataclasses.dataclass
+    class LeaderElection:
+        # seconds, a replica replaces the stopped leader within this time
+        lease_timeout: float = 30
+
     bot_token: str
     working_dir: pathlib.Path
+    database: "Config.Database"
+    broadcast: "Config.Broadcast"
+    leader_election: "Config.LeaderElection"
+    phrases: "Config.Phrases"
+    logging: "Config.Logging"
     start_time: dt.datetime
     period_between_messages: dt.timedelta
     error_mail: typing.Optional["Config.ErrorMail"] = None
+    metrics: typing.Optional["Config.Metrics"] = None
+    tracing: typing.Optional["Config.Tracing"] = None
+    retention: typing.Optional["Config.Retention"] = None
+    # Bot API url template, e.g. "http://localhost:8081/bot{0}/{1}"
+    api_url: str | None = None
 
     def __init__(self, config_path: pathlib.Path) -> None:
         if not config_path.is_file():
@@ -87,6 +226,18 @@ class Config:
         self.working_dir = pathlib.Path(
             self._config.get("working_dir", DEFAULT_WORKING_DIR)
         )
+        self.database = Config.Database(
+            **{
+                "url": f"sqlite:///{self.working_dir / 'iv.db'}",
+                **self._config.get("database", {}),
+            }
+        )
+        self.broadcast = Config.Broadcast(**self._config.get("broadcast", {}))
+        self.leader_election = Config.LeaderElection(
+            **self._config.get("leader_election", {})
+        )
+        self.phrases = Config.Phrases(**self._config.get("phrases", {}))
+        self.logging = Config.Logging(**self._config.get("logging", {}))
         self.start_time = dt.datetime.fromisoformat(self._config["time"]["start_time"])
         period_between_messages = dt.datetime.strptime(
             self._config["time"]["period_between_messages"], "%H:%M:%S"
@@ -98,6 +249,13 @@ class Config:
         )
         if "error_mail" in self._config:
             self.error_mail = Config.ErrorMail(**self._config["error_mail"])
+        self.api_url = self._config.get("api_url")
+        if "metrics" in self._config:
+            self.metrics = Config.Metrics(**self._config["metrics"])
+        if "tracing" in self._config:
+            self.tracing = Config.Tracing(**self._config["tracing"])
+        if "retention" in self._config:
+            self.retention = Config.Retention(**self._config["retention"])
 
 
 class BotThread:
@@ -119,14 +277,28 @@ class BotThread:
         self._bot.start_bot()
 
 
+@dataclasses.dataclass
 class TimerEvent:
-    pass
+    wakeup_time: dt.datetime
 
 
 class ExitEvent:
     pass
 
 
+class IdleEvent:
+    pass
+
+
+class LeadershipAcquiredEvent:
+    pass
+
+
+class SendResult(enum.Enum):
+    SUCCESS = 1
+    NO_PHRASES = 2
+
+
 class BotExceptionHandler(telebot.ExceptionHandler):
     def __init__(self, error_handler: error_handler.ErrorHandlersService):
         self._error_handler = error_handler
@@ -139,15 +311,34 @@ class ServiceFactories:
     error_handlers = staticmethod(error_handler.ErrorHandlersService)
     user_service = staticmethod(US.UserService)
     phrases_service = staticmethod(PS.PhrasesService)
+    shard_service = staticmethod(SS.ShardService)
+    lease_service = staticmethod(LS.LeaseService)
+    retention_service = staticmethod(RS.RetentionService)
+    outbox_service = staticmethod(OS.OutboxService)
     init_db = staticmethod(models.init_db)
     create_bot = staticmethod(telebot.TeleBot)
 
 
 class App:
-    def __init__(self, factories: ServiceFactories, config_path: pathlib.Path) -> None:
+    def __init__(
+        self,
+        factories: ServiceFactories,
+        config_path: pathlib.Path,
+        *,
+        broadcast_only: bool = False,
+    ) -> None:
+        """broadcast_only app doesn't handle bot commands, it only takes part
+        in broadcasts together with other processes sharing the database"""
         self._factories = factories
         self._config = Config(config_path)
+        self._broadcast_only = broadcast_only
+        self._instance_id = (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
         self._setup_logger()
+        if self._config.api_url:
+            logger.info("Using Bot API at %s", self._config.api_url)
+            telebot.apihelper.API_URL = self._config.api_url
         self._error_handlers = factories.error_handlers()
         self._error_handlers.add_handler(error_handler.LoggerNotifier())
         if self._config.error_mail:
@@ -164,21 +355,64 @@ class App:
                 ),
             )
         self._config.working_dir.mkdir(exist_ok=True)
+        database = self._config.database
         self._engine = factories.init_db(
-            f"sqlite:///{self._config.working_dir / 'iv.db'}"
+            database.url,
+            pool_size=database.pool_size,
+            max_overflow=database.max_overflow,
+            pool_timeout=database.pool_timeout,
+            pool_recycle=database.pool_recycle,
         )
+        metrics.instrument_engine(self._engine)
+        tracing.instrument_engine(self._engine)
+        if self._config.tracing:
+            tracing.TRACER.configure(
+                sample_rate=self._config.tracing.sample_rate,
+                buffer_size=self._config.tracing.buffer_size,
+            )
         self._create_session = scoped_session(sessionmaker(self._engine))
         self._user_service = factories.user_service()
+        self._outbox_sender = outbox.OutboxSender(
+            self._create_session,
+            factories.outbox_service(),
+            self._user_service,
+            factories.create_bot(self._config.bot_token),
+            # shared by all messages, it keeps the rate learned by broadcasts
+            send_window.AimdWindow(
+                max_window=self._config.broadcast.max_concurrency,
+                latency_tolerance=self._config.broadcast.latency_tolerance,
+                weights=outbox.LANE_WEIGHTS,
+            ),
+            notify=lambda e: self._error_handlers.notify(expected_exception(e)),
+            max_concurrency=self._config.broadcast.max_concurrency,
+            max_delivery_failures=self._config.broadcast.max_delivery_failures,
+        )
         self._error_handlers.add_handler(
             error_handler.TelegramErrorHandler(
-                lambda: self._factories.create_bot(token=self._config.bot_token),
+                lambda: outbox.OutboxBot(
+                    # not the scoped session, errors are reported while it's used
+                    self._create_session.session_factory,
+                    self._outbox_sender,
+                    self._factories.create_bot(token=self._config.bot_token),
+                    OS.Priority.ALERT,
+                ),
                 self._user_service.get_admin_chats(self._create_session()),
             )
         )
         self._error_handlers.notify(
-            expected_exception(RuntimeError("ivanov bot started"))
+            expected_exception(
+                RuntimeError(
+                    "ivanov broadcast worker started"
+                    if broadcast_only
+                    else "ivanov bot started"
+                )
+            )
+        )
+        self._phrases_service = factories.phrases_service(
+            compression=self._config.phrases.compression
         )
-        self._phrases_service = factories.phrases_service()
+        self._shard_service = factories.shard_service()
+        self._retention_service = factories.retention_service()
         self._events = queue.Queue()
         self._bot = bot.Bot(
             factories.create_bot(
@@ -188,21 +422,62 @@ class App:
             self._create_session,
             self._user_service,
             self._phrases_service,
+            outbox=self._outbox_sender,
+            queue_size=(
+                self._config.broadcast.queue_size
+                if self._config.broadcast.selection == "queue"
+                else None
+            ),
         )
         self._bot_thread = BotThread(self._bot)
         self._wakeup_controller = timer.PeriodicWakeupController(
             self._config.start_time, self._config.period_between_messages
         )
         self._timer = timer.TimerThread(
-            self._wakeup_controller.next_wakeup, lambda: self._events.put(TimerEvent())
+            self._wakeup_controller.next_wakeup,
+            lambda wakeup_time: self._events.put(TimerEvent(wakeup_time)),
         )
+        # maintenance runs halfway between broadcasts
+        self._idle_timer = timer.TimerThread(
+            timer.PeriodicWakeupController(
+                self._config.start_time + self._config.period_between_messages / 2,
+                self._config.period_between_messages,
+            ).next_wakeup,
+            lambda wakeup_time: self._events.put(IdleEvent()),
+        )
+        self._threads = [self._timer, self._outbox_sender]
+        # replicas handle commands, but only the leader starts broadcasts;
+        # broadcast workers join every broadcast
+        self._leader = None
+        self._missed_wakeup = None
+        if not broadcast_only:
+            self._leader = leader.LeaderThread(
+                self._create_session,
+                factories.lease_service(),
+                self._instance_id,
+                dt.timedelta(seconds=self._config.leader_election.lease_timeout),
+                on_acquired=lambda: self._events.put(LeadershipAcquiredEvent()),
+            )
+            self._threads = [
+                self._leader,
+                self._bot_thread,
+                self._timer,
+                self._idle_timer,
+                self._outbox_sender,
+            ]
+        if self._config.metrics:
+            self._threads.append(
+                metrics.MetricsServer(
+                    self._config.metrics.host, self._config.metrics.port
+                )
+            )
 
     # TODO maybe save for every user x phrase day when it was sended?
     # it allows to distinguish users which already got phrase today
     # before bot failure
     def start(self):
-        self._bot_thread.start()
-        self._timer.start()
+        for thread in self._threads:
+            thread.start()
         try:
             while True:
                 with (
@@ -214,7 +489,11 @@ class App:
                     except queue.Empty:
                         continue
                     if isinstance(event, TimerEvent):
-                        self._send_phrases()
+                        self._on_timer(event.wakeup_time)
+                    elif isinstance(event, IdleEvent):
+                        self._on_idle()
+                    elif isinstance(event, LeadershipAcquiredEvent):
+                        self._on_leadership_acquired()
                     elif isinstance(event, ExitEvent):
                         break
         finally:
@@ -223,7 +502,7 @@ class App:
                 logger.exception(e)
             while True:
                 try:
-                    threads = (self._bot_thread, self._timer)
+                    threads = self._threads
                     for thread in threads:
                         thread.stop()
                     for thread in threads:
@@ -238,80 +517,268 @@ class App:
     def stop(self):
         self._events.put(ExitEvent())
 
-    def _send_phrases(self):
-        logger.info(f"Woke up at {dt.datetime.now(dt.UTC)}, sending phrases")
+    def _on_timer(self, wakeup_time: dt.datetime):
+        if self._leader is None or self._leader.is_leader():
+            self._send_phrases(wakeup_time)
+            return
+        logger.info("Not a leader, skipping broadcast at %s", wakeup_time)
+        self._missed_wakeup = wakeup_time
+
+    def _on_idle(self):
+        if not self._leader.is_leader():
+            return
+        if self._config.broadcast.selection == "queue":
+            self._fill_queues()
+        self._migrate_phrase_storage()
+        if self._config.retention:
+            self._apply_retention()
+
+    def _fill_queues(self):
+        start = time.perf_counter()
+        with (
+            tracing.span("App._fill_queues"),
+            self._create_session() as session,
+        ):
+            n_queued = self._phrases_service.fill_queues(
+                session, self._config.broadcast.queue_size
+            )
+        logger.info("Queued %s phrases in %.1fs", n_queued, time.perf_counter() - start)
+
+    def _migrate_phrase_storage(self):
         with self._create_session() as session:
-            bot = self._factories.create_bot(self._config.bot_token)
+            n_migrated = self._phrases_service.migrate_storage(
+                session, self._config.phrases.migration_batch_size
+            )
+        if n_migrated:
+            logger.info(
+                "%s %s phrases",
+                "Compressed" if self._config.phrases.compression else "Decompressed",
+                n_migrated,
+            )
 
-            class SendResult(enum.Enum):
-                SUCCESS = 1
-                NO_PHRASES = 2
-                MESSAGE_ERROR = 3
+    def _apply_retention(self):
+        retention = self._config.retention
+        archive = RS.HistoryArchive(
+            pathlib.Path(retention.archive_dir)
+            if retention.archive_dir
+            else self._config.working_dir / "archive"
+        )
+        start = time.perf_counter()
+        with tracing.span("App._apply_retention"):
+            if retention.max_age_days is not None:
+                with self._create_session() as session:
+                    n_expired = self._retention_service.expire_history(
+                        session,
+                        dt.datetime.now(dt.UTC)
+                        - dt.timedelta(days=retention.max_age_days),
+                        archive,
+                        retention.batch_size,
+                    )
+                ARCHIVED_PHRASES.inc(n_expired, reason="expired")
+                logger.info("Archived %s expired used phrases", n_expired)
+            if retention.compact_cycles:
+                with self._create_session() as session:
+                    n_users = self._retention_service.compact_cycles(
+                        session, archive, retention.batch_size
+                    )
+                ARCHIVED_CYCLES.inc(n_users)
+                logger.info("Started a new cycle for %s users", n_users)
+            if retention.vacuum_pages:
+                self._retention_service.vacuum(self._engine, retention.vacuum_pages)
+        logger.info("Retention took %.1fs", time.perf_counter() - start)
+
+    def enable_incremental_vacuum(self):
+        """Switches a database created before incremental vacuum, run it
+        while no process of the bot is running"""
+        if self._retention_service.enable_incremental_vacuum(self._engine):
+            logger.info("Incremental vacuum is enabled")
+        else:
+            logger.info("Incremental vacuum is already enabled or not supported")
+
+    def _on_leadership_acquired(self):
+        # the previous leader may have stopped right before the wakeup,
+        # shards make the broadcast a no-op if it was already done
+        missed_wakeup, self._missed_wakeup = self._missed_wakeup, None
+        if missed_wakeup is None:
+            return
+        lease_timeout = dt.timedelta(seconds=self._config.leader_election.lease_timeout)
+        if dt.datetime.now(dt.UTC) - missed_wakeup <= 2 * lease_timeout:
+            self._send_phrases(missed_wakeup)
+
+    def _send_phrases(self, wakeup_time: dt.datetime):
+        with tracing.span("App._send_phrases", wakeup_time=wakeup_time.isoformat()):
+            self._do_send_phrases(wakeup_time)
+        if tracing.TRACER.enabled:
+            # the buffer also keeps handler spans recorded since the last export
+            trace_path = (
+                self._config.working_dir
+                / "traces"
+                / f"broadcast-{wakeup_time:%Y%m%dT%H%M%S}.json"
+            )
+            tracing.TRACER.export_chrome_trace(trace_path)
+            logger.info("Trace is written to %s", trace_path)
 
-            results = collections.defaultdict(list)
-            phrases = list(self._phrases_service.get_random_phrases(session))
-            for user_id, chat_id, phrase_id, phrase in phrases:
-                message = phrase or "We do not have phrases for you :("
-                try:
-                    bot.send_message(chat_id, text=message)
-                except Exception as e:
-                    self._error_handlers.notify(expected_exception(e))
-                    results[SendResult.MESSAGE_ERROR].append(e)
-                    continue
-                if phrase is None:
-                    results[SendResult.NO_PHRASES].append(user_id)
-                    continue
-                results[SendResult.SUCCESS].append((user_id, phrase_id))
+    def _do_send_phrases(self, wakeup_time: dt.datetime):
+        logger.info(f"Woke up at {dt.datetime.now(dt.UTC)}, sending phrases")
+        start = time.perf_counter()
+        n_shards = self._config.broadcast.shards
+        counts = collections.Counter()
+        with self._create_session() as session:
+            self._shard_service.remove_runs_before(
+                session, wakeup_time - dt.timedelta(days=7)
+            )
+            self._shard_service.create_run(session, wakeup_time, n_shards)
+        claim_timeout = dt.timedelta(seconds=self._config.broadcast.shard_claim_timeout)
+        while True:
+            with self._create_session() as session:
+                shard = self._shard_service.claim_shard(
+                    session, wakeup_time, self._instance_id, claim_timeout
+                )
+            if shard is None:
+                with self._create_session() as session:
+                    if not self._shard_service.count_unfinished(session, wakeup_time):
+                        break
+                # claims of a crashed process expire and are taken over
+                time.sleep(SHARD_POLL_INTERVAL)
+                continue
+            logger.info("Sending phrases for shard %s/%s", shard.shard, shard.n_shards)
+            with tracing.span("shard", shard=shard.shard, n_shards=shard.n_shards):
+                shard_counts = self._send_shard_phrases(shard)
+            # a shard which failed stays unfinished, it's claimed again
+            # after the claim timeout
+            if shard_counts is not None:
+                counts.update(shard_counts)
+
+        BROADCAST_DURATION.observe(time.perf_counter() - start)
+        for result in SendResult:
+            label = result.name.lower()
+            BROADCAST_MESSAGES.set(counts[result], result=label)
+            BROADCAST_MESSAGES_TOTAL.inc(counts[result], result=label)
+        logger.info(
+            "Broadcast took %.1fs, results %s",
+            time.perf_counter() - start,
+            {result.name: counts[result] for result in SendResult},
+        )
+        logger.info(
+            "Next wakeup at %s",
+            self._wakeup_controller.next_wakeup(dt.datetime.now(dt.UTC)),
+        )
+
+    def _send_shard_phrases(
+        self, shard: SS.ClaimedShard
+    ) -> dict[SendResult, int] | None:
+        """Enqueues the shard's messages and finishes the shard in one
+        transaction, returns None if it failed"""
+        counts = collections.Counter()
+        with self._create_session() as session:
+            plan = self._select_phrases(session, shard.shard, shard.n_shards)
+            # long phrases were split into several messages when added
+            phrase_messages = self._phrases_service.get_messages(
+                session, plan.phrase_ids
+            )
+            parts_by_index = [phrase_messages.get(p) for p in plan.phrase_ids]
+            sent = []
             try:
-                if results[SendResult.SUCCESS]:
-                    session.execute(
-                        sqlalchemy.insert(models.UsedPhrases).values(
-                            results[SendResult.SUCCESS]
-                        )
+                # messages are inserted in batches, but committed together
+                # with used phrases and the finished shard, a crash can't lose
+                # phrases marked as used
+                for begin in range(0, len(plan), ENQUEUE_BATCH_SIZE):
+                    messages = []
+                    for i in range(begin, min(begin + ENQUEUE_BATCH_SIZE, len(plan))):
+                        user_id = plan.user_ids[i]
+                        index = plan.phrase_indexes[i]
+                        parts = None if index == BP.NO_PHRASE else parts_by_index[index]
+                        if parts is None:
+                            counts[SendResult.NO_PHRASES] += 1
+                            parts = (NO_PHRASES_TEXT,)
+                        else:
+                            counts[SendResult.SUCCESS] += 1
+                            sent.append((user_id, plan.phrase_ids[index]))
+                        chat_id = plan.chat_ids[i]
+                        messages += [
+                            OS.Message(chat_id, part, user_id) for part in parts
+                        ]
+                    self._outbox_sender.enqueue(
+                        session, messages, OS.Priority.BROADCAST
+                    )
+                if not self._shard_service.finish_shard(session, shard):
+                    # another process sends the shard
+                    session.rollback()
+                    logger.warning(
+                        "Claim of shard %s/%s was taken over",
+                        shard.shard,
+                        shard.n_shards,
                     )
+                    return None
+                self._phrases_service.mark_sent(
+                    session,
+                    sent,
+                    advance_positions=self._config.broadcast.selection == "permutation",
+                    ordinals=plan.ordinals(),
+                )
+                session.commit()
             except sqlalchemy.exc.SQLAlchemyError as e:
+                session.rollback()
                 self._error_handlers.notify(expected_exception(e))
-            if results[SendResult.MESSAGE_ERROR]:
-                messages = results[SendResult.MESSAGE_ERROR]
+                return None
+            if counts[SendResult.NO_PHRASES]:
                 self._error_handlers.notify(
                     expected_exception(
                         RuntimeError(
-                            f"failed to send some messages {len(messages)}, reasons: {set(str(m) for m in messages)}"
+                            f"no phrases for {counts[SendResult.NO_PHRASES]} users"
                         )
                     )
                 )
-            if results[SendResult.NO_PHRASES]:
-                messages = results[SendResult.NO_PHRASES]
-                self._error_handlers.notify(
-                    expected_exception(
-                        RuntimeError(f"no phrases for {len(messages)} users")
-                    )
-                )
-            session.commit()
+        self._outbox_sender.wake(OS.Priority.BROADCAST)
+        return dict(counts)
 
-        logger.info(
-            "Next wakeup at %s",
-            self._wakeup_controller.next_wakeup(dt.datetime.now(dt.UTC)),
-        )
+    def _select_phrases(self, session, shard: int, n_shards: int) -> BP.BroadcastPlan:
+        if self._config.broadcast.selection == "bitmap":
+            return self._phrases_service.pick_phrases_by_bitmap(
+                session, shard, n_shards
+            )
+        if self._config.broadcast.selection == "vectorized":
+            return self._phrases_service.plan_phrases_vectorized(
+                session, shard, n_shards
+            )
+        if self._config.broadcast.selection == "permutation":
+            return self._phrases_service.pick_phrases_by_permutation(
+                session, self._config.broadcast.permutation_seed, shard, n_shards
+            )
+        return self._phrases_service.get_next_phrases(session, shard, n_shards)
 
     def _setup_logger(self):
+        if logging.getLogger().handlers:
+            # configured by an earlier App of the process, like basicConfig()
+            return
         log_path = (
             self._config.working_dir / "logs" / f"{dt.datetime.now().timestamp()}.log"
         )
-        log_path.parent.mkdir(exist_ok=True)
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s [%(levelname)s][%(threadName)s] %(filename)s:%(lineno)d: %(message)s",
-            handlers=[
-                logging.FileHandler(log_path, "a", "utf-8"),
-                logging.StreamHandler(),
-            ],
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        config = self._config.logging
+        file_handler = log_pipeline.RotatingFileHandler(
+            log_path,
+            max_bytes=config.max_file_bytes,
+            interval_s=config.rotate_hours * 3600 or float("inf"),
+            compress=config.compress,
+            max_total_bytes=config.max_total_bytes,
+            max_files=config.max_files,
         )
+        handlers = [file_handler, logging.StreamHandler()]
+        formatter = logging.Formatter(log_pipeline.FORMAT)
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        log_pipeline.LogPipeline(handlers).start(logging.INFO)
         logger = logging.getLogger(__name__)
         logger.info("logging to %s", log_path)
 
 
 if __name__ == "__main__":
     config = os.environ.get("IVANOV_CONFIG", DEFAULT_WORKING_DIR / "config.json")
-    app = App(ServiceFactories(), config)
-    app.start()
+    broadcast_only = os.environ.get("IVANOV_BROADCAST_WORKER") == "1"
+    app = App(ServiceFactories(), config, broadcast_only=broadcast_only)
+    if os.environ.get("IVANOV_ENABLE_INCREMENTAL_VACUUM") == "1":
+        # offline, the full VACUUM locks the database until it's rewritten
+        app.enable_incremental_vacuum()
+    else:
+        app.start()
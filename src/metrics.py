@@ -0,0 +1,256 @@
+import bisect
+import contextlib
+import http.server
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        with self._lock:
+            return [(self.name, labels, v) for labels, v in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        assert amount >= 0
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    class _Value:
+        def __init__(self, n_buckets):
+            self.buckets = [0] * n_buckets
+            self.sum = 0.0
+            self.count = 0
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = Histogram._Value(len(self._buckets) + 1)
+            v.buckets[bisect.bisect_left(self._buckets, value)] += 1
+            v.sum += value
+            v.count += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels) -> float:
+        """Returns number of observations"""
+        with self._lock:
+            v = self._values.get(tuple(sorted(labels.items())))
+            return v.count if v else 0
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (labels, list(v.buckets), v.sum, v.count)
+                for labels, v in self._values.items()
+            ]
+        samples = []
+        for labels, buckets, sum, count in values:
+            cumulative = 0
+            for le, n in zip(self._buckets + (float("inf"),), buckets):
+                cumulative += n
+                le_label = (("le", _format_value(le)),)
+                samples.append((f"{self.name}_bucket", labels + le_label, cumulative))
+            samples.append((f"{self.name}_sum", labels, sum))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._register(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(m.render() for m in metrics)
+
+    def _register(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            assert isinstance(metric, cls), f"{name} is already a {metric.type}"
+            return metric
+
+
+REGISTRY = Registry()
+
+DB_QUERY_DURATION = REGISTRY.histogram(
+    "ivanov_db_query_duration_seconds", "Duration of SQL statements"
+)
+
+
+def instrument_engine(engine, histogram: Histogram = DB_QUERY_DURATION):
+    """Observes duration of every statement executed by the engine"""
+
+    # the start is kept by the statement's context, threads sharing a
+    # connection execute their statements at the same time
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        try:
+            histogram.observe(time.perf_counter() - start)
+        except Exception:
+            # a metric mustn't fail the statement
+            logger.exception("Failed to observe a statement duration")
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class MetricsServer:
+    """Serves the registry in Prometheus text format on /metrics"""
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="Metrics"
+        )
+        self._thread.start()
+        logger.info("Serving metrics on port %s", self.port)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def python_thread(self):
+        return self._thread
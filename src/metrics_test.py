@@ -0,0 +1,78 @@
+import urllib.error
+import urllib.request
+
+import pytest
+import sqlalchemy
+
+import metrics
+from db import models
+
+
+def test_registry_render():
+    registry = metrics.Registry()
+    counter = registry.counter("requests_total", "Requests")
+    gauge = registry.gauge("queue", "Queue depth")
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+
+    assert registry.counter("requests_total", "Requests") is counter
+    with pytest.raises(AssertionError):
+        registry.gauge("requests_total", "Requests")
+
+    counter.inc(result="ok")
+    counter.inc(2, result="ok")
+    counter.inc(result='"bad"')
+    gauge.set(5)
+    gauge.dec()
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, handler="_start")
+
+    assert counter.get(result="ok") == 3
+    assert gauge.get() == 4
+    assert histogram.get(handler="_start") == 4
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{result="ok"} 3.0\n'
+        'requests_total{result="\\"bad\\""} 1.0\n'
+        "# HELP queue Queue depth\n"
+        "# TYPE queue gauge\n"
+        "queue 4.0\n"
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{handler="_start",le="0.1"} 2.0\n'
+        'latency_seconds_bucket{handler="_start",le="1.0"} 3.0\n'
+        'latency_seconds_bucket{handler="_start",le="+Inf"} 4.0\n'
+        'latency_seconds_sum{handler="_start"} 3.65\n'
+        'latency_seconds_count{handler="_start"} 4.0\n'
+    )
+
+
+def test_instrument_engine():
+    engine = models.init_db_for_testing()
+    histogram = metrics.Histogram("query_seconds", "Queries")
+    metrics.instrument_engine(engine, histogram)
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text("SELECT 1"))
+        connection.execute(sqlalchemy.select(models.User))
+        # failed statements aren't observed
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            connection.execute(sqlalchemy.text("SELECT * FROM missing"))
+        connection.execute(sqlalchemy.text("SELECT 2"))
+    assert histogram.get() == 3
+
+
+def test_metrics_server():
+    registry = metrics.Registry()
+    registry.counter("sent_total", "Sent").inc()
+    server = metrics.MetricsServer("127.0.0.1", 0, registry)
+    server.start()
+    try:
+        url = f"http://127.0.0.1:{server.port}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.status == 200
+            assert "sent_total 1.0" in response.read().decode("utf-8")
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.stop()
+        server.python_thread().join()
@@ -0,0 +1,77 @@
+import hashlib
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+# a signature is NUM_PERM minimums, LSH splits it into BANDS bands, texts
+# sharing any band are compared, which finds pairs with similarity over
+# about (1 / BANDS) ** (1 / ROWS) = 0.5
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# characters in a shingle, a word change touches about SHINGLE_SIZE of them
+SHINGLE_SIZE = 5
+# multiply-shift hash functions, the upper half of a * x + b mod 2**64
+_rng = np.random.default_rng(1)
+_A = _rng.integers(0, 1 << 64, NUM_PERM, dtype=np.uint64, endpoint=False) | 1
+_B = _rng.integers(0, 1 << 64, NUM_PERM, dtype=np.uint64, endpoint=False)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def canonical(text: str) -> str:
+    """Text without differences that don't matter to a reader: case,
+    quotes, punctuation, whitespace and compatibility characters"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def signature(text: str) -> np.ndarray:
+    """MinHash of character shingles of the canonical text"""
+    text = canonical(text)
+    shingles = {
+        text[i : i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))
+    }
+    hashes = np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    # overflows wrap around, which is the mod 2**64
+    permuted = (_A[:, None] * hashes[None, :] + _B[:, None]) >> np.uint64(32)
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingles"""
+    return float(np.count_nonzero(a == b)) / NUM_PERM
+
+
+def bands(signature: np.ndarray) -> list[int]:
+    """LSH bucket of every band, the band is a part of the hash, so the
+    buckets of all bands can be kept in one signed 32-bit column"""
+    data = signature.astype("<u4").tobytes()
+    band_size = ROWS * 4
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                bytes([band]) + data[band * band_size : (band + 1) * band_size],
+                digest_size=4,
+            ).digest(),
+            "little",
+            signed=True,
+        )
+        for band in range(BANDS)
+    ]
+
+
+def to_bytes(signature: np.ndarray) -> bytes:
+    return signature.astype("<u4").tobytes()
+
+
+def from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype="<u4").astype(np.uint32)
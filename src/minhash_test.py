@@ -0,0 +1,36 @@
+import random
+
+import minhash
+
+
+def test_canonical():
+    assert minhash.canonical("  «Hello,   WORLD!»\n") == "hello world"
+    assert minhash.canonical("Straße — ﬁne") == "strasse fine"
+
+
+def test_similarity():
+    text = "Life is what happens to you while you are busy making other plans"
+    same = minhash.signature(text)
+    assert minhash.similarity(same, minhash.signature(f"“{text.upper()}.”")) == 1
+    edited = minhash.signature(text.replace("busy", "occupied"))
+    assert 0.6 < minhash.similarity(same, edited) < 1
+    other = minhash.signature("The only thing we have to fear is fear itself")
+    assert minhash.similarity(same, other) < 0.2
+
+
+def test_bands():
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(1000)]
+    text = " ".join(rng.choice(words) for _ in range(50))
+    signature = minhash.signature(text)
+    assert len(minhash.bands(signature)) == minhash.BANDS
+    assert minhash.bands(signature) == minhash.bands(
+        minhash.from_bytes(minhash.to_bytes(signature))
+    )
+    # a near-duplicate shares a band, an unrelated text doesn't
+    edited = minhash.bands(minhash.signature(text + " w1"))
+    assert set(edited) & set(minhash.bands(signature))
+    unrelated = " ".join(rng.choice(words) for _ in range(50))
+    assert not set(minhash.bands(minhash.signature(unrelated))) & set(
+        minhash.bands(signature)
+    )
@@ -0,0 +1,390 @@
+import collections
+import concurrent.futures
+import datetime as dt
+import logging
+import threading
+import time
+import typing
+
+import sqlalchemy.exc
+import telebot
+
+import metrics
+import outbox_service as OS
+import send_window
+import telegram_errors as TE
+import tracing
+import user_service as US
+
+logger = logging.getLogger(__name__)
+
+# attempts to send a message which got 429 responses, before it's returned
+# to the outbox
+SEND_ATTEMPTS = 3
+
+SEND_DURATION = metrics.REGISTRY.histogram(
+    "ivanov_send_duration_seconds", "Duration of send_message"
+)
+TELEGRAM_RATE_LIMITED = metrics.REGISTRY.counter(
+    "ivanov_telegram_rate_limited_total", "Telegram responses with error 429"
+)
+SEND_WINDOW = metrics.REGISTRY.gauge("ivanov_send_window", "Messages allowed in flight")
+SEND_RATE = metrics.REGISTRY.gauge(
+    "ivanov_send_rate", "Messages per second sent until a lane became empty"
+)
+SEND_WAIT = metrics.REGISTRY.histogram(
+    "ivanov_send_wait_seconds", "Time messages waited for the send window by lane"
+)
+DELIVERY_LATENCY = metrics.REGISTRY.histogram(
+    "ivanov_outbox_delivery_seconds",
+    "Time from adding a message to the outbox to its delivery by lane",
+)
+OUTBOX_MESSAGES = metrics.REGISTRY.counter(
+    "ivanov_outbox_messages_total", "Messages taken from the outbox by result"
+)
+UNSUBSCRIBED_UNREACHABLE = metrics.REGISTRY.counter(
+    "ivanov_unsubscribed_unreachable_total",
+    "Users unsubscribed because their chats were unreachable",
+)
+MIGRATED_CHATS = metrics.REGISTRY.counter(
+    "ivanov_migrated_chats_total", "Groups moved to their new supergroup chat id"
+)
+
+
+# shares of the send window taken by the lanes when all of them are busy
+LANE_WEIGHTS = {
+    OS.Priority.INTERACTIVE: 16,
+    OS.Priority.ALERT: 4,
+    OS.Priority.BROADCAST: 1,
+}
+# messages claimed at once by a lane
+LANE_BATCH_SIZES = {
+    OS.Priority.INTERACTIVE: 10,
+    OS.Priority.ALERT: 10,
+    OS.Priority.BROADCAST: 100,
+}
+
+
+class _Lane:
+    def __init__(self, priority: OS.Priority, batch_size: int, max_concurrency: int):
+        self.priority = priority
+        self.name = priority.name.lower()
+        self.batch_size = batch_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_concurrency, thread_name_prefix=f"Send-{self.name}"
+        )
+        self.wakeup = threading.Event()
+        self.thread = None
+        # ids of the batch being sent
+        self.claimed: list[int] = []
+
+
+class OutboxSender:
+    """Sends messages from the outbox until it's empty.
+
+    Every process runs a sender, they share the outbox through claims.
+    Every priority has its own lane, a thread claiming batches of its
+    messages, so a reply doesn't wait for a batch of broadcast messages.
+    The lanes share the send window by LANE_WEIGHTS. Messages of a batch
+    are sent concurrently, messages of one chat are sent in order by one
+    thread.
+    """
+
+    def __init__(
+        self,
+        create_session,
+        outbox_service: OS.OutboxService,
+        user_service: US.UserService,
+        bot: telebot.TeleBot,
+        window: send_window.AimdWindow,
+        *,
+        notify: typing.Callable[[Exception], None],
+        max_concurrency: int,
+        max_delivery_failures: int,
+        batch_sizes: dict[OS.Priority, int] = LANE_BATCH_SIZES,
+        claim_timeout: dt.timedelta = dt.timedelta(minutes=1),
+        max_attempts: int = 5,
+        poll_interval: float = 1.0,
+    ):
+        self._create_session = create_session
+        self._outbox_service = outbox_service
+        self._user_service = user_service
+        self._bot = bot
+        self.window = window
+        self._notify = notify
+        self._max_delivery_failures = max_delivery_failures
+        self._claim_timeout = claim_timeout
+        self._max_attempts = max_attempts
+        self._poll_interval = poll_interval
+        self._lanes = {
+            priority: _Lane(priority, batch_sizes[priority], max_concurrency)
+            for priority in OS.Priority
+        }
+        self._exited = threading.Event()
+
+    def start(self):
+        assert not self._exited.is_set()
+        for lane in self._lanes.values():
+            lane.thread = threading.Thread(
+                target=self._run, args=(lane,), name=f"Outbox-{lane.name}"
+            )
+            lane.thread.start()
+
+    def stop(self):
+        self._exited.set()
+        for lane in self._lanes.values():
+            lane.wakeup.set()
+        for lane in self._lanes.values():
+            lane.thread.join()
+            lane.executor.shutdown()
+
+    def python_thread(self):
+        return self._lanes[OS.Priority.BROADCAST].thread
+
+    def enqueue(
+        self, session, messages: list[OS.Message], priority: OS.Priority
+    ) -> None:
+        """Adds messages to the session, call wake() after the commit"""
+        self._outbox_service.enqueue(session, messages, priority)
+
+    def wake(self, priority: OS.Priority):
+        self._lanes[priority].wakeup.set()
+
+    def drain(self) -> int:
+        """Sends messages until the outbox is empty, returns their number"""
+        return sum(self._drain(lane) for lane in self._lanes.values())
+
+    def send_batch(self, priority: OS.Priority) -> int:
+        lane = self._lanes[priority]
+        with self._create_session() as session:
+            messages = self._outbox_service.claim(
+                session, lane.batch_size, self._claim_timeout, priority
+            )
+        if not messages:
+            return 0
+        lane.claimed = [message.id for message in messages]
+        try:
+            with tracing.span(
+                "OutboxSender.send_batch", lane=lane.name, n_messages=len(messages)
+            ):
+                by_chat = collections.defaultdict(list)
+                for message in messages:
+                    by_chat[message.chat_id].append(message)
+                futures = [
+                    lane.executor.submit(self._send_chat, chat_messages)
+                    for chat_messages in by_chat.values()
+                ]
+                outcomes = []
+                for future in futures:
+                    outcomes += future.result()
+                self._handle_outcomes(outcomes)
+        finally:
+            lane.claimed = []
+        return len(messages)
+
+    def _drain(self, lane: _Lane) -> int:
+        start = time.perf_counter()
+        n_sent = 0
+        while not self._exited.is_set():
+            n = self.send_batch(lane.priority)
+            if not n:
+                break
+            n_sent += n
+        if n_sent:
+            send_rate = n_sent / max(time.perf_counter() - start, 1e-9)
+            SEND_RATE.set(send_rate, lane=lane.name)
+            logger.info(
+                "Sent %s %s messages from the outbox at %.1f/s, send window %.1f",
+                n_sent,
+                lane.name,
+                send_rate,
+                self.window.window,
+            )
+        return n_sent
+
+    def _run(self, lane: _Lane):
+        while not self._exited.is_set():
+            lane.wakeup.clear()
+            try:
+                self._drain(lane)
+            except Exception as e:
+                logger.exception("Failed to send %s messages", lane.name)
+                self._notify(e)
+            lane.wakeup.wait(self._poll_interval)
+
+    def _send_chat(self, messages: list[OS.ClaimedMessage]):
+        outcomes = []
+        for message in messages:
+            try:
+                self._send_message(message.chat_id, message.text, message.priority)
+                outcomes.append((message, None))
+                created = message.time_created
+                if created.tzinfo is None:
+                    # sqlite doesn't keep the time zone
+                    created = created.replace(tzinfo=dt.UTC)
+                DELIVERY_LATENCY.observe(
+                    (dt.datetime.now(dt.UTC) - created).total_seconds(),
+                    lane=message.priority.name.lower(),
+                )
+            except Exception as e:
+                outcomes.append((message, e))
+        return outcomes
+
+    def _send_message(self, chat_id: int, text: str, priority: OS.Priority):
+        """Sends within the send window, retries after 429"""
+        lane = priority.name.lower()
+        for attempt in range(SEND_ATTEMPTS):
+            with SEND_WAIT.time(lane=lane):
+                self.window.acquire(priority)
+            latency = retry_after = None
+            try:
+                with (
+                    SEND_DURATION.time(),
+                    tracing.span("send_message", chat_id=chat_id, lane=lane),
+                ):
+                    start = time.perf_counter()
+                    self._bot.send_message(chat_id, text=text)
+                    latency = time.perf_counter() - start
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                if TE.classify(e) != TE.DeliveryError.RATE_LIMITED:
+                    raise
+                TELEGRAM_RATE_LIMITED.inc()
+                retry_after = TE.retry_after(e) or 1
+                if attempt == SEND_ATTEMPTS - 1:
+                    raise
+                self._extend_claims(retry_after)
+            finally:
+                self.window.release(latency, retry_after)
+                SEND_WINDOW.set(self.window.window)
+
+    def _extend_claims(self, retry_after: float):
+        """The pause holds the batches of all lanes, their claims mustn't
+        expire while they wait for it"""
+        ids = [id for lane in self._lanes.values() for id in lane.claimed]
+        try:
+            with self._create_session() as session:
+                self._outbox_service.extend_claim(
+                    session,
+                    ids,
+                    dt.timedelta(seconds=retry_after) + self._claim_timeout,
+                )
+        except sqlalchemy.exc.SQLAlchemyError:
+            # the messages may be sent twice then
+            logger.exception("Failed to extend claims of the outbox messages")
+
+    def _handle_outcomes(self, outcomes):
+        removed = []
+        # (delay in seconds, new chat id) -> message ids
+        retries = collections.defaultdict(list)
+        delivered = []
+        unreachable = []
+        failed = []
+        with self._create_session() as session:
+            for message, e in outcomes:
+                result = self._handle_outcome(session, message, e)
+                OUTBOX_MESSAGES.inc(
+                    priority=message.priority.name.lower(), result=result
+                )
+                if result == "sent":
+                    removed.append(message.id)
+                    if message.user_id is not None:
+                        delivered.append(message.user_id)
+                elif result == "unreachable":
+                    removed.append(message.id)
+                    if message.user_id is not None:
+                        unreachable.append(message.user_id)
+                elif result == "migrated":
+                    retries[(0, TE.migrate_to_chat_id(e))].append(message.id)
+                elif result == "retried":
+                    delay = 2**message.attempts
+                    if TE.classify(e) == TE.DeliveryError.RATE_LIMITED:
+                        delay = TE.retry_after(e) or 1
+                    retries[(delay, None)].append(message.id)
+                else:
+                    removed.append(message.id)
+                    failed.append((message, e))
+            self._outbox_service.remove(session, removed)
+            for (delay, chat_id), ids in retries.items():
+                self._outbox_service.retry(
+                    session, ids, dt.timedelta(seconds=delay), chat_id=chat_id
+                )
+            self._update_delivery_failures(session, delivered, unreachable)
+        # failed alerts aren't reported, the report would be an alert too
+        errors = [e for message, e in failed if message.priority != OS.Priority.ALERT]
+        if errors:
+            self._notify(
+                RuntimeError(
+                    f"failed to send some messages {len(errors)}, "
+                    f"reasons: {set(str(e) for e in errors)}"
+                )
+            )
+
+    def _handle_outcome(self, session, message: OS.ClaimedMessage, e) -> str:
+        if e is None:
+            return "sent"
+        error = TE.classify(e)
+        if error == TE.DeliveryError.MIGRATED:
+            new_chat_id = TE.migrate_to_chat_id(e)
+            # a reply to a group has no user to move, and the supergroup
+            # may already have its own user
+            if message.user_id is not None and self._user_service.migrate_chat(
+                session, message.user_id, new_chat_id
+            ):
+                logger.info("Chat %s was migrated to %s", message.chat_id, new_chat_id)
+                MIGRATED_CHATS.inc()
+                return "migrated"
+            return "unreachable"
+        if error == TE.DeliveryError.UNREACHABLE:
+            return "unreachable"
+        logger.warning("Failed to send a message to %s: %s", message.chat_id, e)
+        if message.attempts + 1 < self._max_attempts:
+            return "retried"
+        return "dropped"
+
+    def _update_delivery_failures(self, session, delivered, unreachable):
+        self._user_service.reset_delivery_failures(session, delivered)
+        n_unsubscribed = self._user_service.record_delivery_failures(
+            session, unreachable, self._max_delivery_failures
+        )
+        UNSUBSCRIBED_UNREACHABLE.inc(n_unsubscribed)
+        if unreachable:
+            logger.info(
+                "%s chats are unreachable, %s users unsubscribed",
+                len(unreachable),
+                n_unsubscribed,
+            )
+
+
+class OutboxBot:
+    """Bot for error handlers, messages go through the outbox with the
+    given priority, documents are sent directly"""
+
+    def __init__(
+        self,
+        create_session,
+        sender: OutboxSender,
+        bot: telebot.TeleBot,
+        priority: OS.Priority,
+    ):
+        self._create_session = create_session
+        self._sender = sender
+        self._bot = bot
+        self._priority = priority
+
+    def send_message(self, chat_id: int, text: str):
+        try:
+            with self._create_session() as session:
+                self._sender.enqueue(
+                    session, [OS.Message(chat_id, text)], self._priority
+                )
+                session.commit()
+        except sqlalchemy.exc.SQLAlchemyError:
+            # errors of the database itself are still delivered
+            logger.exception("Failed to add a message to the outbox")
+            self._bot.send_message(chat_id, text=text)
+            return
+        self._sender.wake(self._priority)
+
+    def send_document(self, chat_id: int, document):
+        return self._bot.send_document(chat_id, document)
@@ -0,0 +1,174 @@
+import dataclasses
+import datetime as dt
+import enum
+import uuid
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from db import models
+import tracing
+
+
+class Priority(enum.IntEnum):
+    """Lower values are sent first"""
+
+    INTERACTIVE = 0
+    ALERT = 1
+    BROADCAST = 2
+
+
+@dataclasses.dataclass
+class Message:
+    chat_id: int
+    text: str
+    user_id: uuid.UUID | None = None
+
+
+@dataclasses.dataclass
+class ClaimedMessage:
+    id: int
+    priority: Priority
+    chat_id: int
+    user_id: uuid.UUID | None
+    text: str
+    attempts: int
+    time_created: dt.datetime
+
+
+class OutboxService:
+    """Messages stored in the database until they are delivered.
+
+    enqueue() doesn't commit, so messages are written together with the
+    rest of the caller's transaction. A claimed message is hidden from
+    other senders for claim_timeout, if its sender crashes the message is
+    sent again, so delivery is at least once.
+    """
+
+    @tracing.traced
+    def enqueue(self, session: Session, messages: list[Message], priority: Priority):
+        if not messages:
+            return
+        now = dt.datetime.now(dt.UTC)
+        session.execute(
+            sqlalchemy.insert(models.OutboxMessage),
+            [
+                {
+                    "priority": int(priority),
+                    "chat_id": m.chat_id,
+                    "user_id": m.user_id,
+                    "text": m.text,
+                    "attempts": 0,
+                    "time_created": now,
+                    "time_available": now,
+                }
+                for m in messages
+            ],
+        )
+
+    @tracing.traced
+    def claim(
+        self,
+        session: Session,
+        limit: int,
+        claim_timeout: dt.timedelta,
+        priority: Priority | None = None,
+    ) -> list[ClaimedMessage]:
+        """Claims up to limit available messages, of the priority if it's
+        given, the most urgent first"""
+        outbox = models.OutboxMessage.__table__
+        now = dt.datetime.now(dt.UTC)
+        stmt = sqlalchemy.select(outbox.c.id).where(outbox.c.time_available <= now)
+        if priority is not None:
+            stmt = stmt.where(outbox.c.priority == int(priority))
+        ids = session.scalars(
+            stmt.order_by(outbox.c.priority, outbox.c.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not ids:
+            session.commit()
+            return []
+        # the condition is checked again, another sender may have claimed
+        # some of the messages in the meantime
+        rows = session.execute(
+            sqlalchemy.update(outbox)
+            .where(outbox.c.id.in_(ids), outbox.c.time_available <= now)
+            .values(time_available=now + claim_timeout)
+            .returning(
+                outbox.c.id,
+                outbox.c.priority,
+                outbox.c.chat_id,
+                outbox.c.user_id,
+                outbox.c.text,
+                outbox.c.attempts,
+                outbox.c.time_created,
+            )
+        ).all()
+        session.commit()
+        messages = [
+            ClaimedMessage(id, Priority(p), chat_id, user_id, text, attempts, created)
+            for id, p, chat_id, user_id, text, attempts, created in rows
+        ]
+        messages.sort(key=lambda m: (m.priority, m.id))
+        return messages
+
+    @tracing.traced
+    def extend_claim(
+        self, session: Session, ids: list[int], claim_timeout: dt.timedelta
+    ):
+        """Hides the claimed messages for claim_timeout from now, unless
+        they are already hidden for longer"""
+        if not ids:
+            return
+        outbox = models.OutboxMessage.__table__
+        until = dt.datetime.now(dt.UTC) + claim_timeout
+        session.execute(
+            sqlalchemy.update(outbox)
+            .where(outbox.c.id.in_(ids), outbox.c.time_available < until)
+            .values(time_available=until)
+        )
+        session.commit()
+
+    @tracing.traced
+    def remove(self, session: Session, ids: list[int]):
+        """Removes delivered or abandoned messages"""
+        if not ids:
+            return
+        session.execute(
+            sqlalchemy.delete(models.OutboxMessage).where(
+                models.OutboxMessage.id.in_(ids)
+            )
+        )
+        session.commit()
+
+    @tracing.traced
+    def retry(
+        self,
+        session: Session,
+        ids: list[int],
+        delay: dt.timedelta,
+        *,
+        chat_id: int | None = None,
+    ):
+        """Makes the messages available again after delay, optionally
+        for another chat"""
+        if not ids:
+            return
+        values = {
+            "attempts": models.OutboxMessage.attempts + 1,
+            "time_available": dt.datetime.now(dt.UTC) + delay,
+        }
+        if chat_id is not None:
+            values["chat_id"] = chat_id
+        session.execute(
+            sqlalchemy.update(models.OutboxMessage)
+            .where(models.OutboxMessage.id.in_(ids))
+            .values(**values)
+        )
+        session.commit()
+
+    def count(self, session: Session) -> int:
+        return session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count()).select_from(models.OutboxMessage)
+        )
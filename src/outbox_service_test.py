@@ -0,0 +1,51 @@
+import datetime as dt
+
+from db import models
+import outbox_service as OS
+
+CLAIM_TIMEOUT = dt.timedelta(minutes=1)
+
+
+def test_claim_by_priority(portable_db):
+    session = portable_db.session()
+    service = OS.OutboxService()
+    service.enqueue(
+        session, [OS.Message(1, "b1"), OS.Message(2, "b2")], OS.Priority.BROADCAST
+    )
+    service.enqueue(session, [OS.Message(3, "alert")], OS.Priority.ALERT)
+    service.enqueue(session, [OS.Message(1, "reply")], OS.Priority.INTERACTIVE)
+    session.commit()
+
+    claimed = service.claim(session, 3, CLAIM_TIMEOUT)
+    assert [m.text for m in claimed] == ["reply", "alert", "b1"]
+    assert claimed[0].priority == OS.Priority.INTERACTIVE
+    # claimed messages are hidden from other senders
+    assert [m.text for m in service.claim(session, 3, CLAIM_TIMEOUT)] == ["b2"]
+    assert service.claim(session, 3, CLAIM_TIMEOUT) == []
+
+    service.remove(session, [m.id for m in claimed])
+    assert service.count(session) == 1
+
+
+def test_expired_claims_and_retries(portable_db):
+    session = portable_db.session()
+    service = OS.OutboxService()
+    user = models.User(chat_id=-1)
+    session.add(user)
+    session.commit()
+    service.enqueue(session, [OS.Message(-1, "phrase", user.id)], OS.Priority.BROADCAST)
+    session.commit()
+
+    # the sender crashed, the message is claimed again
+    [message] = service.claim(session, 10, dt.timedelta(0))
+    assert message.user_id == user.id
+    [message] = service.claim(session, 10, CLAIM_TIMEOUT)
+    assert message.attempts == 0
+
+    # the group became a supergroup, its id doesn't fit into 32 bits
+    service.retry(session, [message.id], dt.timedelta(0), chat_id=-1001234567890)
+    [message] = service.claim(session, 10, CLAIM_TIMEOUT)
+    assert (message.chat_id, message.attempts) == (-1001234567890, 1)
+
+    service.retry(session, [message.id], dt.timedelta(hours=1))
+    assert service.claim(session, 10, CLAIM_TIMEOUT) == []
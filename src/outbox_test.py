@@ -0,0 +1,235 @@
+import datetime as dt
+import time
+
+import sqlalchemy
+import telebot
+
+import bot as B
+from db import models
+import outbox
+import outbox_service as OS
+import phrases_service as PS
+import send_window
+import test.bot
+import user_service as US
+
+
+def create_sender(testing_db, test_bot, notified, **kwargs):
+    return outbox.OutboxSender(
+        testing_db.session,
+        OS.OutboxService(),
+        US.UserService(),
+        test_bot,
+        send_window.AimdWindow(max_window=4),
+        notify=notified.append,
+        max_concurrency=4,
+        max_delivery_failures=3,
+        **kwargs,
+    )
+
+
+def api_error(code, description, parameters=None):
+    return {
+        "ok": False,
+        "error_code": code,
+        "description": description,
+        "parameters": parameters or {},
+    }
+
+
+def test_send_in_order(testing_db):
+    test_bot = test.bot.MockTelebot()
+    sender = create_sender(
+        testing_db,
+        test_bot,
+        [],
+        batch_sizes={priority: 3 for priority in OS.Priority},
+    )
+    session = testing_db.session()
+    sender.enqueue(
+        session,
+        [OS.Message(1, f"phrase{i}") for i in range(5)],
+        OS.Priority.BROADCAST,
+    )
+    sender.enqueue(session, [OS.Message(2, "reply")], OS.Priority.INTERACTIVE)
+    session.commit()
+
+    # lanes are claimed separately, messages of a chat are sent in order
+    assert sender.send_batch(OS.Priority.INTERACTIVE) == 1
+    assert test_bot.chats[2] == ["reply"]
+    assert 1 not in test_bot.chats
+    assert sender.send_batch(OS.Priority.BROADCAST) == 3
+    assert test_bot.chats[1] == ["phrase0", "phrase1", "phrase2"]
+    assert sender.drain() == 2
+    assert test_bot.chats[1] == [f"phrase{i}" for i in range(5)]
+    assert OS.OutboxService().count(session) == 0
+
+
+def test_failed_messages(testing_db):
+    test_bot = test.bot.MockTelebot()
+    test_bot.send_errors[1] = api_error(500, "Internal Server Error")
+    test_bot.send_errors[2] = api_error(500, "Internal Server Error")
+    notified = []
+    sender = create_sender(testing_db, test_bot, notified, max_attempts=2)
+    session = testing_db.session()
+    sender.enqueue(session, [OS.Message(1, "phrase")], OS.Priority.BROADCAST)
+    sender.enqueue(session, [OS.Message(2, "alert")], OS.Priority.ALERT)
+    session.commit()
+
+    assert sender.drain() == 2
+    assert not notified
+    # retried after a delay
+    session.execute(
+        sqlalchemy.update(models.OutboxMessage).values(
+            time_available=dt.datetime.now(dt.UTC)
+        )
+    )
+    session.commit()
+    del test_bot.send_errors[2]
+    assert sender.drain() == 2
+    assert test_bot.chats[2] == ["alert"]
+    assert len(notified) == 1
+    assert "failed to send some messages 1" in str(notified[0])
+    assert OS.OutboxService().count(session) == 0
+
+
+def test_migrated_chat(testing_db):
+    test_bot = test.bot.MockTelebot()
+    test_bot.send_errors[-1] = api_error(
+        400,
+        "Bad Request: group chat was upgraded to a supergroup chat",
+        {"migrate_to_chat_id": -100},
+    )
+    sender = create_sender(testing_db, test_bot, [])
+    session = testing_db.session()
+    user = models.User(chat_id=-1, _send_phrases=True)
+    session.add(user)
+    session.commit()
+    user_id = user.id
+    sender.enqueue(
+        session,
+        [OS.Message(-1, "phrase1", user_id), OS.Message(-1, "phrase2", user_id)],
+        OS.Priority.BROADCAST,
+    )
+    session.commit()
+
+    sender.drain()
+    assert test_bot.chats[-100] == ["phrase1", "phrase2"]
+    user = testing_db.session().get(models.User, user_id)
+    assert user.chat_id == -100
+    assert user.send_phrases()
+
+
+class RateLimitedTelebot(test.bot.MockTelebot):
+    """Answers the first message with 429, claims the outbox when the
+    message is sent again"""
+
+    def __init__(self, create_session):
+        super().__init__()
+        self.send_errors[1] = api_error(
+            429, "Too Many Requests: retry after 2", {"retry_after": 2}
+        )
+        self._create_session = create_session
+        self.claimed = None
+
+    def send_message(self, chat_id, text):
+        if chat_id in self.send_errors:
+            error = self.send_errors.pop(chat_id)
+            raise telebot.apihelper.ApiTelegramException("sendMessage", None, error)
+        with self._create_session() as session:
+            self.claimed = OS.OutboxService().claim(
+                session, 10, dt.timedelta(minutes=1)
+            )
+        return super().send_message(chat_id, text)
+
+
+def test_claim_outlives_retry_after(testing_db):
+    test_bot = RateLimitedTelebot(testing_db.session)
+    sender = create_sender(
+        testing_db, test_bot, [], claim_timeout=dt.timedelta(seconds=1)
+    )
+    session = testing_db.session()
+    sender.enqueue(session, [OS.Message(1, "phrase")], OS.Priority.BROADCAST)
+    session.commit()
+
+    assert sender.send_batch(OS.Priority.BROADCAST) == 1
+    assert test_bot.chats[1] == ["phrase"]
+    # the pause was longer than the claim timeout, the claim was extended
+    assert test_bot.claimed == []
+    assert OS.OutboxService().count(session) == 0
+
+
+def test_bot_replies(testing_db):
+    test_bot = test.bot.MockTelebot()
+    sender = create_sender(testing_db, test_bot, [])
+    bot = B.Bot(
+        test_bot,
+        testing_db.session,
+        US.UserService(),
+        PS.PhrasesService(),
+        outbox=sender,
+    )
+    test_bot.user_message(100, "start")
+    assert not test_bot.chats[100]
+    session = testing_db.session()
+    assert US.UserService().get_user(session, 100).send_phrases()
+    sender.drain()
+    assert test_bot.chats[100] == ["Hello! You're subscribed now"]
+
+    test_bot.user_message(100, "profile")
+    assert not test_bot.chats[100][1:]
+    sender.drain()
+    assert test_bot.chats[100][1:] == ["The action is forbidden"]
+
+    session.execute(sqlalchemy.update(models.User).values(_is_admin=True))
+    session.commit()
+    test_bot.user_message(100, "profile 0.1")
+    bot._profile_thread.join()
+    assert len(test_bot.documents[100]) == 1
+    sender.drain()
+    assert test_bot.chats[100][2] == "Profiling for 0.1s"
+    assert "samples in" in test_bot.chats[100][3]
+
+
+class SlowTelebot(test.bot.MockTelebot):
+    def send_message(self, chat_id, text):
+        time.sleep(0.01)
+        return super().send_message(chat_id, text)
+
+
+def test_reply_during_broadcast(app_db):
+    test_bot = SlowTelebot()
+    sender = outbox.OutboxSender(
+        app_db.session,
+        OS.OutboxService(),
+        US.UserService(),
+        test_bot,
+        send_window.AimdWindow(max_window=4, initial=4, weights=outbox.LANE_WEIGHTS),
+        notify=[].append,
+        max_concurrency=4,
+        max_delivery_failures=3,
+        poll_interval=0.01,
+    )
+    session = app_db.session()
+    sender.enqueue(
+        session,
+        [OS.Message(chat_id, "phrase") for chat_id in range(400)],
+        OS.Priority.BROADCAST,
+    )
+    session.commit()
+    sender.start()
+    try:
+        while len(test_bot.chats) < 20:
+            time.sleep(0.01)
+        start = time.monotonic()
+        sender.enqueue(session, [OS.Message(-1, "reply")], OS.Priority.INTERACTIVE)
+        session.commit()
+        sender.wake(OS.Priority.INTERACTIVE)
+        while not test_bot.chats.get(-1):
+            time.sleep(0.005)
+        reply_latency = time.monotonic() - start
+        # the reply doesn't wait for the broadcast batch
+        assert reply_latency < 0.3
+        assert len(test_bot.chats) < 400
+    finally:
+        sender.stop()
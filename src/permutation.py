@@ -0,0 +1,41 @@
+"""Keyed pseudorandom permutations of range(size) computed one element at a
+time, so that a permutation doesn't need to be stored"""
+
+import hashlib
+
+_MASK64 = (1 << 64) - 1
+_ROUNDS = 4
+
+
+def make_key(*parts) -> int:
+    digest = hashlib.blake2b(
+        ":".join(str(p) for p in parts).encode("utf-8"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _mix(x: int) -> int:
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def permute(index: int, size: int, key: int) -> int:
+    """Element at index of the permutation of range(size) chosen by key.
+
+    Feistel network over the smallest power of 4 not less than size, values
+    outside of range(size) are permuted again until they fall inside.
+    """
+    assert 0 <= index < size
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    half_mask = (1 << half_bits) - 1
+    value = index
+    while True:
+        left, right = value >> half_bits, value & half_mask
+        for round in range(_ROUNDS):
+            mixed = _mix((key + round * 0x9E3779B97F4A7C15 + right) & _MASK64)
+            left, right = right, left ^ (mixed & half_mask)
+        value = (left << half_bits) | right
+        if value < size:
+            return value
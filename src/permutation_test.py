@@ -0,0 +1,36 @@
+import collections
+
+import permutation
+
+
+def test_permute_is_permutation():
+    for size in [1, 2, 3, 5, 16, 17, 100, 1000]:
+        for key in [0, 1, permutation.make_key("user", 42)]:
+            values = [permutation.permute(i, size, key) for i in range(size)]
+            assert sorted(values) == list(range(size))
+
+
+def test_permute_depends_on_key():
+    size = 100
+    orders = {
+        tuple(
+            permutation.permute(i, size, permutation.make_key(user))
+            for i in range(size)
+        )
+        for user in range(20)
+    }
+    assert len(orders) == 20
+    assert tuple(range(size)) not in orders
+    assert permutation.make_key("a", 1) == permutation.make_key("a", 1)
+    assert permutation.make_key("a", 1) != permutation.make_key("a", 2)
+
+
+def test_permute_first_element_is_uniform():
+    size = 5
+    n_keys = 5000
+    freq = collections.Counter(
+        permutation.permute(0, size, permutation.make_key(key)) for key in range(n_keys)
+    )
+    assert set(freq) == set(range(size))
+    for n in freq.values():
+        assert abs(n / n_keys - 1 / size) < 0.03
@@ -0,0 +1,66 @@
+import base64
+import collections
+import hashlib
+import typing
+import zlib
+
+# zlib looks back 32KB, a longer dictionary is never used
+DICTIONARY_SIZE = 32 * 1024
+# texts and their lengths used for training, enough to find common words
+TRAINING_TEXTS = 5000
+TRAINING_TEXT_LENGTH = 2000
+# phrase.text of a compressed phrase, keeps the column unique
+KEY_PREFIX = "zlib:"
+
+
+def key(text: str) -> str:
+    # the key is stored twice, in the table and the unique index
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    return KEY_PREFIX + base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+def train_dictionary(texts: typing.Iterable[str], size: int = DICTIONARY_SIZE) -> bytes:
+    """Builds a zlib preset dictionary of word sequences repeated in texts.
+
+    Sequences saving the most bytes go last, zlib encodes closer matches
+    with shorter distances.
+    """
+    counts = collections.Counter()
+    for text in _sample(texts):
+        words = text.split()
+        for n in (1, 2, 3):
+            for i in range(len(words) - n + 1):
+                counts[" ".join(words[i : i + n])] += 1
+    candidates = sorted(
+        (
+            (count * len(s.encode("utf-8")), s)
+            for s, count in counts.items()
+            if count > 1
+        ),
+        reverse=True,
+    )
+    chosen = []
+    total = 0
+    for _, s in candidates:
+        if total >= size:
+            break
+        chosen.append(s)
+        total += len(s.encode("utf-8")) + 1
+    return " ".join(reversed(chosen)).encode("utf-8")[-size:]
+
+
+def compress(text: str, dictionary: bytes) -> bytes:
+    compressor = zlib.compressobj(level=9, zdict=dictionary)
+    return compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+
+def decompress(data: bytes, dictionary: bytes) -> str:
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+def _sample(texts: typing.Iterable[str]) -> typing.Iterator[str]:
+    for n, text in enumerate(texts):
+        if n == TRAINING_TEXTS:
+            return
+        yield text[:TRAINING_TEXT_LENGTH]
@@ -0,0 +1,39 @@
+import random
+
+import phrase_compression
+
+
+def quotes(n, seed=0):
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(300)]
+    return [
+        "Wisdom says: " + " ".join(rng.choice(words) for _ in range(40))
+        for _ in range(n)
+    ]
+
+
+def test_round_trip():
+    texts = quotes(100) + ["Цитата 😀"]
+    dictionary = phrase_compression.train_dictionary(texts)
+    assert len(dictionary) <= phrase_compression.DICTIONARY_SIZE
+    for text in texts:
+        compressed = phrase_compression.compress(text, dictionary)
+        assert phrase_compression.decompress(compressed, dictionary) == text
+
+
+def test_dictionary_helps_short_texts():
+    dictionary = phrase_compression.train_dictionary(quotes(1000))
+    texts = quotes(100, seed=1)
+    plain = sum(len(t.encode()) for t in texts)
+    without = sum(len(phrase_compression.compress(t, b"")) for t in texts)
+    with_dictionary = sum(
+        len(phrase_compression.compress(t, dictionary)) for t in texts
+    )
+    assert with_dictionary < without < plain
+    assert with_dictionary < plain / 2
+
+
+def test_key():
+    assert phrase_compression.key("a") == phrase_compression.key("a")
+    assert phrase_compression.key("a") != phrase_compression.key("b")
+    assert phrase_compression.key("a").startswith(phrase_compression.KEY_PREFIX)
@@ -1,85 +1,955 @@
+import bisect
+import collections
+import dataclasses
 import functools
+import logging
+import random
+import re
+import threading
+import typing
+import uuid
+import numpy as np
 import sqlalchemy
 from sqlalchemy.orm import Session
 from db import models
-from sqlalchemy.orm import aliased
+import bitset
+import broadcast_plan as BP
+import minhash
+import permutation
+import phrase_compression
+import telegram_text
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# keeps IN (...) lists and multi-row statements reasonably small
+BATCH_SIZE = 500
+# rows of an executemany of mark_sent(), bounds its parameter lists
+SENT_BATCH_SIZE = 5000
+# a word or a "quoted phrase" of a search query
+_SEARCH_TERM = re.compile(r'"[^"]+"|\w+')
+_SEARCH_WORD = re.compile(r"\w+")
+# estimated share of common shingles of near-duplicate phrases
+NEAR_DUPLICATE_SIMILARITY = 0.75
+# length of Phrase.text
+MAX_PHRASE_LENGTH = 100000
+# a chunk takes about PLAN_CHUNK_SIZE x phrases x 7 bytes, subscribers are
+# read from the cursor in chunks of this size by all pickers, otherwise the
+# session buffers all rows of a broadcast
+PLAN_CHUNK_SIZE = 4096
+_STREAMED = {"yield_per": PLAN_CHUNK_SIZE}
+# users x new phrases drawn at once when new phrases are merged into queues
+MERGE_MATRIX_SIZE = 1 << 20
+
+
+@dataclasses.dataclass
+class AddedPhrases:
+    added: int = 0
+    # (skipped phrase, similar stored or added phrase)
+    near_duplicates: list[tuple[str, str]] = dataclasses.field(default_factory=list)
 
 
 class PhrasesService:
-    def add_phrases(self, session: Session, new_phrases: list[str]):
-        new_phrases = set(p for p in new_phrases if isinstance(p, str) and p)
-        old_phrases = set(phrase.text for phrase in self.get_phrases(session))
-        phrases_to_insert = set()
-        for phrase in new_phrases:
-            if phrase not in old_phrases:
-                phrases_to_insert.add(phrase)
+    def __init__(self, *, compression: bool = False):
+        """compression stores texts of new phrases compressed, see
+        migrate_storage() for the existing ones"""
+        self._compression = compression
+        # phrase id -> text, loaded on demand and dropped when phrases are added
+        self._texts = {}
+        # phrase id -> messages the phrase is sent as
+        self._messages = {}
+        # dictionary id -> zlib dictionary of compressed phrases
+        self._dictionaries = {}
+        self._texts_lock = threading.Lock()
+
+    @tracing.traced
+    def add_phrases(
+        self,
+        session: Session,
+        new_phrases: list[str],
+        rng: np.random.Generator | None = None,
+    ) -> AddedPhrases:
+        """Adds normalized phrases which aren't there yet and splits the long
+        ones into messages. Near-duplicates of stored phrases or of earlier
+        phrases of the list are skipped too. New phrases are merged into
+        the existing phrase queues."""
+        # in order of the list, the first of similar phrases is added
+        new_phrases = dict.fromkeys(
+            telegram_text.normalize(p) for p in new_phrases if isinstance(p, str)
+        )
+        new_phrases.pop("", None)
+        too_long = [p for p in new_phrases if len(p) > MAX_PHRASE_LENGTH]
+        if too_long:
+            logger.warning(
+                "Skipped %s phrases longer than %s characters",
+                len(too_long),
+                MAX_PHRASE_LENGTH,
+            )
+            for phrase in too_long:
+                del new_phrases[phrase]
+        # compressed phrases are stored by their keys
+        old_phrases = set(session.scalars(sqlalchemy.select(models.Phrase.text)))
+        phrases_to_insert = [
+            phrase
+            for phrase in new_phrases
+            if phrase not in old_phrases
+            and phrase_compression.key(phrase) not in old_phrases
+        ]
+        near_duplicates = self._find_near_duplicates(session, phrases_to_insert)
+        phrases_to_insert = [p for p in phrases_to_insert if p not in near_duplicates]
         if phrases_to_insert:
-            session.execute(
-                sqlalchemy.insert(models.Phrase),
-                [{"text": text} for text in phrases_to_insert],
+            if self._compression:
+                dictionary_id, dictionary = self._get_dictionary(
+                    session, phrases_to_insert
+                )
+                values = [
+                    {
+                        "text": phrase_compression.key(text),
+                        "compressed": phrase_compression.compress(text, dictionary),
+                        "dictionary_id": dictionary_id,
+                    }
+                    for text in phrases_to_insert
+                ]
+            else:
+                values = [{"text": text} for text in phrases_to_insert]
+            n_old_phrases = session.scalar(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(models.Phrase)
             )
+            new_ids = session.scalars(
+                sqlalchemy.insert(models.Phrase).returning(models.Phrase.id), values
+            ).all()
+            self._merge_into_queues(session, new_ids, n_old_phrases, rng)
+            # new phrases become a batch of the permutation selection
+            models.fill_phrase_ordinals(session.connection())
+            models.split_long_phrases(session.connection(), new_ids)
+            models.index_phrases(session.connection())
+            models.fill_phrase_signatures(session.connection())
             session.commit()
+            with self._texts_lock:
+                self._texts.clear()
+                self._messages.clear()
+        if near_duplicates:
+            logger.info("Skipped %s near-duplicate phrases", len(near_duplicates))
+        return AddedPhrases(len(phrases_to_insert), list(near_duplicates.items()))
+
+    def _find_near_duplicates(self, session, texts: list[str]) -> dict[str, str]:
+        """Returns texts similar to a stored phrase or an earlier text of the
+        list, mapped to the similar text. Only phrases sharing an LSH bucket
+        are compared."""
+        signatures = {text: minhash.signature(text) for text in texts}
+        buckets = {text: minhash.bands(signatures[text]) for text in texts}
+        # bucket -> ordinals of stored phrases
+        stored = collections.defaultdict(list)
+        all_buckets = list(
+            {b for text_buckets in buckets.values() for b in text_buckets}
+        )
+        for begin in range(0, len(all_buckets), BATCH_SIZE):
+            for bucket, ordinal in session.execute(
+                sqlalchemy.select(
+                    models.PhraseBucket.bucket, models.PhraseBucket.ordinal
+                ).where(
+                    models.PhraseBucket.bucket.in_(
+                        all_buckets[begin : begin + BATCH_SIZE]
+                    )
+                )
+            ):
+                stored[bucket].append(ordinal)
+        ordinals = list(
+            {o for bucket_ordinals in stored.values() for o in bucket_ordinals}
+        )
+        stored_signatures = {}
+        for begin in range(0, len(ordinals), BATCH_SIZE):
+            stored_signatures.update(
+                (ordinal, minhash.from_bytes(signature))
+                for ordinal, signature in session.execute(
+                    sqlalchemy.select(
+                        models.PhraseSignature.ordinal, models.PhraseSignature.signature
+                    ).where(
+                        models.PhraseSignature.ordinal.in_(
+                            ordinals[begin : begin + BATCH_SIZE]
+                        )
+                    )
+                )
+            )
 
+        duplicates = {}
+        # bucket -> added texts of the list
+        added = collections.defaultdict(list)
+        for text in texts:
+            candidates = {("stored", o) for b in buckets[text] for o in stored[b]}
+            candidates |= {("new", t) for b in buckets[text] for t in added[b]}
+            best, best_similarity = None, 0.0
+            for kind, candidate in candidates:
+                other = (
+                    stored_signatures[candidate]
+                    if kind == "stored"
+                    else signatures[candidate]
+                )
+                similarity = minhash.similarity(signatures[text], other)
+                if similarity > best_similarity:
+                    best, best_similarity = (kind, candidate), similarity
+            if best_similarity >= NEAR_DUPLICATE_SIMILARITY:
+                duplicates[text] = best
+            else:
+                for b in buckets[text]:
+                    added[b].append(text)
+        similar = list({c for kind, c in duplicates.values() if kind == "stored"})
+        ids = {}
+        for begin in range(0, len(similar), BATCH_SIZE):
+            ids.update(
+                session.execute(
+                    sqlalchemy.select(models.Phrase.ordinal, models.Phrase.id).where(
+                        models.Phrase.ordinal.in_(similar[begin : begin + BATCH_SIZE])
+                    )
+                ).all()
+            )
+        stored_texts = self.get_texts(session, ids.values())
+        return {
+            text: stored_texts[ids[c]] if kind == "stored" else c
+            for text, (kind, c) in duplicates.items()
+        }
+
+    @tracing.traced
+    def migrate_storage(self, session: Session, batch_size: int) -> int:
+        """Compresses up to batch_size stored phrases, or decompresses them
+        if compression is off. Returns the number of migrated phrases."""
+        phrase = models.Phrase
+        if self._compression:
+            rows = session.execute(
+                sqlalchemy.select(phrase.id, phrase.text)
+                .where(phrase.compressed.is_(None))
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return 0
+            dictionary_id, dictionary = self._get_dictionary(
+                session, (text for _, text in rows)
+            )
+            values = [
+                {
+                    "b_id": id,
+                    "text": phrase_compression.key(text),
+                    "compressed": phrase_compression.compress(text, dictionary),
+                    "dictionary_id": dictionary_id,
+                }
+                for id, text in rows
+            ]
+            # long phrases are split when they are loaded instead, the parts
+            # would take as much as the uncompressed text
+            part = models.PhrasePart
+            for begin in range(0, len(rows), BATCH_SIZE):
+                session.execute(
+                    sqlalchemy.delete(part).where(
+                        part.phrase_id.in_(
+                            [id for id, _ in rows[begin : begin + BATCH_SIZE]]
+                        )
+                    )
+                )
+        else:
+            rows = session.execute(
+                sqlalchemy.select(phrase.id, phrase.compressed, phrase.dictionary_id)
+                .where(phrase.compressed.is_not(None))
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return 0
+            values = [
+                {
+                    "b_id": id,
+                    "text": phrase_compression.decompress(
+                        compressed, self._load_dictionary(session, dictionary_id)
+                    ),
+                    "compressed": None,
+                    "dictionary_id": None,
+                }
+                for id, compressed, dictionary_id in rows
+            ]
+        table = phrase.__table__
+        session.execute(
+            sqlalchemy.update(table)
+            .where(table.c.id == sqlalchemy.bindparam("b_id"))
+            .values(
+                text=sqlalchemy.bindparam("text"),
+                compressed=sqlalchemy.bindparam("compressed"),
+                dictionary_id=sqlalchemy.bindparam("dictionary_id"),
+            ),
+            values,
+        )
+        if not self._compression:
+            models.split_long_phrases(session.connection(), [id for id, _, _ in rows])
+        session.commit()
+        return len(rows)
+
+    @tracing.traced
     def get_phrases(self, session):
         return session.query(models.Phrase).all()
 
-    def get_random_phrases(self, session):
-        return session.execute(PhrasesService._get_random_phrases_request()).all()
+    @tracing.traced
+    def get_texts(
+        self, session, phrase_ids: typing.Iterable[uuid.UUID | None]
+    ) -> dict[uuid.UUID, str]:
+        """Returns texts of the phrases, only texts which aren't cached yet
+        are loaded from the database"""
+        phrase_ids = set(phrase_ids)
+        phrase_ids.discard(None)
+        with self._texts_lock:
+            missing = [i for i in phrase_ids if i not in self._texts]
+        loaded = {}
+        phrase = models.Phrase
+        for begin in range(0, len(missing), BATCH_SIZE):
+            batch = missing[begin : begin + BATCH_SIZE]
+            for id, text, compressed, dictionary_id in session.execute(
+                sqlalchemy.select(
+                    phrase.id, phrase.text, phrase.compressed, phrase.dictionary_id
+                ).where(phrase.id.in_(batch))
+            ):
+                if compressed is not None:
+                    text = phrase_compression.decompress(
+                        compressed, self._load_dictionary(session, dictionary_id)
+                    )
+                loaded[id] = text
+        with self._texts_lock:
+            self._texts.update(loaded)
+            return {i: self._texts[i] for i in phrase_ids if i in self._texts}
+
+    @tracing.traced
+    def find_phrases(
+        self, session, query: str, limit: int, offset: int = 0
+    ) -> list[tuple[uuid.UUID, str]]:
+        """Returns (id, text) of phrases containing all words of the query,
+        quoted words are looked up as a phrase. Newer phrases go first."""
+        terms = [
+            " ".join(_SEARCH_WORD.findall(term)) for term in _SEARCH_TERM.findall(query)
+        ]
+        terms = [term for term in terms if term]
+        if not terms:
+            return []
+        phrase = models.Phrase
+        if session.get_bind().dialect.name == "sqlite":
+            # every term is quoted, the query can't use the FTS5 syntax
+            match = " ".join(f'"{term}"' for term in terms)
+            ordinals = session.scalars(
+                sqlalchemy.text(
+                    "SELECT rowid FROM phrase_fts WHERE phrase_fts MATCH :match "
+                    "ORDER BY rowid DESC LIMIT :limit OFFSET :offset"
+                ),
+                {"match": match, "limit": limit, "offset": offset},
+            ).all()
+            ids = dict(
+                session.execute(
+                    sqlalchemy.select(phrase.ordinal, phrase.id).where(
+                        phrase.ordinal.in_(ordinals)
+                    )
+                ).all()
+            )
+            ids = [ids[ordinal] for ordinal in ordinals if ordinal in ids]
+        else:
+            search = models.PhraseSearch
+            config = sqlalchemy.literal_column(models.SEARCH_CONFIG)
+            stmt = sqlalchemy.select(phrase.id).join(
+                search, search.ordinal == phrase.ordinal
+            )
+            for term in terms:
+                stmt = stmt.where(
+                    search.document.bool_op("@@")(
+                        sqlalchemy.func.phraseto_tsquery(config, term)
+                    )
+                )
+            ids = session.scalars(
+                stmt.order_by(search.ordinal.desc()).limit(limit).offset(offset)
+            ).all()
+        texts = self.get_texts(session, ids)
+        return [(id, texts[id]) for id in ids if id in texts]
+
+    def _get_dictionary(
+        self, session, texts: typing.Iterable[str]
+    ) -> tuple[int, bytes]:
+        """Returns the latest dictionary, the first one is trained on texts"""
+        dictionary = session.execute(
+            sqlalchemy.select(models.PhraseDictionary.id, models.PhraseDictionary.data)
+            .order_by(models.PhraseDictionary.id.desc())
+            .limit(1)
+        ).first()
+        if dictionary is None:
+            data = phrase_compression.train_dictionary(texts)
+            id = session.scalar(
+                sqlalchemy.insert(models.PhraseDictionary)
+                .values(data=data)
+                .returning(models.PhraseDictionary.id)
+            )
+            dictionary = (id, data)
+            logger.info("Trained a phrase dictionary of %s bytes", len(data))
+        with self._texts_lock:
+            self._dictionaries[dictionary[0]] = dictionary[1]
+        return dictionary
+
+    def _load_dictionary(self, session, dictionary_id: int) -> bytes:
+        with self._texts_lock:
+            dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is None:
+            dictionary = session.get(models.PhraseDictionary, dictionary_id).data
+            with self._texts_lock:
+                self._dictionaries[dictionary_id] = dictionary
+        return dictionary
+
+    @tracing.traced
+    def get_messages(
+        self, session, phrase_ids: typing.Iterable[uuid.UUID | None]
+    ) -> dict[uuid.UUID, tuple[str, ...]]:
+        """Returns messages the phrases are sent as, the parts stored by
+        add_phrases() for long phrases and the text for the others"""
+        texts = self.get_texts(session, phrase_ids)
+        with self._texts_lock:
+            missing = [i for i in texts if i not in self._messages]
+        long_ids = {
+            i
+            for i in missing
+            if telegram_text.length(texts[i]) > telegram_text.MAX_MESSAGE_LENGTH
+        }
+        parts = collections.defaultdict(list)
+        part = models.PhrasePart
+        ordered_ids = list(long_ids)
+        for begin in range(0, len(ordered_ids), BATCH_SIZE):
+            batch = ordered_ids[begin : begin + BATCH_SIZE]
+            for phrase_id, text in session.execute(
+                sqlalchemy.select(part.phrase_id, part.text)
+                .where(part.phrase_id.in_(batch))
+                .order_by(part.phrase_id, part.position)
+            ):
+                parts[phrase_id].append(text)
+        loaded = {}
+        for i in missing:
+            if i not in long_ids:
+                loaded[i] = (texts[i],)
+            elif parts[i]:
+                loaded[i] = tuple(parts[i])
+            else:
+                # inserted bypassing add_phrases
+                loaded[i] = tuple(telegram_text.split(texts[i]))
+        with self._texts_lock:
+            self._messages.update(loaded)
+            return {i: self._messages[i] for i in texts}
+
+    @tracing.traced
+    def fill_queues(
+        self,
+        session,
+        size: int,
+        shard: int | None = None,
+        n_shards: int | None = None,
+        *,
+        user_id: uuid.UUID | None = None,
+    ) -> int:
+        """Tops up phrase queues of subscribers to size random phrases which
+        were neither sent nor queued yet. Returns number of queued phrases.
+
+        Existing entries are kept, add_phrases() merges new phrases into
+        them. If shard or user_id is given only queues of its users are
+        read, through the user_id prefix of the queue's primary key.
+        """
+        params = {"size": size}
+        if shard is not None:
+            params.update(shard=shard, n_shards=n_shards)
+        if user_id is not None:
+            params.update(user_id=user_id)
+        queue = models.QueuedPhrase.__table__
+        used = models.UsedPhrases.__table__
+        # queued phrases may have been sent without going through mark_sent
+        stale = sqlalchemy.delete(queue).where(
+            sqlalchemy.exists().where(
+                used.c.user_id == queue.c.user_id,
+                used.c.phrase_id == queue.c.phrase_id,
+            )
+        )
+        if user_id is not None:
+            stale = stale.where(queue.c.user_id == user_id)
+        elif shard is not None:
+            stale = stale.where(
+                queue.c.user_id.in_(
+                    PhrasesService._subscribers(models.User.id, sharded=True)
+                )
+            )
+        session.execute(stale, params)
+        result = session.execute(
+            PhrasesService._fill_queues_request(
+                sharded=shard is not None, single_user=user_id is not None
+            ),
+            params,
+        )
+        session.commit()
+        return result.rowcount
+
+    def _merge_into_queues(
+        self,
+        session,
+        phrase_ids: list[uuid.UUID],
+        n_old_phrases: int,
+        rng: np.random.Generator | None,
+    ):
+        """Puts new phrases into existing queues as if they had been there
+        when the queues were filled.
+
+        A queue is the beginning of a random order of the phrases the user
+        hasn't got yet. Every new phrase takes a uniformly random place in
+        that order, as in the inside-out Fisher-Yates shuffle, and replaces
+        the queued phrase if the place is in the queue. Replaced phrases
+        are queued again by later fill_queues() calls.
+        """
+        if not phrase_ids:
+            return
+        rng = rng or np.random.default_rng()
+        queue = models.QueuedPhrase.__table__
+        used = models.UsedPhrases.__table__
+        user_ids = session.scalars(sqlalchemy.select(queue.c.user_id).distinct()).all()
+        update = (
+            sqlalchemy.update(queue)
+            .where(
+                queue.c.user_id == sqlalchemy.bindparam("b_user_id"),
+                queue.c.position == sqlalchemy.bindparam("b_position"),
+            )
+            .values(phrase_id=sqlalchemy.bindparam("b_phrase_id"))
+        )
+        for begin in range(0, len(user_ids), BATCH_SIZE):
+            batch = user_ids[begin : begin + BATCH_SIZE]
+            positions = collections.defaultdict(list)
+            for user_id, position in session.execute(
+                sqlalchemy.select(queue.c.user_id, queue.c.position)
+                .where(queue.c.user_id.in_(batch))
+                .order_by(queue.c.user_id, queue.c.position)
+            ):
+                positions[user_id].append(position)
+            n_used = dict(
+                session.execute(
+                    sqlalchemy.select(used.c.user_id, sqlalchemy.func.count())
+                    .where(used.c.user_id.in_(batch))
+                    .group_by(used.c.user_id)
+                ).all()
+            )
+            lengths = np.array([len(positions[u]) for u in batch])
+            # phrases the order consisted of before the new ones
+            n_unsent = np.maximum(
+                [n_old_phrases - n_used.get(u, 0) for u in batch], lengths
+            )
+            replaced = {}
+            # bounds the users x phrases matrix
+            step = max(1, MERGE_MATRIX_SIZE // len(batch))
+            for first in range(0, len(phrase_ids), step):
+                n = min(step, len(phrase_ids) - first)
+                places = np.floor(
+                    rng.random((len(batch), n))
+                    * (n_unsent[:, None] + np.arange(first, first + n) + 1)
+                ).astype(np.int64)
+                # in order of users, then phrases, a later phrase replaces
+                # an earlier one
+                for row, column in zip(*np.nonzero(places < lengths[:, None])):
+                    user_id = batch[row]
+                    position = positions[user_id][places[row, column]]
+                    replaced[(user_id, position)] = phrase_ids[first + column]
+            if replaced:
+                session.execute(
+                    update,
+                    [
+                        {"b_user_id": u, "b_position": p, "b_phrase_id": phrase_id}
+                        for (u, p), phrase_id in replaced.items()
+                    ],
+                )
+
+    @tracing.traced
+    def get_next_phrases(
+        self, session, shard: int | None = None, n_shards: int | None = None
+    ) -> BP.BroadcastPlan:
+        """Returns (user_id, chat_id, phrase_id) for every subscriber, the
+        phrase is the head of the user's queue or None if it is empty.
+        Use get_texts() to get texts of the phrases."""
+        if shard is None:
+            rows = session.execute(
+                PhrasesService._get_next_phrases_request(),
+                execution_options=_STREAMED,
+            )
+        else:
+            rows = session.execute(
+                PhrasesService._get_next_phrases_request(sharded=True),
+                {"shard": shard, "n_shards": n_shards},
+                execution_options=_STREAMED,
+            )
+        plan = BP.BroadcastPlan.from_rows(rows)
+        ordinals = self._get_ordinals(session, plan.phrase_ids)
+        plan.phrase_ordinals = [ordinals.get(p) for p in plan.phrase_ids]
+        return plan
+
+    @tracing.traced
+    def mark_sent(
+        self,
+        session,
+        sent: typing.Sequence[tuple[uuid.UUID, uuid.UUID]],
+        *,
+        advance_positions: bool = False,
+        ordinals: typing.Mapping[uuid.UUID, int] | None = None,
+    ):
+        """Records (user_id, phrase_id) as used, in UsedPhrases and SentBitmap,
+        and removes them from queues. advance_positions moves the users to
+        the next phrase of pick_phrases_by_permutation(), the users who got
+        every phrase to the start of the next cycle. ordinals of the phrases,
+        e.g. BroadcastPlan.ordinals(), spare looking them up."""
+        if not sent:
+            return
+        queue = models.QueuedPhrase.__table__
+        user = models.User.__table__
+        if advance_positions:
+            n_phrases = session.scalar(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(models.Phrase)
+            )
+            position = sqlalchemy.func.coalesce(user.c.phrase_position, 0)
+            # a user past the last phrase starts the next cycle
+            wrapped = position >= n_phrases
+            advance = sqlalchemy.update(user).values(
+                phrase_position=sqlalchemy.case((wrapped, 1), else_=position + 1),
+                cycle=sqlalchemy.case(
+                    (wrapped, sqlalchemy.func.coalesce(user.c.cycle, 0) + 1),
+                    else_=user.c.cycle,
+                ),
+            )
+        for begin in range(0, len(sent), SENT_BATCH_SIZE):
+            batch = sent[begin : begin + SENT_BATCH_SIZE]
+            # phrases may be sent again, e.g. by permutations which don't
+            # read the history or in the next cycle
+            session.execute(
+                models.dialect_insert(session)(
+                    models.UsedPhrases
+                ).on_conflict_do_nothing(),
+                [
+                    {"user_id": user_id, "phrase_id": phrase_id}
+                    for user_id, phrase_id in batch
+                ],
+            )
+            session.execute(
+                sqlalchemy.delete(queue).where(
+                    queue.c.user_id == sqlalchemy.bindparam("b_user_id"),
+                    queue.c.phrase_id == sqlalchemy.bindparam("b_phrase_id"),
+                ),
+                [
+                    {"b_user_id": user_id, "b_phrase_id": phrase_id}
+                    for user_id, phrase_id in batch
+                ],
+            )
+            if advance_positions:
+                session.execute(
+                    advance.where(user.c.id == sqlalchemy.bindparam("b_id")),
+                    [{"b_id": user_id} for user_id, _ in batch],
+                )
+        self._set_sent_bits(session, sent, ordinals or {})
+        session.commit()
+
+    @tracing.traced
+    def pick_phrases_by_bitmap(
+        self,
+        session,
+        shard: int | None = None,
+        n_shards: int | None = None,
+        rng: random.Random | None = None,
+    ) -> BP.BroadcastPlan:
+        """Returns (user_id, chat_id, phrase_id) for every subscriber like
+        get_next_phrases(), but picks a random phrase which isn't set in the
+        user's SentBitmap instead of using queues"""
+        rng = rng or random.Random()
+        by_ordinal = self._get_phrases_by_ordinal(session)
+        n_phrases = max(by_ordinal, default=-1) + 1
+        # fmt: off
+        query = (PhrasesService
+            ._subscribers(models.User.id, models.User.chat_id, models.SentBitmap.bits, sharded=shard is not None)
+            .join(models.SentBitmap, models.SentBitmap.user_id == models.User.id, isouter=True))
+        # fmt: on
+        params = {} if shard is None else {"shard": shard, "n_shards": n_shards}
+        plan = BP.BroadcastPlan()
+        for user_id, chat_id, bits in session.execute(
+            query, params, execution_options=_STREAMED
+        ):
+            ordinal = bitset.pick_unset(bits or b"", n_phrases, rng)
+            plan.append(user_id, chat_id, by_ordinal.get(ordinal), ordinal)
+        return plan
+
+    @tracing.traced
+    def plan_phrases_vectorized(
+        self,
+        session,
+        shard: int | None = None,
+        n_shards: int | None = None,
+        rng: np.random.Generator | None = None,
+    ) -> BP.BroadcastPlan:
+        """Same as pick_phrases_by_bitmap(), but bitmaps are unpacked into a
+        users x phrases matrix and phrases are picked with numpy, in chunks
+        of PLAN_CHUNK_SIZE users read from the cursor to bound memory"""
+        rng = rng or np.random.default_rng()
+        by_ordinal = self._get_phrases_by_ordinal(session)
+        n_phrases = max(by_ordinal, default=-1) + 1
+        # phrase indexes of the plan are the ordinals
+        plan = BP.BroadcastPlan(
+            (by_ordinal.get(o) for o in range(n_phrases)), range(n_phrases)
+        )
+        # fmt: off
+        query = (PhrasesService
+            ._subscribers(models.User.id, models.User.chat_id, models.SentBitmap.bits, sharded=shard is not None)
+            .join(models.SentBitmap, models.SentBitmap.user_id == models.User.id, isouter=True))
+        # fmt: on
+        params = {} if shard is None else {"shard": shard, "n_shards": n_shards}
+        rows = session.execute(query, params, execution_options=_STREAMED)
+        n_bytes = (n_phrases + 7) // 8
+        for chunk in rows.partitions():
+            bits = b"".join(
+                (r[2] or b"")[:n_bytes].ljust(n_bytes, b"\0") for r in chunk
+            )
+            sent = np.unpackbits(
+                np.frombuffer(bits, dtype=np.uint8).reshape(len(chunk), n_bytes),
+                axis=1,
+                count=n_phrases,
+                bitorder="little",
+            )
+            # r-th unsent phrase of every user, r is uniform below their count
+            unsent = np.cumsum(sent == 0, axis=1, dtype=np.int32)
+            n_unsent = unsent[:, -1] if n_phrases else np.zeros(len(chunk), np.int32)
+            r = (rng.random(len(chunk)) * n_unsent).astype(np.int32)
+            ordinals = np.argmax(unsent > r[:, None], axis=1) if n_phrases else r
+            ordinals[n_unsent == 0] = BP.NO_PHRASE
+            plan.extend_indexed(
+                (row[0] for row in chunk), (row[1] for row in chunk), ordinals.tolist()
+            )
+        return plan
+
+    @tracing.traced
+    def pick_phrases_by_permutation(
+        self,
+        session,
+        seed: int,
+        shard: int | None = None,
+        n_shards: int | None = None,
+    ) -> BP.BroadcastPlan:
+        """Returns (user_id, chat_id, phrase_id) for every subscriber, the
+        phrase is permutation[User.phrase_position].
+
+        The permutation of a user is derived from (user id, seed, cycle) and
+        is a concatenation of permutations of every batch of ordinals, so
+        phrases added later only extend it. A user past the last phrase gets
+        the first phrase of the next cycle. Doesn't read sent phrases.
+        """
+        by_ordinal = self._get_phrases_by_ordinal(session)
+        batches = session.execute(
+            sqlalchemy.select(models.Phrase.batch_start, sqlalchemy.func.count())
+            .where(models.Phrase.batch_start.is_not(None))
+            .group_by(models.Phrase.batch_start)
+            .order_by(models.Phrase.batch_start)
+        ).all()
+        starts = [start for start, _ in batches]
+        n_phrases = sum(size for _, size in batches)
+        query = PhrasesService._subscribers(
+            models.User.id,
+            models.User.chat_id,
+            models.User.phrase_position,
+            models.User.cycle,
+            sharded=shard is not None,
+        )
+        params = {} if shard is None else {"shard": shard, "n_shards": n_shards}
+        plan = BP.BroadcastPlan()
+        for user_id, chat_id, position, cycle in session.execute(
+            query, params, execution_options=_STREAMED
+        ):
+            position, cycle = position or 0, cycle or 0
+            if not n_phrases:
+                plan.append(user_id, chat_id, None)
+                continue
+            if position >= n_phrases:
+                position, cycle = 0, cycle + 1
+            start, size = batches[bisect.bisect_right(starts, position) - 1]
+            key = permutation.make_key(user_id, seed, cycle, start)
+            ordinal = start + permutation.permute(position - start, size, key)
+            plan.append(user_id, chat_id, by_ordinal[ordinal], ordinal)
+        return plan
+
+    def _get_phrases_by_ordinal(self, session) -> dict[int, uuid.UUID]:
+        # phrases are numbered by add_phrases() and the data migration at
+        # startup, not here, concurrent broadcasts would race on ordinals
+        return {
+            ordinal: id
+            for id, ordinal in session.execute(
+                sqlalchemy.select(models.Phrase.id, models.Phrase.ordinal).where(
+                    models.Phrase.ordinal.is_not(None)
+                )
+            )
+        }
+
+    def _get_ordinals(
+        self, session, phrase_ids: typing.Iterable[uuid.UUID | None]
+    ) -> dict[uuid.UUID, int]:
+        phrase_ids = [p for p in set(phrase_ids) if p is not None]
+        ordinals = {}
+        for begin in range(0, len(phrase_ids), BATCH_SIZE):
+            ordinals.update(
+                session.execute(
+                    sqlalchemy.select(models.Phrase.id, models.Phrase.ordinal).where(
+                        models.Phrase.id.in_(phrase_ids[begin : begin + BATCH_SIZE]),
+                        models.Phrase.ordinal.is_not(None),
+                    )
+                ).all()
+            )
+        return ordinals
+
+    def _set_sent_bits(
+        self,
+        session,
+        sent: typing.Sequence[tuple[uuid.UUID, uuid.UUID]],
+        ordinals: typing.Mapping[uuid.UUID, int],
+    ):
+        missing = {p for _, p in sent if p not in ordinals}
+        if missing:
+            ordinals = {**ordinals, **self._get_ordinals(session, missing)}
+        by_user = collections.defaultdict(list)
+        for user_id, phrase_id in sent:
+            # a phrase inserted bypassing add_phrases is numbered at startup
+            if phrase_id in ordinals:
+                by_user[user_id].append(ordinals[phrase_id])
+        user_ids = list(by_user)
+        bitmap = models.SentBitmap.__table__
+        for begin in range(0, len(user_ids), BATCH_SIZE):
+            batch = user_ids[begin : begin + BATCH_SIZE]
+            bits = dict(
+                session.execute(
+                    sqlalchemy.select(bitmap.c.user_id, bitmap.c.bits).where(
+                        bitmap.c.user_id.in_(batch)
+                    )
+                ).all()
+            )
+            insert = models.dialect_insert(session)(bitmap)
+            session.execute(
+                insert.on_conflict_do_update(
+                    index_elements=[bitmap.c.user_id],
+                    set_={"bits": insert.excluded.bits},
+                ),
+                [
+                    {
+                        "user_id": user_id,
+                        "bits": bitset.set_bits(
+                            bits.get(user_id, b""), by_user[user_id]
+                        ),
+                    }
+                    for user_id in batch
+                ],
+            )
+
+    @staticmethod
+    def _subscribers(*columns, sharded: bool, single_user: bool = False):
+        query = sqlalchemy.select(*columns).where(models.User._send_phrases)
+        if single_user:
+            query = query.where(models.User.id == sqlalchemy.bindparam("user_id"))
+        if sharded:
+            query = query.where(
+                models.User.shard_key % sqlalchemy.bindparam("n_shards")
+                == sqlalchemy.bindparam("shard")
+            )
+        return query
 
     @functools.cache
     @staticmethod
-    def _get_random_phrases_request():
-        # somethind like
-        # SELECT R.id as user_id, Result.phrase_id as phrase_id
-        # FROM ((
-        #   SELECT name, id
-        #   FROM EMPLOYEE
-        #   WHERE dept = 1
-        # ) AS R
-        # LEFT JOIN (
-        #   SELECT U.id AS user_id, PHRASE.id AS phrase_id
+    def _fill_queues_request(sharded: bool = False, single_user: bool = False):
+        # something like
+        # INSERT INTO PHRASE_QUEUE (user_id, phrase_id, position)
+        # SELECT user_id, phrase_id, last + rank
+        # FROM (
+        #   SELECT U.id AS user_id, PHRASE.id AS phrase_id, U.n, U.last,
+        #     row_number() OVER (PARTITION BY U.id ORDER BY random()) AS rank
         #   FROM (
-        #     SELECT name, id
-        #     FROM EMPLOYEE
-        #     WHERE dept = 1
-        #   ) U
+        #     SELECT id,
+        #       (SELECT count(*) FROM PHRASE_QUEUE WHERE user_id = USER.id) AS n,
+        #       (SELECT coalesce(max(position), 0) FROM PHRASE_QUEUE
+        #         WHERE user_id = USER.id) AS last
+        #     FROM USER
+        #     WHERE send_phrases AND n < :size
+        #   ) AS U
         #   CROSS JOIN PHRASE
-        #   EXCEPT
-        #   SELECT user_id, phrase_id
-        #   FROM USED_PHRASE
-        # ) AS L
-        # ON L.user_id = R.id
-        # ) AS Result
-        # order by random()
-        # ) group by user_id;
+        #   WHERE NOT EXISTS (phrase in USED_PHRASE of the user)
+        #     AND NOT EXISTS (phrase in PHRASE_QUEUE of the user)
+        # )
+        # WHERE rank <= :size - n;
+        queue = models.QueuedPhrase.__table__
+        used = models.UsedPhrases.__table__
+        size = sqlalchemy.bindparam("size")
 
         # fmt: off
-        users_to_send_phrases = (sqlalchemy
-            .select(models.User.id, models.User.chat_id)
-            .where(models.User._send_phrases)).subquery()
-        not_yet_sent_phrases = (sqlalchemy
-            .select(models.User.id, models.Phrase.id)
-            .join(models.Phrase, sqlalchemy.literal(True))
-            .except_(sqlalchemy.select(models.UsedPhrases.user_id, models.UsedPhrases.phrase_id))).subquery()
-        not_yet_sent_phrases_for_each_user = (sqlalchemy
-            .select(users_to_send_phrases, aliased(models.Phrase, not_yet_sent_phrases).id)
-            .join(
-                not_yet_sent_phrases, 
-                aliased(models.User, users_to_send_phrases).id == 
-                aliased(models.User, not_yet_sent_phrases).id, 
-                isouter=True)
-            .order_by(sqlalchemy.func.random())).subquery()
-        random_phrase_ids = (sqlalchemy
-            .select(not_yet_sent_phrases_for_each_user)
-            .group_by(aliased(models.User, not_yet_sent_phrases_for_each_user).id)).subquery()
-        phrases = sqlalchemy.select(models.Phrase).subquery()
-        random_phrases = (sqlalchemy
-            .select(random_phrase_ids, aliased(models.Phrase, phrases).text)
+        # correlated subqueries are lookups by the primary key prefix, only
+        # queues of the selected users are read
+        n_queued = (sqlalchemy
+            .select(sqlalchemy.func.count())
+            .where(queue.c.user_id == models.User.id)
+            .scalar_subquery())
+        last = (sqlalchemy
+            .select(sqlalchemy.func.coalesce(sqlalchemy.func.max(queue.c.position), 0))
+            .where(queue.c.user_id == models.User.id)
+            .scalar_subquery())
+        users = (PhrasesService
+            ._subscribers(
+                models.User.id,
+                n_queued.label("n"),
+                last.label("last"),
+                sharded=sharded,
+                single_user=single_user)
+            .where(n_queued < size)).subquery()
+        candidates = (sqlalchemy
+            .select(
+                users.c.id.label("user_id"),
+                models.Phrase.id.label("phrase_id"),
+                users.c.n,
+                users.c.last,
+                sqlalchemy.func.row_number().over(
+                    partition_by=users.c.id,
+                    order_by=sqlalchemy.func.random(),
+                ).label("rank"))
+            .join(models.Phrase, sqlalchemy.true())
+            .where(
+                ~sqlalchemy.exists().where(
+                    used.c.user_id == users.c.id,
+                    used.c.phrase_id == models.Phrase.id),
+                ~sqlalchemy.exists().where(
+                    queue.c.user_id == users.c.id,
+                    queue.c.phrase_id == models.Phrase.id))).subquery()
+        new_entries = (sqlalchemy
+            .select(
+                candidates.c.user_id,
+                candidates.c.phrase_id,
+                candidates.c.last + candidates.c.rank)
+            .where(candidates.c.rank <= size - candidates.c.n))
+        # fmt: on
+        return sqlalchemy.insert(queue).from_select(
+            ["user_id", "phrase_id", "position"], new_entries
+        )
+
+    @functools.cache
+    @staticmethod
+    def _get_next_phrases_request(sharded: bool = False):
+        # SELECT USER.id, USER.chat_id, Q.phrase_id
+        # FROM USER
+        # LEFT JOIN PHRASE_QUEUE AS Q
+        #   ON Q.user_id = USER.id AND Q.position = (
+        #     SELECT min(position) FROM PHRASE_QUEUE WHERE user_id = USER.id)
+        # WHERE USER.send_phrases
+        queue = models.QueuedPhrase.__table__
+        head = queue.alias("head")
+
+        # fmt: off
+        # the head of a queue is found by the primary key, only queues of the
+        # selected users are read
+        head_position = (sqlalchemy
+            .select(sqlalchemy.func.min(head.c.position))
+            .where(head.c.user_id == models.User.id)
+            .scalar_subquery())
+        next_phrases = (PhrasesService
+            ._subscribers(
+                models.User.id,
+                models.User.chat_id,
+                queue.c.phrase_id,
+                sharded=sharded)
             .join(
-                phrases,
-                aliased(models.Phrase, random_phrase_ids).id ==
-                aliased(models.Phrase, phrases).id,
-                isouter=True
-            ))
+                queue,
+                sqlalchemy.and_(
+                    queue.c.user_id == models.User.id,
+                    queue.c.position == head_position),
+                isouter=True))
         # fmt: on
-        return random_phrases
+        return next_phrases
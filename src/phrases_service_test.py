@@ -1,7 +1,16 @@
 import dataclasses
+import random
 from db import models
 import collections
+import bitset
+import numpy as np
+import pytest
 import sqlalchemy
+from sqlalchemy.orm import Session
+import uuid
+import minhash
+import phrase_compression
+import phrases_service
 from phrases_service import PhrasesService
 
 
@@ -18,6 +27,9 @@ def init_database(session, state: DatabaseState):
         phrases.update(user_phrases)
     for phrase in phrases:
         session.add(models.Phrase(text=phrase))
+    session.flush()
+    # numbered at startup
+    models.fill_phrase_ordinals(session.connection())
     session.commit()
 
     users = {user.chat_id: user for user in session.query(models.User).all()}
@@ -26,63 +38,582 @@ def init_database(session, state: DatabaseState):
     for chat_id, _, user_phrases in state.users:
         for used_phrase in user_phrases:
             values.append((users[chat_id].id, phrases[used_phrase].id))
-    session.execute(sqlalchemy.insert(models.UsedPhrases).values(values))
+    if values:
+        session.execute(sqlalchemy.insert(models.UsedPhrases).values(values))
     session.commit()
 
 
-def test_select_random_phrase_for_each_user(testing_db):
-    session = testing_db.session()
+def get_queues(session):
+    queues = collections.defaultdict(list)
+    rows = session.execute(
+        sqlalchemy.select(
+            models.User.chat_id, models.QueuedPhrase.position, models.Phrase.text
+        )
+        .join(models.User, models.User.id == models.QueuedPhrase.user_id)
+        .join(models.Phrase, models.Phrase.id == models.QueuedPhrase.phrase_id)
+        .order_by(models.QueuedPhrase.position)
+    )
+    for chat_id, _, text in rows:
+        queues[chat_id].append(text)
+    return queues
+
+
+def test_phrase_queues(portable_db):
+    session = portable_db.session()
+    service = PhrasesService()
 
     init_database(
         session,
         DatabaseState(
             users=[
-                (100, True, ["p1", "p2", "p3"]),
-                (101, False, ["p1", "p2", "p3"]),
-                (200, True, []),
-                (201, True, ["p1", "p2", "p3", "p4"]),
+                (100, True, ["p1"]),
+                (101, False, []),
+                (200, True, ["p1", "p2", "p3", "p4"]),
+                (300, True, []),
             ],
             additional_phrases=[],
         ),
     )
 
-    for i in range(10):
-        phrases = list(PhrasesService().get_random_phrases(session))
-        user_to_phrase = {p[1]: p[3] for p in phrases}
-        assert len(user_to_phrase) == 3
-        assert user_to_phrase[100] == "p4"
-        assert 101 not in user_to_phrase
-        assert user_to_phrase[200] in ["p1", "p2", "p3", "p4"]
-        assert user_to_phrase[201] is None
+    assert service.fill_queues(session, 2) == 4
+    queues = get_queues(session)
+    assert set(queues) == {100, 300}
+    assert len(queues[100]) == 2 and set(queues[100]) <= {"p2", "p3", "p4"}
+    assert len(queues[300]) == 2 and len(set(queues[300])) == 2
+    # queues are full
+    assert service.fill_queues(session, 2) == 0
+
+    next_phrases = {p[1]: p for p in service.get_next_phrases(session)}
+    assert set(next_phrases) == {100, 200, 300}
+    texts = service.get_texts(session, (p[2] for p in next_phrases.values()))
+    assert texts[next_phrases[100][2]] == queues[100][0]
+    assert next_phrases[200][2] is None
+    assert texts[next_phrases[300][2]] == queues[300][0]
+
+    service.mark_sent(
+        session, [(p[0], p[2]) for p in next_phrases.values() if p[2] is not None]
+    )
+    assert get_queues(session) == {100: queues[100][1:], 300: queues[300][1:]}
+    used = {(p.user_id, p.phrase_id) for p in session.query(models.UsedPhrases)}
+    assert (next_phrases[100][0], next_phrases[100][2]) in used
+
+    # a new phrase may replace a queued one, then free positions are filled
+    service.add_phrases(session, ["p5"])
+    merged = get_queues(session)
+    assert set(merged) == {100, 300}
+    for chat_id in (100, 300):
+        assert merged[chat_id] in ([queues[chat_id][1]], ["p5"])
+    assert service.fill_queues(session, 2) == 3
+    queues_after = get_queues(session)
+    assert queues_after[100][0] == merged[100][0]
+    assert queues_after[200] == ["p5"]
+    assert queues_after[300][0] == merged[300][0]
+    next_phrases = service.get_next_phrases(session)
+    texts = service.get_texts(session, (p[2] for p in next_phrases))
+    assert {p[1]: texts[p[2]] for p in next_phrases} == {
+        100: merged[100][0],
+        200: "p5",
+        300: merged[300][0],
+    }
+
+
+def test_merge_new_phrases_into_queues(testing_db):
+    session = testing_db.session()
+    service = PhrasesService()
+    n_users = 200
+    init_database(
+        session,
+        DatabaseState(
+            users=[(chat_id, True, []) for chat_id in range(n_users)],
+            additional_phrases=[f"old{i}" for i in range(8)],
+        ),
+    )
+    assert service.fill_queues(session, 4) == 4 * n_users
+
+    new_phrases = [f"new{i}" for i in range(8)]
+    service.add_phrases(session, new_phrases, rng=np.random.default_rng(1))
+    queues = get_queues(session)
+    assert all(len(set(queue)) == 4 for queue in queues.values())
+    # the queue is the beginning of a random order of 16 phrases, half of
+    # them are new, at any position
+    by_position = [
+        sum(queue[i] in new_phrases for queue in queues.values()) for i in range(4)
+    ]
+    assert all(abs(n - n_users / 2) < n_users / 8 for n in by_position), by_position
+    counts = collections.Counter(
+        phrase for queue in queues.values() for phrase in queue
+    )
+    assert all(abs(counts[p] - n_users / 4) < n_users / 8 for p in new_phrases)
+
+
+def test_phrase_queues_for_shard(portable_db):
+    session = portable_db.session()
+    service = PhrasesService()
+
+    init_database(
+        session,
+        DatabaseState(
+            users=[(chat_id, True, []) for chat_id in range(20)],
+            additional_phrases=["p1"],
+        ),
+    )
+
+    n_shards = 3
+    chat_ids = []
+    for shard in range(n_shards):
+        n_queued = service.fill_queues(session, 1, shard, n_shards)
+        phrases = service.get_next_phrases(session, shard, n_shards)
+        assert n_queued == len(phrases)
+        texts = service.get_texts(session, (p[2] for p in phrases))
+        assert all(texts[p[2]] == "p1" for p in phrases)
+        chat_ids.extend(p[1] for p in phrases)
+    assert sorted(chat_ids) == list(range(20))
+    assert sum(map(len, get_queues(session).values())) == 20
+
+
+def test_get_texts(testing_db):
+    session = testing_db.session()
+    service = PhrasesService()
+    service.add_phrases(session, ["p1", "p2"])
+    ids = {p.text: p.id for p in service.get_phrases(session)}
+
+    statements = []
+    sqlalchemy.event.listen(
+        testing_db.engine,
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    assert service.get_texts(session, [ids["p1"], None]) == {ids["p1"]: "p1"}
+    assert len(statements) == 1
+    assert service.get_texts(session, ids.values()) == {
+        ids["p1"]: "p1",
+        ids["p2"]: "p2",
+    }
+    assert len(statements) == 2
+    assert service.get_texts(session, ids.values()) == {
+        ids["p1"]: "p1",
+        ids["p2"]: "p2",
+    }
+    assert len(statements) == 2
+    assert service.get_texts(session, [uuid.uuid4()]) == {}
+
+
+def test_add_long_phrases(testing_db):
+    session = testing_db.session()
+    service = PhrasesService()
+    long_phrase = "\n\n".join(["a" * 3000, "b" * 3000])
+    assert (
+        service.add_phrases(session, [" p1\r\n", "p1", "", None, long_phrase]).added
+        == 2
+    )
+    assert service.add_phrases(session, ["x" * 100001]).added == 0
+    ids = {p.text: p.id for p in service.get_phrases(session)}
+    assert set(ids) == {"p1", long_phrase}
+    assert session.query(models.PhrasePart).count() == 2
+
+    assert service.get_messages(session, ids.values()) == {
+        ids["p1"]: ("p1",),
+        ids[long_phrase]: ("a" * 3000, "b" * 3000),
+    }
+
+    # startup doesn't scan phrases once the parts are introduced
+    session.add(models.Phrase(text="c " * 3000))
+    session.commit()
+    models.run_data_migrations(testing_db.engine)
+    assert session.query(models.PhrasePart).count() == 2
+
 
+def test_split_existing_long_phrases(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'iv.db'}"
+    engine = models.init_db(db_url)
+    with Session(engine) as session:
+        session.add_all([models.Phrase(text="c " * 3000), models.Phrase(text="p")])
+        session.commit()
+    # phrases inserted before the parts were introduced
+    models.PhrasePart.__table__.drop(engine)
+    engine.dispose()
+    for _ in range(2):
+        engine = models.init_db(db_url)
+        with Session(engine) as session:
+            phrase = session.query(models.Phrase).filter_by(text="c " * 3000).one()
+            parts = PhrasesService().get_messages(session, [phrase.id])[phrase.id]
+            assert len(parts) == 2
+            assert session.query(models.PhrasePart).count() == 2
+        engine.dispose()
 
-def test_select_random_phrase_uniform_distribution(testing_db):
+
+def test_compressed_phrases(testing_db):
     session = testing_db.session()
+    PhrasesService().add_phrases(session, ["plain1", "plain2"])
+    service = PhrasesService(compression=True)
+    long_phrase = "long " * 2000
+    assert service.add_phrases(session, ["plain1", "new", long_phrase]).added == 2
+    stored = {p.text: p for p in service.get_phrases(session)}
+    assert set(stored) == {
+        "plain1",
+        "plain2",
+        phrase_compression.key("new"),
+        phrase_compression.key(long_phrase.strip()),
+    }
+    new = stored[phrase_compression.key("new")]
+    long_id = stored[phrase_compression.key(long_phrase.strip())].id
+    assert session.query(models.PhrasePart).count() == 0
+
+    # a new service doesn't have the texts nor the dictionary cached
+    service = PhrasesService(compression=True)
+    assert service.get_texts(session, [new.id, stored["plain1"].id]) == {
+        new.id: "new",
+        stored["plain1"].id: "plain1",
+    }
+    assert len(service.get_messages(session, [long_id])[long_id]) == 3
+
+    # existing phrases are compressed in batches
+    assert service.migrate_storage(session, 1) == 1
+    assert service.migrate_storage(session, 10) == 1
+    assert service.migrate_storage(session, 10) == 0
+    assert all(p.compressed is not None for p in service.get_phrases(session))
+    # duplicates of compressed phrases are found without decompressing
+    assert PhrasesService().add_phrases(session, ["plain1", "new"]).added == 0
+
+    service = PhrasesService()
+    assert service.migrate_storage(session, 10) == 4
+    assert sorted(p.text for p in service.get_phrases(session)) == sorted(
+        ["plain1", "plain2", "new", long_phrase.strip()]
+    )
+    assert session.query(models.PhrasePart).count() == 3
+
+
+def test_find_phrases(portable_db):
+    session = portable_db.session()
+    # added before the index, found after the migration
+    session.add(models.Phrase(text="Old news about Time"))
+    session.commit()
+    models.run_data_migrations(portable_db.engine)
+    service = PhrasesService()
+    service.add_phrases(session, ["Time is money", "No time to lose", "Café time"])
+    PhrasesService(compression=True).add_phrases(session, ["Compressed time"])
+
+    def find(query, limit=10, offset=0):
+        return [text for _, text in service.find_phrases(session, query, limit, offset)]
+
+    found = find("time")
+    # newer phrases go first, phrases added together are in any order
+    assert found[0] == "Compressed time"
+    assert set(found[1:4]) == {"Time is money", "No time to lose", "Café time"}
+    assert found[4] == "Old news about Time"
+    assert find("TIME money") == ["Time is money"]
+    assert find('"time to"') == ["No time to lose"]
+    assert find("café") == ["Café time"]
+    if portable_db.engine.dialect.name == "sqlite":
+        # only the sqlite index removes diacritics
+        assert find("cafe") == ["Café time"]
+    assert find("compressed") == ["Compressed time"]
+    assert find("tim") == []
+    # FTS5 syntax is searched as words
+    assert find('"money" * -(') == ["Time is money"]
+    assert find("time OR lose") == []
+    assert find('"" *') == []
+    assert len(find("time", limit=2)) == 2
+    assert find("time", limit=10, offset=3) == find("time")[3:]
+
+
+def test_near_duplicates(testing_db):
+    session = testing_db.session()
+    service = PhrasesService()
+    quote = "Life is what happens to you while you are busy making other plans"
+    # added before signatures were introduced
+    session.add(models.Phrase(text=quote))
+    session.commit()
+    models.run_data_migrations(testing_db.engine)
+    assert session.query(models.PhraseSignature).count() == 1
+    assert 0 < session.query(models.PhraseBucket).count() <= minhash.BANDS
+
+    other = "The only thing we have to fear is fear itself"
+    result = service.add_phrases(
+        session,
+        [
+            f"«{quote}.»",
+            other,
+            quote.replace("busy", "so busy"),
+            other.upper() + "!",
+            "A completely different quote about silence",
+        ],
+    )
+    assert result.added == 2
+    assert sorted(result.near_duplicates) == sorted(
+        [
+            (f"«{quote}.»", quote),
+            (quote.replace("busy", "so busy"), quote),
+            (other.upper() + "!", other),
+        ]
+    )
+    assert {p.text for p in service.get_phrases(session)} == {
+        quote,
+        other,
+        "A completely different quote about silence",
+    }
+    assert session.query(models.PhraseSignature).count() == 3
+
+    # compressed phrases are compared by their texts too
+    compressed = "Compressed wisdom about the sea and the sky"
+    PhrasesService(compression=True).add_phrases(session, [compressed])
+    result = service.add_phrases(session, [compressed.lower() + "!"])
+    assert result.near_duplicates == [(compressed.lower() + "!", compressed)]
+
+
+PICKERS = {
+    "bitmap": (PhrasesService.pick_phrases_by_bitmap, random.Random),
+    "vectorized": (PhrasesService.plan_phrases_vectorized, np.random.default_rng),
+}
+
+
+@pytest.mark.parametrize("picker", sorted(PICKERS))
+def test_pick_phrases_by_bitmap(portable_db, picker):
+    session = portable_db.session()
+    service = PhrasesService()
+    pick, create_rng = PICKERS[picker]
 
     init_database(
         session,
         DatabaseState(
             users=[
-                (-1, False, ["p1", "p2", "p3"]),
-                (100, True, ["p1", "p2"]),
-                (200, True, ["p3", "p4"]),
+                (100, True, []),
+                (101, False, []),
+                (200, True, []),
             ],
+            additional_phrases=["p1", "p2", "p3"],
+        ),
+    )
+    rng = create_rng(1)
+    sent = collections.defaultdict(list)
+    for _ in range(4):
+        phrases = pick(service, session, rng=rng)
+        assert sorted(p[1] for p in phrases) == [100, 200]
+        texts = service.get_texts(session, (p[2] for p in phrases))
+        for _, chat_id, phrase_id in phrases:
+            sent[chat_id].append(texts.get(phrase_id))
+        service.mark_sent(session, [(p[0], p[2]) for p in phrases if p[2]])
+    for chat_id in (100, 200):
+        assert sorted(sent[chat_id][:3]) == ["p1", "p2", "p3"]
+        assert sent[chat_id][3] is None
+    assert session.query(models.UsedPhrases).count() == 6
+
+    # phrases added later are picked up
+    service.add_phrases(session, ["p4"])
+    phrases = pick(service, session, rng=rng)
+    texts = service.get_texts(session, (p[2] for p in phrases))
+    assert [texts[p[2]] for p in phrases] == ["p4", "p4"]
+
+
+def test_plan_ordinals(portable_db):
+    session = portable_db.session()
+    service = PhrasesService()
+    init_database(
+        session,
+        DatabaseState(users=[(100, True, [])], additional_phrases=["p1", "p2"]),
+    )
+    service.fill_queues(session, 2)
+    # numbered at startup only, broadcasts don't write ordinals
+    session.add(models.Phrase(text="unnumbered"))
+    session.commit()
+    ordinals = dict(
+        session.execute(
+            sqlalchemy.select(models.Phrase.id, models.Phrase.ordinal)
+        ).all()
+    )
+    plans = [
+        service.get_next_phrases(session),
+        service.pick_phrases_by_bitmap(session),
+        service.plan_phrases_vectorized(session),
+        service.pick_phrases_by_permutation(session, seed=1),
+    ]
+    for plan in plans:
+        user_id, _, phrase_id = list(plan)[0]
+        assert plan.ordinals()[phrase_id] == ordinals[phrase_id] is not None
+    assert (
+        session.scalar(
+            sqlalchemy.select(models.Phrase.ordinal).where(
+                models.Phrase.text == "unnumbered"
+            )
+        )
+        is None
+    )
+    plan = plans[0]
+    service.mark_sent(session, [(user_id, phrase_id)], ordinals=plan.ordinals())
+    bits = session.get(models.SentBitmap, user_id).bits
+    assert bitset.count(bits) == 1
+
+
+@pytest.mark.parametrize("picker", sorted(PICKERS))
+def test_pick_phrases_by_bitmap_for_shard(portable_db, picker):
+    session = portable_db.session()
+    service = PhrasesService()
+    pick, _ = PICKERS[picker]
+
+    init_database(
+        session,
+        DatabaseState(
+            users=[(chat_id, True, ["p1"]) for chat_id in range(20)],
+            additional_phrases=["p2"],
+        ),
+    )
+    # bitmaps of UsedPhrases inserted above
+    models.run_data_migrations(portable_db.engine)
+
+    n_shards = 3
+    chat_ids = []
+    for shard in range(n_shards):
+        phrases = pick(service, session, shard, n_shards)
+        texts = service.get_texts(session, (p[2] for p in phrases))
+        assert all(texts[p[2]] == "p2" for p in phrases)
+        chat_ids.extend(p[1] for p in phrases)
+    assert sorted(chat_ids) == list(range(20))
+
+
+@pytest.mark.parametrize("picker", sorted(PICKERS))
+def test_pick_phrases_by_bitmap_uniform_distribution(testing_db, picker):
+    session = testing_db.session()
+    service = PhrasesService()
+    pick, create_rng = PICKERS[picker]
+
+    init_database(
+        session,
+        DatabaseState(
+            users=[(100, True, ["p1", "p2"]), (200, True, ["p3", "p4"])],
             additional_phrases=["p5"],
         ),
     )
+    models.run_data_migrations(testing_db.engine)
 
-    freq = collections.defaultdict(lambda: 0)
+    rng = create_rng(2)
+    freq = collections.Counter()
     n_iters = 1000
     for _ in range(n_iters):
-        phrases = list(PhrasesService().get_random_phrases(session))
-        user_to_phrase = {p[1]: p[3] for p in phrases}
-        assert len(user_to_phrase) == 2
-        assert -1 not in user_to_phrase
-        assert user_to_phrase[100] in {"p3", "p4", "p5"}
-        assert user_to_phrase[200] in {"p1", "p2", "p5"}
-        for user_phrase in user_to_phrase.items():
-            freq[user_phrase] += 1
-
-    freq = {k: v / n_iters for k, v in freq.items()}
-    for phrase_freq in freq.values():
-        assert abs(phrase_freq - 1 / 3) < 0.05
+        phrases = pick(service, session, rng=rng)
+        texts = service.get_texts(session, (p[2] for p in phrases))
+        freq.update((p[1], texts[p[2]]) for p in phrases)
+    assert set(freq) == {
+        (100, "p3"),
+        (100, "p4"),
+        (100, "p5"),
+        (200, "p1"),
+        (200, "p2"),
+        (200, "p5"),
+    }
+    for n in freq.values():
+        assert abs(n / n_iters - 1 / 3) < 0.05
+
+
+def test_plan_phrases_vectorized_chunks(testing_db, monkeypatch):
+    session = testing_db.session()
+    service = PhrasesService()
+    monkeypatch.setattr(phrases_service, "PLAN_CHUNK_SIZE", 3)
+
+    init_database(
+        session,
+        DatabaseState(
+            users=[
+                (chat_id, True, ["p1"] if chat_id % 2 else []) for chat_id in range(10)
+            ],
+            additional_phrases=["p2"],
+        ),
+    )
+    models.run_data_migrations(testing_db.engine)
+    service.add_phrases(session, [f"new{i}" for i in range(20)])
+
+    phrases = service.plan_phrases_vectorized(session)
+    assert sorted(p[1] for p in phrases) == list(range(10))
+    texts = service.get_texts(session, (p[2] for p in phrases))
+    for _, chat_id, phrase_id in phrases:
+        assert not (chat_id % 2 and texts[phrase_id] == "p1")
+
+
+def send_by_permutation(service, session, seed, n_broadcasts):
+    sent = collections.defaultdict(list)
+    for _ in range(n_broadcasts):
+        phrases = service.pick_phrases_by_permutation(session, seed)
+        texts = service.get_texts(session, (p[2] for p in phrases))
+        for _, chat_id, phrase_id in phrases:
+            sent[chat_id].append(texts.get(phrase_id))
+        service.mark_sent(
+            session, [(p[0], p[2]) for p in phrases if p[2]], advance_positions=True
+        )
+    return sent
+
+
+def test_pick_phrases_by_permutation(portable_db):
+    session = portable_db.session()
+    service = PhrasesService()
+    init_database(
+        session,
+        DatabaseState(
+            users=[(chat_id, chat_id != 0, []) for chat_id in range(10)],
+            additional_phrases=[f"p{i}" for i in range(5)],
+        ),
+    )
+    positions = session.execute(
+        sqlalchemy.select(models.User.chat_id, models.User.phrase_position)
+    ).all()
+    assert all(position is None for _, position in positions)
+
+    planned = {p[1]: p[2] for p in service.pick_phrases_by_permutation(session, seed=1)}
+    assert set(planned) == set(range(1, 10))
+    # stable for the same seed
+    assert planned == {
+        p[1]: p[2] for p in PhrasesService().pick_phrases_by_permutation(session, 1)
+    }
+    assert planned != {
+        p[1]: p[2] for p in service.pick_phrases_by_permutation(session, seed=2)
+    }
+
+    first = send_by_permutation(service, session, 1, 3)
+    service.add_phrases(session, ["new1", "new2"])
+    rest = send_by_permutation(service, session, 1, 5)
+    orders = set()
+    for chat_id in range(1, 10):
+        sequence = first[chat_id] + rest[chat_id]
+        orders.add(tuple(sequence))
+        # old phrases first, new phrases don't reshuffle them
+        assert sorted(sequence[:5]) == [f"p{i}" for i in range(5)]
+        assert sorted(sequence[5:7]) == ["new1", "new2"]
+        # the next cycle starts
+        assert sequence[7] is not None
+    assert len(orders) > 1
+    assert 0 not in first
+    positions = session.execute(
+        sqlalchemy.select(
+            models.User.chat_id, models.User.phrase_position, models.User.cycle
+        )
+    ).all()
+    assert sorted(positions) == [(0, None, None)] + [
+        (chat_id, 1, 1) for chat_id in range(1, 10)
+    ]
+    assert session.query(models.UsedPhrases).count() == 9 * 7
+
+
+def test_permutation_after_history(portable_db):
+    session = portable_db.session()
+    service = PhrasesService()
+    # sent by queues before
+    init_database(
+        session,
+        DatabaseState(
+            users=[(chat_id, True, ["p0", "p1"]) for chat_id in range(3)],
+            additional_phrases=["p2"],
+        ),
+    )
+    sent = send_by_permutation(service, session, 1, 4)
+    for chat_id in range(3):
+        assert sorted(sent[chat_id][:3]) == ["p0", "p1", "p2"]
+        assert sent[chat_id][3] is not None
+    assert session.query(models.UsedPhrases).count() == 3 * 3
+    bits = session.execute(sqlalchemy.select(models.SentBitmap.bits)).scalars()
+    assert [bitset.count(b) for b in bits] == [3] * 3
+
+    # the history expired, the users past the last phrase start a new cycle
+    session.execute(sqlalchemy.delete(models.UsedPhrases))
+    session.execute(sqlalchemy.update(models.User).values(phrase_position=3))
+    session.commit()
+    sent = send_by_permutation(service, session, 1, 3)
+    for chat_id in range(3):
+        assert sorted(sent[chat_id]) == ["p0", "p1", "p2"]
@@ -0,0 +1,75 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+
+def _frame_name(code) -> str:
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+class Profile:
+    def __init__(self, stacks: collections.Counter, n_samples: int, duration: float):
+        # root first stacks of function names -> number of samples
+        self.stacks = stacks
+        self.n_samples = n_samples
+        self.duration = duration
+
+    def collapsed(self) -> str:
+        """Stacks in collapsed format, e.g. for flamegraph.pl or speedscope"""
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.items()
+        )
+
+    def summary(self, top: int = 20) -> str:
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        n = max(self.n_samples, 1)
+        lines = [
+            f"{self.n_samples} samples in {self.duration:.1f}s",
+            "",
+            f"Top {top} by own time:",
+        ]
+        lines += [f"{c / n:6.1%} {name}" for name, c in own.most_common(top)]
+        lines += ["", f"Top {top} by total time:"]
+        lines += [f"{c / n:6.1%} {name}" for name, c in total.most_common(top)]
+        return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """Periodically samples stacks of all threads.
+
+    Nothing is installed into the interpreter, so there is no overhead
+    when the profiler isn't running.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self._interval = interval
+
+    def run(self, duration: float) -> Profile:
+        stacks = collections.Counter()
+        n_samples = 0
+        own_thread = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + duration
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(f"thread {names.get(thread_id, thread_id)}")
+                stacks[tuple(reversed(stack))] += 1
+                n_samples += 1
+            time.sleep(self._interval)
+        return Profile(stacks, n_samples, time.perf_counter() - start)
@@ -0,0 +1,47 @@
+import collections
+import threading
+import time
+
+import profiler
+
+
+def _busy_loop(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler():
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy_loop, args=(stop,), name="Busy")
+    thread.start()
+    try:
+        profile = profiler.SamplingProfiler(interval=0.001).run(0.2)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert profile.n_samples > 0
+    assert profile.duration >= 0.2
+    busy = [s for s in profile.stacks if s[0] == "thread Busy"]
+    assert busy
+    assert all(any(f.startswith("_busy_loop ") for f in s) for s in busy)
+    own_name = f"thread {threading.current_thread().name}"
+    assert all(s[0] != own_name for s in profile.stacks)
+
+    collapsed = profile.collapsed()
+    lines = collapsed.splitlines()
+    assert len(lines) == len(profile.stacks)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profile.n_samples
+    assert any(line.startswith("thread Busy;") for line in lines)
+
+    summary = profile.summary(top=5)
+    assert summary.startswith(f"{profile.n_samples} samples in ")
+    assert "Top 5 by own time:" in summary
+    assert "Top 5 by total time:" in summary
+    assert "_busy_loop" in summary
+
+
+def test_empty_profile():
+    profile = profiler.Profile(collections.Counter(), 0, 0.0)
+    assert profile.collapsed() == ""
+    assert "0 samples" in profile.summary()
@@ -0,0 +1,205 @@
+import csv
+import datetime as dt
+import gzip
+import logging
+import pathlib
+import uuid
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+import bitset
+from db import models
+
+logger = logging.getLogger(__name__)
+
+# PRAGMA auto_vacuum value
+INCREMENTAL_AUTO_VACUUM = 2
+
+
+class HistoryArchive:
+    """Appends archived UsedPhrases rows to gzipped CSV files, one per month
+    of archiving. Every write adds a gzip member, gzip.open() reads them all."""
+
+    COLUMNS = ["user_id", "phrase_id", "time_created", "reason"]
+
+    def __init__(self, directory: pathlib.Path):
+        self._directory = directory
+
+    def path(self, time: dt.datetime) -> pathlib.Path:
+        return self._directory / f"used_phrases-{time:%Y-%m}.csv.gz"
+
+    def write(self, rows, reason: str) -> pathlib.Path:
+        path = self.path(dt.datetime.now(dt.UTC))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        is_new = not path.exists()
+        with gzip.open(path, "at", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(self.COLUMNS)
+            for user_id, phrase_id, time_created in rows:
+                writer.writerow([user_id, phrase_id, time_created, reason])
+        return path
+
+    @staticmethod
+    def read(path: pathlib.Path) -> list[dict]:
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            return list(csv.DictReader(f))
+
+
+class RetentionService:
+    """Moves UsedPhrases rows out of the database.
+
+    Rows are archived before they are deleted, and the sent bitmaps are
+    updated, so that selections using bitmaps see the same history.
+    """
+
+    def expire_history(
+        self,
+        session: Session,
+        before: dt.datetime,
+        archive: HistoryArchive,
+        limit: int,
+    ) -> int:
+        """Archives up to limit rows created before the time, the phrases
+        may be sent to the users again"""
+        used = models.UsedPhrases.__table__
+        rows = session.execute(
+            sqlalchemy.select(used.c.user_id, used.c.phrase_id, used.c.time_created)
+            .where(used.c.time_created < before)
+            .order_by(used.c.time_created)
+            .limit(limit)
+        ).all()
+        if not rows:
+            return 0
+        archive.write(rows, "expired")
+        session.execute(
+            sqlalchemy.delete(used).where(
+                used.c.user_id == sqlalchemy.bindparam("b_user_id"),
+                used.c.phrase_id == sqlalchemy.bindparam("b_phrase_id"),
+            ),
+            [{"b_user_id": u, "b_phrase_id": p} for u, p, _ in rows],
+        )
+        self._clear_sent_bits(session, [(u, p) for u, p, _ in rows])
+        session.commit()
+        return len(rows)
+
+    def compact_cycles(
+        self, session: Session, archive: HistoryArchive, limit: int
+    ) -> int:
+        """Archives the history of up to limit users who got every phrase
+        and starts a new cycle for them, returns number of such users"""
+        used = models.UsedPhrases.__table__
+        n_phrases = session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count()).select_from(models.Phrase)
+        )
+        if not n_phrases:
+            return 0
+        user_ids = session.scalars(
+            sqlalchemy.select(used.c.user_id)
+            .group_by(used.c.user_id)
+            .having(sqlalchemy.func.count() >= n_phrases)
+            .limit(limit)
+        ).all()
+        if not user_ids:
+            return 0
+        rows = session.execute(
+            sqlalchemy.select(
+                used.c.user_id, used.c.phrase_id, used.c.time_created
+            ).where(used.c.user_id.in_(user_ids))
+        ).all()
+        archive.write(rows, "cycle")
+        session.execute(sqlalchemy.delete(used).where(used.c.user_id.in_(user_ids)))
+        session.execute(
+            sqlalchemy.delete(models.SentBitmap).where(
+                models.SentBitmap.user_id.in_(user_ids)
+            )
+        )
+        session.execute(
+            sqlalchemy.update(models.User)
+            .where(models.User.id.in_(user_ids))
+            .values(
+                cycle=sqlalchemy.func.coalesce(models.User.cycle, 0) + 1,
+                phrase_position=0,
+            )
+        )
+        session.commit()
+        return len(user_ids)
+
+    def vacuum(self, engine: sqlalchemy.Engine, pages: int):
+        """Returns free pages to the OS and refreshes planner statistics,
+        cheap enough to run between broadcasts"""
+        with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as connection:
+            if engine.dialect.name == "sqlite":
+                if _auto_vacuum(connection) == INCREMENTAL_AUTO_VACUUM:
+                    connection.exec_driver_sql(
+                        f"PRAGMA incremental_vacuum({int(pages)})"
+                    )
+                else:
+                    logger.info(
+                        "Incremental vacuum is off, enable it with "
+                        "scripts/controller.py vacuum while the bot is stopped"
+                    )
+                connection.exec_driver_sql("PRAGMA optimize")
+            elif engine.dialect.name == "postgresql":
+                connection.exec_driver_sql("VACUUM (ANALYZE) used_phrases")
+
+    def enable_incremental_vacuum(self, engine: sqlalchemy.Engine) -> bool:
+        """Switches an sqlite database created before incremental vacuum,
+        returns whether it was switched. The full VACUUM rewrites the whole
+        database under an exclusive lock, run it offline."""
+        if engine.dialect.name != "sqlite":
+            return False
+        with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as connection:
+            if _auto_vacuum(connection) == INCREMENTAL_AUTO_VACUUM:
+                return False
+            logger.info("Switching database to incremental auto_vacuum")
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+        return True
+
+    def _clear_sent_bits(
+        self, session: Session, rows: list[tuple[uuid.UUID, uuid.UUID]]
+    ):
+        phrase_ids = list({phrase_id for _, phrase_id in rows})
+        ordinals = dict(
+            session.execute(
+                sqlalchemy.select(models.Phrase.id, models.Phrase.ordinal).where(
+                    models.Phrase.id.in_(phrase_ids)
+                )
+            ).all()
+        )
+        by_user = {}
+        for user_id, phrase_id in rows:
+            if ordinals.get(phrase_id) is not None:
+                by_user.setdefault(user_id, []).append(ordinals[phrase_id])
+        bitmap = models.SentBitmap.__table__
+        bitmaps = session.execute(
+            sqlalchemy.select(bitmap.c.user_id, bitmap.c.bits).where(
+                bitmap.c.user_id.in_(list(by_user))
+            )
+        ).all()
+        if bitmaps:
+            session.execute(
+                sqlalchemy.update(bitmap)
+                .where(bitmap.c.user_id == sqlalchemy.bindparam("b_user_id"))
+                .values(bits=sqlalchemy.bindparam("bits")),
+                [
+                    {
+                        "b_user_id": user_id,
+                        "bits": bitset.clear_bits(bits, by_user[user_id]),
+                    }
+                    for user_id, bits in bitmaps
+                ],
+            )
+
+
+def _auto_vacuum(connection) -> int:
+    # the pragma answers from the connection's cached header, a read
+    # refreshes it after another connection's VACUUM
+    connection.exec_driver_sql("SELECT 1 FROM sqlite_master LIMIT 1").all()
+    return connection.exec_driver_sql("PRAGMA auto_vacuum").scalar()
@@ -0,0 +1,134 @@
+import datetime as dt
+import sqlite3
+
+import sqlalchemy
+
+import bitset
+from db import models
+from phrases_service import PhrasesService
+import retention_service as RS
+
+
+def add_history(session, chat_ids, texts, time_created):
+    users = [models.User(chat_id=chat_id, _send_phrases=True) for chat_id in chat_ids]
+    session.add_all(users)
+    session.commit()
+    service = PhrasesService()
+    service.add_phrases(session, texts)
+    phrases = {p.text: p.id for p in service.get_phrases(session)}
+    service.mark_sent(
+        session,
+        [(u.id, phrases[t]) for u in users for t in texts],
+        advance_positions=True,
+    )
+    session.execute(
+        sqlalchemy.update(models.UsedPhrases)
+        .where(models.UsedPhrases.phrase_id.in_([phrases[t] for t in texts]))
+        .values(time_created=time_created)
+    )
+    session.commit()
+    return users, phrases
+
+
+def test_expire_history(testing_db, tmp_path):
+    session = testing_db.session()
+    now = dt.datetime.now(dt.UTC)
+    users, phrases = add_history(
+        session, [1, 2], ["old1", "old2"], now - dt.timedelta(days=40)
+    )
+    _, phrases = add_history(session, [3], ["new"], now)
+    phrases = {p.text: p for p in PhrasesService().get_phrases(session)}
+
+    archive = RS.HistoryArchive(tmp_path)
+    service = RS.RetentionService()
+    before = now - dt.timedelta(days=30)
+    assert service.expire_history(session, before, archive, limit=3) == 3
+    assert service.expire_history(session, before, archive, limit=3) == 1
+    assert service.expire_history(session, before, archive, limit=3) == 0
+
+    remaining = (
+        session.execute(sqlalchemy.select(models.UsedPhrases.phrase_id)).scalars().all()
+    )
+    assert remaining == [phrases["new"].id]
+    rows = RS.HistoryArchive.read(archive.path(dt.datetime.now(dt.UTC)))
+    assert len(rows) == 4
+    assert {r["reason"] for r in rows} == {"expired"}
+    assert {(r["user_id"], r["phrase_id"]) for r in rows} == {
+        (str(u.id), str(phrases[t].id)) for u in users for t in ["old1", "old2"]
+    }
+    # expired phrases may be picked again
+    bits = dict(
+        session.execute(
+            sqlalchemy.select(models.SentBitmap.user_id, models.SentBitmap.bits)
+        ).all()
+    )
+    for user in users:
+        assert bitset.count(bits[user.id]) == 0
+    assert bitset.count(bits[_user_id(session, 3)]) == 1
+
+
+def _user_id(session, chat_id):
+    return session.scalar(
+        sqlalchemy.select(models.User.id).where(models.User.chat_id == chat_id)
+    )
+
+
+def test_compact_cycles(testing_db, tmp_path):
+    session = testing_db.session()
+    now = dt.datetime.now(dt.UTC)
+    add_history(session, [1, 2], ["p1", "p2"], now)
+    add_history(session, [3], ["p3"], now)
+    # 1 and 2 didn't get p3, 3 got p3 only
+    archive = RS.HistoryArchive(tmp_path)
+    service = RS.RetentionService()
+    assert service.compact_cycles(session, archive, limit=10) == 0
+
+    user = session.scalar(
+        sqlalchemy.select(models.User).where(models.User.chat_id == 1)
+    )
+    p3 = session.scalar(
+        sqlalchemy.select(models.Phrase.id).where(models.Phrase.text == "p3")
+    )
+    PhrasesService().mark_sent(session, [(user.id, p3)], advance_positions=True)
+    assert service.compact_cycles(session, archive, limit=10) == 1
+
+    session.refresh(user)
+    assert user.cycle == 1
+    assert user.phrase_position == 0
+    used = (
+        session.execute(sqlalchemy.select(models.UsedPhrases.user_id)).scalars().all()
+    )
+    assert user.id not in used and len(used) == 3
+    assert session.get(models.SentBitmap, user.id) is None
+    rows = RS.HistoryArchive.read(archive.path(dt.datetime.now(dt.UTC)))
+    assert len(rows) == 3 and {r["reason"] for r in rows} == {"cycle"}
+    assert {r["user_id"] for r in rows} == {str(user.id)}
+
+
+def test_vacuum(tmp_path):
+    engine = models.init_db(f"sqlite:///{tmp_path / 'iv.db'}")
+    service = RS.RetentionService()
+    # new databases use incremental vacuum from the start
+    assert not service.enable_incremental_vacuum(engine)
+    service.vacuum(engine, pages=10)
+    with sqlite3.connect(tmp_path / "iv.db") as connection:
+        auto_vacuum = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+        assert auto_vacuum == RS.INCREMENTAL_AUTO_VACUUM
+    engine.dispose()
+
+
+def test_enable_incremental_vacuum(tmp_path):
+    with sqlite3.connect(tmp_path / "iv.db") as connection:
+        connection.execute("CREATE TABLE old (id INTEGER)")
+    engine = models.init_db(f"sqlite:///{tmp_path / 'iv.db'}")
+    service = RS.RetentionService()
+    # idle vacuum doesn't rewrite the database
+    service.vacuum(engine, pages=10)
+    with sqlite3.connect(tmp_path / "iv.db") as connection:
+        assert connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    assert service.enable_incremental_vacuum(engine)
+    assert not service.enable_incremental_vacuum(engine)
+    with sqlite3.connect(tmp_path / "iv.db") as connection:
+        auto_vacuum = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+        assert auto_vacuum == RS.INCREMENTAL_AUTO_VACUUM
+    engine.dispose()
@@ -0,0 +1,128 @@
+import collections
+import math
+import threading
+import time
+
+
+class AimdWindow:
+    """Limits the number of requests in flight.
+
+    The window grows by one for every window of successful requests
+    (additive increase) and is halved (multiplicative decrease) on 429
+    responses or when latency exceeds latency_tolerance times the base
+    latency, the lowest latency of recent requests, which means requests
+    started to queue up somewhere. 429 also pauses all requests for
+    retry_after seconds.
+
+    Requests of several lanes share the window by weights: when requests
+    of different lanes wait, the lane with the least requests per weight
+    goes first, lanes with equal shares go in order of their numbers.
+    """
+
+    # base latency is the minimum over the last one or two such periods,
+    # so it follows a network which became slower for good
+    BASE_LATENCY_SAMPLES = 1000
+
+    def __init__(
+        self,
+        *,
+        max_window: int,
+        initial: float = 1,
+        min_window: float = 1,
+        decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+        weights: dict[int, float] | None = None,
+        clock=time.monotonic,
+    ):
+        assert 1 <= min_window <= initial <= max_window
+        self._max_window = max_window
+        self._min_window = min_window
+        self._decrease_factor = decrease
+        self._latency_tolerance = latency_tolerance
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._window = float(initial)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._latency_min = math.inf
+        self._previous_latency_min = math.inf
+        self._latency_samples = 0
+        # requests sent before the last decrease which are still in flight
+        self._sent_before_decrease = 0
+        self._weights = weights or {}
+        self._waiting = collections.Counter()
+        # requests per weight sent by every lane
+        self._shares = collections.defaultdict(float)
+
+    @property
+    def window(self) -> float:
+        return self._window
+
+    @property
+    def base_latency(self) -> float:
+        return min(self._latency_min, self._previous_latency_min)
+
+    def acquire(self, lane: int = 0):
+        with self._condition:
+            if not self._waiting[lane]:
+                # a lane which was idle doesn't get a credit for that time
+                active = [self._shares[w] for w, n in self._waiting.items() if n]
+                if active:
+                    self._shares[lane] = max(self._shares[lane], min(active))
+            self._waiting[lane] += 1
+            try:
+                while True:
+                    pause = self._paused_until - self._clock()
+                    if pause > 0:
+                        self._condition.wait(pause)
+                    elif self._in_flight < int(self._window) and self._is_next(lane):
+                        self._in_flight += 1
+                        self._shares[lane] += 1 / self._weights.get(lane, 1)
+                        return
+                    else:
+                        self._condition.wait()
+            finally:
+                self._waiting[lane] -= 1
+                # the next request may be of another lane now
+                self._condition.notify_all()
+
+    def release(self, latency: float | None = None, retry_after: float | None = None):
+        """latency of a successful request, retry_after of a 429 response,
+        neither for other failures"""
+        with self._condition:
+            self._in_flight -= 1
+            # such requests report the congestion which caused the decrease
+            can_decrease = self._sent_before_decrease == 0
+            self._sent_before_decrease = max(0, self._sent_before_decrease - 1)
+            if retry_after is not None:
+                self._paused_until = max(
+                    self._paused_until, self._clock() + retry_after
+                )
+                if can_decrease:
+                    self._decrease()
+            elif latency is not None:
+                self._observe_latency(latency, can_decrease)
+            self._condition.notify_all()
+
+    def _is_next(self, lane: int) -> bool:
+        return lane == min(
+            (w for w, n in self._waiting.items() if n),
+            key=lambda w: (self._shares[w], w),
+        )
+
+    def _observe_latency(self, latency: float, can_decrease: bool):
+        self._latency_min = min(self._latency_min, latency)
+        self._latency_samples += 1
+        if self._latency_samples == self.BASE_LATENCY_SAMPLES:
+            self._previous_latency_min = self._latency_min
+            self._latency_min = math.inf
+            self._latency_samples = 0
+        if latency > self.base_latency * self._latency_tolerance:
+            if can_decrease:
+                self._decrease()
+        else:
+            self._window = min(self._max_window, self._window + 1 / self._window)
+
+    def _decrease(self):
+        self._window = max(self._min_window, self._window * self._decrease_factor)
+        self._sent_before_decrease = self._in_flight
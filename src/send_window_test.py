@@ -0,0 +1,108 @@
+import threading
+import time
+
+from send_window import AimdWindow
+
+
+def test_additive_increase():
+    window = AimdWindow(max_window=8)
+    for _ in range(100):
+        window.acquire()
+        window.release(latency=0.01)
+    assert window.window == 8
+
+
+def test_decrease_once_per_window():
+    window = AimdWindow(max_window=8, initial=8)
+    for _ in range(8):
+        window.acquire()
+    # all requests in flight report the same congestion
+    for _ in range(8):
+        window.release(latency=None, retry_after=0)
+    assert window.window == 4
+
+    for _ in range(4):
+        window.acquire()
+        window.release(latency=0.01)
+    window.acquire()
+    window.release(latency=0.1)
+    assert 2 <= window.window < 3
+
+
+def test_retry_after_pauses_requests():
+    window = AimdWindow(max_window=4, initial=4)
+    window.acquire()
+    window.release(retry_after=0.2)
+    start = time.monotonic()
+    window.acquire()
+    assert time.monotonic() - start >= 0.15
+    window.release(latency=0.01)
+
+
+def test_window_limits_requests_in_flight():
+    window = AimdWindow(max_window=3, initial=3)
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = []
+
+    def request():
+        window.acquire()
+        with lock:
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop()
+        window.release(latency=0.01)
+
+    threads = [threading.Thread(target=request) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(max_in_flight) == 3
+
+
+def test_converges_to_capacity():
+    # the server handles 10 requests at once, the rest wait in its queue
+    capacity = 10
+    window = AimdWindow(max_window=100)
+    windows = []
+    for _ in range(300):
+        n = int(window.window)
+        for _ in range(n):
+            window.acquire()
+        latency = 0.05 * max(1, n / capacity)
+        for _ in range(n):
+            window.release(latency=latency)
+        windows.append(window.window)
+    assert capacity / 2 <= min(windows[-100:])
+    # requests queue up on the server before latency crosses the tolerance
+    assert int(max(windows[-100:])) <= capacity * 2 + 1
+
+
+def test_lanes_share_window_by_weights():
+    window = AimdWindow(max_window=1, weights={0: 4, 2: 1})
+    order = []
+    lock = threading.Lock()
+
+    def request(lane):
+        window.acquire(lane)
+        with lock:
+            order.append(lane)
+        window.release(latency=0.01)
+
+    window.acquire(2)
+    threads = [threading.Thread(target=request, args=(2,)) for _ in range(5)]
+    threads += [threading.Thread(target=request, args=(0,)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    while sum(window._waiting.values()) < len(threads):
+        time.sleep(0.001)
+    window.release(latency=0.01)
+    for t in threads:
+        t.join()
+
+    # a newly active lane starts level with the others, then gets four
+    # requests for every one of the other lane
+    assert order == [0, 2, 0, 0, 0, 0, 2, 2, 2, 2]
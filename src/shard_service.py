@@ -0,0 +1,123 @@
+import dataclasses
+import datetime as dt
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from db import models
+
+# a claimed shard which isn't finished by then is claimed again, its owner is
+# assumed to be dead
+CLAIM_TIMEOUT = dt.timedelta(minutes=10)
+
+
+def _run_time(wakeup_time: dt.datetime) -> dt.datetime:
+    # every process computes the wakeup time on its own, round it
+    # so that all of them agree on the run key
+    wakeup_time = wakeup_time.astimezone(dt.UTC)
+    return (wakeup_time + dt.timedelta(microseconds=500000)).replace(microsecond=0)
+
+
+@dataclasses.dataclass
+class ClaimedShard:
+    run_time: dt.datetime
+    shard: int
+    n_shards: int
+    owner: str
+
+
+class ShardService:
+    """Coordinates broadcast shards between processes through the database.
+
+    Every process registers all shards of a run and then claims free shards
+    one by one, a shard is claimed by exactly one owner. A shard not finished
+    within claim_timeout is free again, so the users of a crashed process
+    still get the broadcast.
+    """
+
+    def create_run(self, session: Session, wakeup_time: dt.datetime, n_shards: int):
+        insert = models.dialect_insert(session)
+        run_time = _run_time(wakeup_time)
+        session.execute(
+            insert(models.BroadcastShard)
+            .values(
+                [
+                    {"run_time": run_time, "shard": shard, "n_shards": n_shards}
+                    for shard in range(n_shards)
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+        session.commit()
+
+    def claim_shard(
+        self,
+        session: Session,
+        wakeup_time: dt.datetime,
+        owner: str,
+        claim_timeout: dt.timedelta = CLAIM_TIMEOUT,
+    ) -> ClaimedShard | None:
+        run_time = _run_time(wakeup_time)
+        now = dt.datetime.now(dt.UTC)
+        shard_table = models.BroadcastShard
+        is_free = sqlalchemy.or_(
+            shard_table.owner.is_(None),
+            sqlalchemy.and_(
+                shard_table.time_finished.is_(None),
+                shard_table.time_claimed < now - claim_timeout,
+            ),
+        )
+        free_shards = session.execute(
+            sqlalchemy.select(shard_table.shard, shard_table.n_shards)
+            .where(shard_table.run_time == run_time)
+            .where(is_free)
+            .order_by(shard_table.shard)
+        ).all()
+        session.commit()
+        for shard, n_shards in free_shards:
+            # the condition is checked again, another process may have
+            # claimed the shard in the meantime
+            result = session.execute(
+                sqlalchemy.update(shard_table)
+                .where(shard_table.run_time == run_time)
+                .where(shard_table.shard == shard)
+                .where(is_free)
+                .values(owner=owner, time_claimed=now)
+            )
+            session.commit()
+            if result.rowcount == 1:
+                return ClaimedShard(run_time, shard, n_shards, owner)
+        return None
+
+    def count_unfinished(self, session: Session, wakeup_time: dt.datetime) -> int:
+        """Shards of the run which are free or still being sent"""
+        count = session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count())
+            .select_from(models.BroadcastShard)
+            .where(models.BroadcastShard.run_time == _run_time(wakeup_time))
+            .where(models.BroadcastShard.time_finished.is_(None))
+        )
+        session.commit()
+        return count
+
+    def finish_shard(self, session: Session, shard: ClaimedShard) -> bool:
+        """Marks the shard finished unless its claim was taken over, the
+        caller commits it together with the shard's messages. Returns
+        whether the shard was still claimed by its owner."""
+        result = session.execute(
+            sqlalchemy.update(models.BroadcastShard)
+            .where(models.BroadcastShard.run_time == shard.run_time)
+            .where(models.BroadcastShard.shard == shard.shard)
+            .where(models.BroadcastShard.owner == shard.owner)
+            .where(models.BroadcastShard.time_finished.is_(None))
+            .values(time_finished=dt.datetime.now(dt.UTC))
+        )
+        return result.rowcount == 1
+
+    def remove_runs_before(self, session: Session, time: dt.datetime):
+        session.execute(
+            sqlalchemy.delete(models.BroadcastShard).where(
+                models.BroadcastShard.run_time < _run_time(time)
+            )
+        )
+        session.commit()
@@ -0,0 +1,103 @@
+import datetime as dt
+import threading
+
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+
+from db import models
+import shard_service as SS
+
+
+def test_claim_shards(testing_db):
+    session = testing_db.session()
+    shard_service = SS.ShardService()
+    wakeup_time = dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC)
+
+    shard_service.create_run(session, wakeup_time, 3)
+    # registering the run twice is fine
+    shard_service.create_run(session, wakeup_time, 3)
+    assert session.query(models.BroadcastShard).count() == 3
+
+    claimed = []
+    for owner in ["a", "b", "a", "b"]:
+        shard = shard_service.claim_shard(
+            session, wakeup_time + dt.timedelta(microseconds=1), owner
+        )
+        claimed.append(shard and (shard.shard, shard.n_shards))
+    assert claimed == [(0, 3), (1, 3), (2, 3), None]
+
+    # only the owner finishes the shard
+    assert not shard_service.finish_shard(
+        session, SS.ClaimedShard(wakeup_time, 0, 3, "b")
+    )
+    assert shard_service.finish_shard(session, SS.ClaimedShard(wakeup_time, 0, 3, "a"))
+    session.commit()
+    finished = session.query(models.BroadcastShard).filter(
+        models.BroadcastShard.time_finished.is_not(None)
+    )
+    assert [s.shard for s in finished] == [0]
+
+    shard_service.create_run(session, wakeup_time + dt.timedelta(days=1), 3)
+    shard_service.remove_runs_before(session, wakeup_time + dt.timedelta(hours=1))
+    assert session.query(models.BroadcastShard).count() == 3
+
+
+def test_claim_expired_shard(testing_db):
+    session = testing_db.session()
+    shard_service = SS.ShardService()
+    wakeup_time = dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC)
+    shard_service.create_run(session, wakeup_time, 2)
+    timeout = dt.timedelta(minutes=10)
+
+    crashed = shard_service.claim_shard(session, wakeup_time, "crashed", timeout)
+    finished = shard_service.claim_shard(session, wakeup_time, "a", timeout)
+    assert shard_service.finish_shard(session, finished)
+    session.commit()
+    assert shard_service.claim_shard(session, wakeup_time, "b", timeout) is None
+    assert shard_service.count_unfinished(session, wakeup_time) == 1
+
+    # the claim expired, finished shards are never claimed again
+    shard = shard_service.claim_shard(session, wakeup_time, "b", dt.timedelta(0))
+    assert shard.shard == crashed.shard
+    assert shard_service.claim_shard(session, wakeup_time, "c", timeout) is None
+    # the crashed owner can't finish the shard taken over
+    assert not shard_service.finish_shard(session, crashed)
+    assert shard_service.finish_shard(session, shard)
+    session.commit()
+    assert shard_service.claim_shard(session, wakeup_time, "c", dt.timedelta(0)) is None
+    assert shard_service.count_unfinished(session, wakeup_time) == 0
+    owners = {s.shard: s.owner for s in session.query(models.BroadcastShard)}
+    assert owners == {crashed.shard: "b", finished.shard: "a"}
+
+
+def test_claim_shards_concurrent(tmp_path):
+    engine = models.init_db(f"sqlite:///{tmp_path / 'iv.db'}")
+    create_session = scoped_session(sessionmaker(engine))
+    shard_service = SS.ShardService()
+    wakeup_time = dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC)
+
+    n_threads = 8
+    n_shards = 50
+    barrier = threading.Barrier(n_threads)
+    claimed = [[] for _ in range(n_threads)]
+
+    def worker(i):
+        barrier.wait()
+        with create_session() as session:
+            shard_service.create_run(session, wakeup_time, n_shards)
+            while shard := shard_service.claim_shard(session, wakeup_time, str(i)):
+                claimed[i].append(shard.shard)
+        create_session.remove()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    all_claimed = sum(claimed, [])
+    assert sorted(all_claimed) == list(range(n_shards))
+    with create_session() as session:
+        for shard in session.query(models.BroadcastShard):
+            assert shard.shard in claimed[int(shard.owner)]
+    engine.dispose()
@@ -0,0 +1,49 @@
+import enum
+
+import telebot
+
+
+class DeliveryError(enum.Enum):
+    # the user blocked the bot, deleted the account or the chat is gone,
+    # retrying won't help
+    UNREACHABLE = 1
+    # the group became a supergroup with a new chat id
+    MIGRATED = 2
+    RATE_LIMITED = 3
+    # everything else, e.g. network errors and 5xx
+    OTHER = 4
+
+
+# descriptions of 400 errors meaning the chat can't be reached anymore
+_UNREACHABLE_DESCRIPTIONS = (
+    "chat not found",
+    "user not found",
+    "peer_id_invalid",
+    "group chat was deactivated",
+    "have no rights to send a message",
+)
+
+
+def classify(e: Exception) -> DeliveryError:
+    if not isinstance(e, telebot.apihelper.ApiTelegramException):
+        return DeliveryError.OTHER
+    if e.error_code == 429:
+        return DeliveryError.RATE_LIMITED
+    if migrate_to_chat_id(e) is not None:
+        return DeliveryError.MIGRATED
+    if e.error_code == 403:
+        return DeliveryError.UNREACHABLE
+    description = (e.description or "").lower()
+    if e.error_code == 400 and any(d in description for d in _UNREACHABLE_DESCRIPTIONS):
+        return DeliveryError.UNREACHABLE
+    return DeliveryError.OTHER
+
+
+def migrate_to_chat_id(e: telebot.apihelper.ApiTelegramException) -> int | None:
+    parameters = e.result_json.get("parameters") or {}
+    return parameters.get("migrate_to_chat_id")
+
+
+def retry_after(e: telebot.apihelper.ApiTelegramException) -> float | None:
+    parameters = e.result_json.get("parameters") or {}
+    return parameters.get("retry_after")
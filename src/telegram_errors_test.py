@@ -0,0 +1,40 @@
+import pytest
+import telebot
+
+import telegram_errors as TE
+
+
+def api_error(code, description, parameters=None):
+    result_json = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        result_json["parameters"] = parameters
+    return telebot.apihelper.ApiTelegramException("sendMessage", None, result_json)
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (api_error(403, "Forbidden: bot was blocked by the user"), "UNREACHABLE"),
+        (api_error(403, "Forbidden: user is deactivated"), "UNREACHABLE"),
+        (api_error(400, "Bad Request: chat not found"), "UNREACHABLE"),
+        (
+            api_error(
+                400,
+                "Bad Request: group chat was upgraded to a supergroup chat",
+                {"migrate_to_chat_id": -1001},
+            ),
+            "MIGRATED",
+        ),
+        (api_error(429, "Too Many Requests", {"retry_after": 1}), "RATE_LIMITED"),
+        (api_error(400, "Bad Request: message is too long"), "OTHER"),
+        (api_error(500, "Internal Server Error"), "OTHER"),
+        (ConnectionError(), "OTHER"),
+    ],
+)
+def test_classify(error, expected):
+    assert TE.classify(error) == TE.DeliveryError[expected]
+
+
+def test_migrate_to_chat_id():
+    assert TE.migrate_to_chat_id(api_error(400, "", {"migrate_to_chat_id": -5})) == -5
+    assert TE.migrate_to_chat_id(api_error(400, "Bad Request: chat not found")) is None
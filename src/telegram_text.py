@@ -0,0 +1,52 @@
+import re
+
+# Bot API limit of a message, in UTF-16 code units
+MAX_MESSAGE_LENGTH = 4096
+
+# places to split a long text at, the first one found wins
+_SEPARATORS = (re.compile(r"\n\s*\n"), re.compile(r"\n"), re.compile(r"\s"))
+
+
+def length(text: str) -> int:
+    """Length as counted by Telegram"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def normalize(text: str) -> str:
+    """Text as it's stored and sent: Telegram strips surrounding whitespace
+    and sends \\r\\n as \\n anyway"""
+    return text.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+
+def split(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """Splits normalized text into messages of at most limit, preferably
+    between paragraphs, then lines, then words"""
+    parts = []
+    while length(text) > limit:
+        end = _prefix_end(text, limit)
+        cut = None
+        for separator in _SEPARATORS:
+            matches = [m for m in separator.finditer(text, 0, end + 1) if m.start()]
+            if matches:
+                cut = matches[-1]
+                break
+        if cut is None:
+            parts.append(text[:end])
+            text = text[end:]
+        else:
+            parts.append(text[: cut.start()].rstrip())
+            text = text[cut.end() :]
+        text = text.lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def _prefix_end(text: str, limit: int) -> int:
+    """End of the longest prefix of at most limit UTF-16 code units"""
+    units = 0
+    for i, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            return i
+    return len(text)
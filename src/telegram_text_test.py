@@ -0,0 +1,39 @@
+import telegram_text
+
+
+def test_length_counts_utf16_units():
+    assert telegram_text.length("abc") == 3
+    assert telegram_text.length("Цитата") == 6
+    assert telegram_text.length("😀") == 2
+
+
+def test_normalize():
+    assert telegram_text.normalize("  a\r\nb\rc \n") == "a\nb\nc"
+
+
+def test_split_short_text():
+    assert telegram_text.split("a b", limit=3) == ["a b"]
+    assert telegram_text.split("", limit=3) == []
+
+
+def test_split_prefers_paragraphs_then_lines_then_words():
+    text = "aaa bbb\nccc\n\nddd eee"
+    assert telegram_text.split(text, limit=12) == ["aaa bbb\nccc", "ddd eee"]
+    assert telegram_text.split(text, limit=10) == ["aaa bbb", "ccc", "ddd eee"]
+    assert telegram_text.split("aaa bbb ccc", limit=8) == ["aaa bbb", "ccc"]
+
+
+def test_split_long_words():
+    assert telegram_text.split("abcdefg", limit=3) == ["abc", "def", "g"]
+    # surrogate pairs aren't cut in half
+    assert telegram_text.split("a😀😀", limit=2) == ["a", "😀", "😀"]
+
+
+def test_split_parts_fit():
+    text = " ".join(f"word{i}" for i in range(3000))
+    parts = telegram_text.split(text)
+    assert len(parts) > 1
+    assert all(
+        telegram_text.length(p) <= telegram_text.MAX_MESSAGE_LENGTH for p in parts
+    )
+    assert " ".join(parts) == text
@@ -3,6 +3,8 @@ import collections
 import dataclasses
 import typing
 
+import telebot
+
 
 @dataclasses.dataclass
 class Chat:
@@ -57,6 +59,9 @@ class MockTelebot:
         self.files = {}
         self._observers = []
         self._chat_to_user = {}
+        self.documents = collections.defaultdict(list)
+        # chat id -> Bot API error returned by send_message
+        self.send_errors = {}
 
     def add_observer(self, observer: MockTelebotObserver):
         self._observers.append(observer)
@@ -68,6 +73,10 @@ class MockTelebot:
         )
 
     def send_message(self, chat_id, text):
+        if chat_id in self.send_errors:
+            raise telebot.apihelper.ApiTelegramException(
+                "sendMessage", None, self.send_errors[chat_id]
+            )
         self.chats[chat_id].append(text)
         self.message_id += 1
         message = Message(self.message_id, Chat(chat_id), text=text)
@@ -76,7 +85,7 @@ class MockTelebot:
         return message
 
     def send_document(self, chat, file):
-        pass
+        self.documents[chat].append(file)
 
     def infinity_polling(self):
         pass
@@ -94,6 +103,7 @@ class MockTelebot:
                 -1 - len(self.chats[chat_id]),
                 Chat(chat_id),
                 from_user=user,
+                text=text,
                 reply_to_message=reply_to,
                 document=file,
             )
@@ -102,7 +112,7 @@ class MockTelebot:
                 message_content_types.append("document")
             if content_types != message_content_types:
                 continue
-            if commands and text in commands:
+            if commands and text and text.split()[0].lstrip("/") in commands:
                 handler(message)
             elif func and func(message):
                 handler(message)
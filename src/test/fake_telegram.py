@@ -0,0 +1,177 @@
+import collections
+import dataclasses
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import typing
+import urllib.parse
+
+
+@dataclasses.dataclass
+class FakeTelegramConfig:
+    # seconds, or a function returning seconds, spent on every request
+    latency: float | typing.Callable[[], float] = 0.0
+    # share of requests failing with 500
+    error_rate: float = 0.0
+    # requests per second allowed before answering 429, None is unlimited
+    rate_limit: float | None = None
+    retry_after: int = 1
+    blocked_chats: set[int] = dataclasses.field(default_factory=set)
+    # seconds getUpdates waits before returning no updates
+    get_updates_delay: float = 0.1
+    seed: int | None = None
+
+
+class FakeTelegramServer:
+    """Local HTTP server imitating Telegram Bot API.
+
+    Point telebot at it with
+    telebot.apihelper.API_URL = server.api_url
+    """
+
+    def __init__(self, config: FakeTelegramConfig | None = None, port: int = 0):
+        self.config = config or FakeTelegramConfig()
+        self.chats = collections.defaultdict(list)
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.connections = 0
+        self._lock = threading.RLock()
+        self._random = random.Random(self.config.seed)
+        self._message_id = 0
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive, so that connection reuse by clients is observable
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, avoid delayed ack stalls
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                url = urllib.parse.urlsplit(self.path)
+                match = re.fullmatch(r"/bot(?P<token>[^/]+)/(?P<method>\w+)", url.path)
+                if not match:
+                    self._reply(404, {"ok": False, "error_code": 404})
+                    return
+                params = dict(urllib.parse.parse_qsl(url.query))
+                status, body = server._dispatch(match["method"], params)
+                self._reply(status, body)
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="FakeTelegram"
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _dispatch(self, method: str, params: dict) -> tuple[int, dict]:
+        with self._lock:
+            self.requests[method] += 1
+        if method == "getUpdates":
+            time.sleep(self.config.get_updates_delay)
+            return 200, {"ok": True, "result": []}
+
+        latency = self.config.latency
+        time.sleep(latency() if callable(latency) else latency)
+        with self._lock:
+            if self._is_rate_limited():
+                return self._error(
+                    429,
+                    f"Too Many Requests: retry after {self.config.retry_after}",
+                    {"retry_after": self.config.retry_after},
+                )
+            if self._random.random() < self.config.error_rate:
+                return self._error(500, "Internal Server Error")
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": self._bot_user()}
+        if method in ("sendMessage", "sendDocument"):
+            chat_id = int(params["chat_id"])
+            if chat_id in self.config.blocked_chats:
+                return self._error(403, "Forbidden: bot was blocked by the user")
+            with self._lock:
+                self._message_id += 1
+                message = {
+                    "message_id": self._message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": self._bot_user(),
+                }
+                if method == "sendMessage":
+                    message["text"] = params.get("text", "")
+                    self.chats[chat_id].append(message["text"])
+                else:
+                    message["document"] = {"file_id": "file", "file_unique_id": "f"}
+            return 200, {"ok": True, "result": message}
+        return 200, {"ok": True, "result": True}
+
+    def _is_rate_limited(self) -> bool:
+        if self.config.rate_limit is None:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_requests = 0
+        self._window_requests += 1
+        return self._window_requests > self.config.rate_limit
+
+    def _error(self, code: int, description: str, parameters: dict | None = None):
+        with self._lock:
+            self.errors[code] += 1
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return code, body
+
+    @staticmethod
+    def _bot_user():
+        return {"id": 1, "is_bot": True, "first_name": "ivanov", "username": "iv_bot"}
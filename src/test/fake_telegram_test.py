@@ -0,0 +1,138 @@
+import datetime as dt
+import json
+import time
+
+import pytest
+import telebot
+
+import main
+import outbox
+from db import models
+from test.fake_telegram import FakeTelegramConfig
+from test.fake_telegram import FakeTelegramServer
+
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    def _start(config=None):
+        server = FakeTelegramServer(config).start()
+        servers.append(server)
+        monkeypatch.setattr(telebot.apihelper, "API_URL", server.api_url)
+        return server
+
+    servers = []
+    yield _start
+    for server in servers:
+        server.stop()
+
+
+def test_send_messages(fake_telegram):
+    server = fake_telegram(FakeTelegramConfig(latency=0.05, blocked_chats={2}))
+    bot = telebot.TeleBot("1:token")
+
+    start = time.perf_counter()
+    message = bot.send_message(1, "hello")
+    assert time.perf_counter() - start >= 0.05
+    assert message.text == "hello"
+    assert message.chat.id == 1
+    bot.send_message(1, "world")
+    assert server.chats[1] == ["hello", "world"]
+
+    with pytest.raises(telebot.apihelper.ApiTelegramException) as e:
+        bot.send_message(2, "hello")
+    assert e.value.error_code == 403
+    assert "blocked" in e.value.description
+    # the session is reused between requests
+    assert server.connections == 1
+
+
+def test_errors(fake_telegram):
+    server = fake_telegram(FakeTelegramConfig(rate_limit=2, retry_after=3))
+    bot = telebot.TeleBot("1:token")
+    bot.send_message(1, "1")
+    bot.send_message(1, "2")
+    with pytest.raises(telebot.apihelper.ApiTelegramException) as e:
+        bot.send_message(1, "3")
+    assert e.value.error_code == 429
+    assert e.value.result_json["parameters"]["retry_after"] == 3
+    assert server.errors[429] == 1
+
+    server = fake_telegram(FakeTelegramConfig(error_rate=1.0))
+    with pytest.raises(telebot.apihelper.ApiTelegramException) as e:
+        bot.send_message(1, "1")
+    assert e.value.error_code == 500
+
+
+def test_app_broadcast(tmp_path, app_db, fake_telegram):
+    server = fake_telegram(FakeTelegramConfig(blocked_chats={1002}))
+    with app_db.session() as session:
+        session.add_all(
+            [
+                models.User(chat_id=1001, _send_phrases=True),
+                models.User(chat_id=1002, _send_phrases=True),
+                models.Phrase(text="phrase"),
+            ]
+        )
+        session.commit()
+
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: app_db.engine
+    test_config = {
+        "token": "1:token",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "1:0:0",
+        },
+        "working_dir": str(tmp_path),
+        "api_url": server.api_url,
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(test_config))
+    app = main.App(factories, config_path)
+    # queues are filled between broadcasts
+    app._fill_queues()
+    app._send_phrases(dt.datetime.now(dt.UTC))
+    app._outbox_sender.drain()
+
+    assert server.chats[1001] == ["phrase"]
+    assert server.errors[403] == 1
+    with app_db.session() as session:
+        # phrases are marked as used when they are added to the outbox
+        assert session.query(models.UsedPhrases).count() == 2
+        assert session.query(models.OutboxMessage).count() == 0
+        blocked = session.query(models.User).filter_by(chat_id=1002).one()
+        assert blocked.delivery_failures == 1
+
+
+def test_app_broadcast_rate_limited(tmp_path, app_db, fake_telegram):
+    server = fake_telegram(FakeTelegramConfig(rate_limit=20, retry_after=1))
+    chat_ids = list(range(1000, 1040))
+    with app_db.session() as session:
+        session.add_all([models.User(chat_id=c, _send_phrases=True) for c in chat_ids])
+        session.add(models.Phrase(text="phrase"))
+        session.commit()
+
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: app_db.engine
+    test_config = {
+        "token": "1:token",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "1:0:0",
+        },
+        "working_dir": str(tmp_path),
+        "api_url": server.api_url,
+        "broadcast": {"max_concurrency": 32},
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(test_config))
+    app = main.App(factories, config_path)
+    # queues are filled between broadcasts
+    app._fill_queues()
+    app._send_phrases(dt.datetime.now(dt.UTC))
+    app._outbox_sender.drain()
+
+    # messages rejected with 429 are sent again after retry_after
+    assert server.errors[429] > 0
+    assert sorted(server.chats) == chat_ids
+    assert outbox.SEND_WINDOW.get() == app._outbox_sender.window.window
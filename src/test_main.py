@@ -1,13 +1,23 @@
+import datetime as dt
 import re
 import json
 import queue
 import threading
+import time
 
+import pytest
 import sqlalchemy
+from sqlalchemy.orm import Session
 
 import main
+import outbox
+import outbox_service as OS
 from db import models
+import lease_service as LS
+import phrases_service as PS
+import shard_service as SS
 import test.bot
+import tracing
 
 
 class EventLoop:
@@ -19,7 +29,7 @@ class EventLoop:
     def run(self):
         while True:
             try:
-                (key, ev) = self._queue.get(timeout=1.0)
+                key, ev = self._queue.get(timeout=1.0)
             except queue.Empty:
                 continue
             if key == "exit":
@@ -52,8 +62,8 @@ class AppThread(threading.Thread):
         self.join()
 
 
-def test_send_phrases(tmp_path, testing_db):
-    with testing_db.session() as session:
+def test_send_phrases(tmp_path, app_db):
+    with app_db.session() as session:
         admin = models.User(chat_id=1000, _is_admin=True, _send_phrases=False)
         user = models.User(chat_id=1001, _is_admin=False, _send_phrases=True)
         user2 = models.User(chat_id=1002, _is_admin=False, _send_phrases=True)
@@ -72,13 +82,15 @@ def test_send_phrases(tmp_path, testing_db):
             )
         )
         session.commit()
+        # the fill between broadcasts
+        PS.PhrasesService().fill_queues(session, 2)
         for u in users:
             session.refresh(u)
 
     test_bot = test.bot.MockTelebot()
 
     factories = main.ServiceFactories()
-    factories.init_db = lambda *args, **kwargs: testing_db.engine
+    factories.init_db = lambda *args, **kwargs: app_db.engine
     factories.create_bot = lambda *args, **kwargs: test_bot
     test_config = {
         "token": "<test token>",
@@ -127,3 +139,301 @@ def test_send_phrases(tmp_path, testing_db):
     assert re.match(".*ivanov bot started.*", test_bot.chats[admin.chat_id][0])
     assert re.match("Error no phrases for 1 users.*", test_bot.chats[admin.chat_id][1])
     assert re.match("Error no phrases for 2 users.*", test_bot.chats[admin.chat_id][2])
+
+
+def test_config_database(tmp_path):
+    test_config = {
+        "token": "<test token>",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "0:0:1",
+        },
+        "working_dir": str(tmp_path),
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(test_config))
+    config = main.Config(config_path)
+    assert config.database.url == f"sqlite:///{tmp_path / 'iv.db'}"
+    assert config.database.pool_size == 5
+
+    test_config["database"] = {
+        "url": "postgresql+psycopg://localhost/ivanov",
+        "pool_size": 20,
+    }
+    config_path.write_text(json.dumps(test_config))
+    config = main.Config(config_path)
+    assert config.database.url == "postgresql+psycopg://localhost/ivanov"
+    assert config.database.pool_size == 20
+    assert config.database.max_overflow == 10
+    assert config.broadcast.selection == "queue"
+
+    test_config["broadcast"] = {"selection": "bitmap"}
+    config_path.write_text(json.dumps(test_config))
+    assert main.Config(config_path).broadcast.selection == "bitmap"
+    test_config["broadcast"] = {"selection": "unknown"}
+    config_path.write_text(json.dumps(test_config))
+    with pytest.raises(RuntimeError, match="Unknown broadcast selection unknown"):
+        main.Config(config_path)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_leader_election(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'iv.db'}"
+    engine = models.init_db(db_url)
+    chat_id = 1001
+    with Session(engine) as session:
+        session.add(models.User(chat_id=chat_id, _send_phrases=True))
+        session.add_all([models.Phrase(text=f"phrase{i}") for i in range(100)])
+        session.commit()
+    engine.dispose()
+
+    class CrashingLeaseService(LS.LeaseService):
+        def release(self, session, name, owner):
+            # the lease is left to expire as if the leader crashed
+            pass
+
+    bots = [test.bot.MockTelebot(), test.bot.MockTelebot()]
+    app_threads = []
+    for i, test_bot in enumerate(bots):
+        factories = main.ServiceFactories()
+        factories.create_bot = lambda *args, test_bot=test_bot, **kwargs: test_bot
+        factories.lease_service = CrashingLeaseService
+        test_config = {
+            "token": "<test token>",
+            "time": {
+                "start_time": "2025-01-10T22:30:00+03:00",
+                "period_between_messages": "0:0:1",
+            },
+            "working_dir": str(tmp_path / f"app{i}"),
+            "database": {"url": db_url},
+            "leader_election": {"lease_timeout": 1},
+        }
+        (tmp_path / f"app{i}").mkdir()
+        config_path = tmp_path / f"config{i}.json"
+        config_path.write_text(json.dumps(test_config))
+        app_threads.append(AppThread(factories, config_path))
+    for app_thread in app_threads:
+        app_thread.start()
+
+    def n_sent():
+        return sum(len(bot.chats[chat_id]) for bot in bots)
+
+    try:
+        # either app may deliver the messages of the leader's broadcasts
+        wait_for(lambda: n_sent() >= 2)
+        leaders = [i for i, t in enumerate(app_threads) if t.app._leader.is_leader()]
+        assert len(leaders) == 1
+        leader = leaders[0]
+        follower = 1 - leader
+
+        app_threads[leader].stop()
+        n_sent_by_leader = n_sent()
+        wait_for(lambda: n_sent() >= n_sent_by_leader + 2)
+        assert app_threads[follower].app._leader.is_leader()
+    finally:
+        for app_thread in app_threads:
+            if app_thread.is_alive():
+                app_thread.stop()
+
+    # every phrase is sent once
+    phrases = bots[0].chats[chat_id] + bots[1].chats[chat_id]
+    assert len(phrases) == len(set(phrases))
+
+
+def test_broadcast_trace(tmp_path, app_db):
+    with app_db.session() as session:
+        session.add(models.User(chat_id=1001, _send_phrases=True))
+        session.add(models.Phrase(text="phrase"))
+        session.commit()
+
+    test_bot = test.bot.MockTelebot()
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: app_db.engine
+    factories.create_bot = lambda *args, **kwargs: test_bot
+    test_config = {
+        "token": "<test token>",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "1:0:0",
+        },
+        "working_dir": str(tmp_path),
+        "tracing": {"sample_rate": 1.0},
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(test_config))
+    app = main.App(factories, config_path)
+    # queues are filled between broadcasts
+    app._fill_queues()
+    try:
+        app._send_phrases(dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC))
+        app._outbox_sender.drain()
+        app._send_phrases(dt.datetime(2025, 1, 10, 20, 30, tzinfo=dt.UTC))
+    finally:
+        tracing.TRACER.configure(enabled=False)
+
+    trace_path = tmp_path / "traces" / "broadcast-20250110T193000.json"
+    trace = json.loads(trace_path.read_text())
+    names = [e["name"] for e in trace["traceEvents"]]
+    for name in ["App._send_phrases", "shard", "sql"]:
+        assert name in names
+    assert test_bot.chats[1001] == ["phrase"]
+    # messages are sent from the outbox after the broadcast
+    trace_path = tmp_path / "traces" / "broadcast-20250110T203000.json"
+    trace = json.loads(trace_path.read_text())
+    names = [e["name"] for e in trace["traceEvents"]]
+    for name in ["OutboxSender.send_batch", "send_message"]:
+        assert name in names
+
+
+def test_broadcast_unreachable_chats(tmp_path, app_db):
+    with app_db.session() as session:
+        for chat_id in (1001, 1002, 1003):
+            session.add(models.User(chat_id=chat_id, _send_phrases=True))
+        session.add_all([models.Phrase(text=f"phrase{i}") for i in range(3)])
+        session.commit()
+
+    test_bot = test.bot.MockTelebot()
+    test_bot.send_errors[1002] = {
+        "ok": False,
+        "error_code": 403,
+        "description": "Forbidden: bot was blocked by the user",
+    }
+    test_bot.send_errors[1003] = {
+        "ok": False,
+        "error_code": 400,
+        "description": "Bad Request: group chat was upgraded to a supergroup chat",
+        "parameters": {"migrate_to_chat_id": -1003},
+    }
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: app_db.engine
+    factories.create_bot = lambda *args, **kwargs: test_bot
+    test_config = {
+        "token": "<test token>",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "1:0:0",
+        },
+        "working_dir": str(tmp_path),
+        "broadcast": {"max_delivery_failures": 2},
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(test_config))
+    app = main.App(factories, config_path)
+    wakeup_time = dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC)
+    n_unreachable = outbox.OUTBOX_MESSAGES.get(
+        priority="broadcast", result="unreachable"
+    )
+    for i in range(3):
+        app._send_phrases(wakeup_time + dt.timedelta(hours=i))
+        app._outbox_sender.drain()
+
+    assert len(test_bot.chats[1001]) == 3
+    assert len(test_bot.chats[-1003]) == 3
+    with app_db.session() as session:
+        blocked = session.scalars(
+            sqlalchemy.select(models.User).where(models.User.chat_id == 1002)
+        ).one()
+        assert not blocked.send_phrases()
+        assert blocked.delivery_failures == 2
+        migrated = session.scalars(
+            sqlalchemy.select(models.User).where(models.User.chat_id == -1003)
+        ).one()
+        assert migrated.send_phrases()
+        assert migrated.delivery_failures is None
+    n_unreachable = (
+        outbox.OUTBOX_MESSAGES.get(priority="broadcast", result="unreachable")
+        - n_unreachable
+    )
+    assert n_unreachable == 2
+
+
+def test_broadcast_long_phrase(tmp_path, app_db):
+    long_phrase = " ".join(f"word{i}" for i in range(1000))
+    with app_db.session() as session:
+        session.add(models.User(chat_id=1001, _send_phrases=True))
+        PS.PhrasesService().add_phrases(session, [long_phrase])
+
+    test_bot = test.bot.MockTelebot()
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: app_db.engine
+    factories.create_bot = lambda *args, **kwargs: test_bot
+    test_config = {
+        "token": "<test token>",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "1:0:0",
+        },
+        "working_dir": str(tmp_path),
+    }
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(test_config))
+    app = main.App(factories, config_path)
+    # queues are filled between broadcasts
+    app._fill_queues()
+    app._send_phrases(dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC))
+    app._outbox_sender.drain()
+
+    parts = test_bot.chats[1001]
+    assert len(parts) == 2
+    assert all(len(part) <= 4096 for part in parts)
+    assert " ".join(parts) == long_phrase
+
+
+def test_broadcast_shard_failed(tmp_path, app_db):
+    with app_db.session() as session:
+        session.add(models.User(chat_id=1001, _send_phrases=True))
+        session.add(models.Phrase(text="phrase"))
+        session.commit()
+    factories = main.ServiceFactories()
+    factories.init_db = lambda *args, **kwargs: app_db.engine
+    factories.create_bot = lambda *args, **kwargs: test.bot.MockTelebot()
+    config_path = tmp_path / "config.json"
+    test_config = {
+        "token": "<test token>",
+        "time": {
+            "start_time": "2025-01-10T22:30:00+03:00",
+            "period_between_messages": "1:0:0",
+        },
+        "working_dir": str(tmp_path),
+    }
+    config_path.write_text(json.dumps(test_config))
+    app = main.App(factories, config_path)
+    notified = []
+    app._error_handlers.notify = notified.append
+    app._fill_queues()
+    shard_service = SS.ShardService()
+    wakeup_time = dt.datetime(2025, 1, 10, 19, 30, tzinfo=dt.UTC)
+    with app_db.session() as session:
+        shard_service.create_run(session, wakeup_time, 1)
+        shard = shard_service.claim_shard(session, wakeup_time, "a")
+
+    def fail(*args, **kwargs):
+        raise sqlalchemy.exc.OperationalError("UPDATE", {}, Exception("locked"))
+
+    mark_sent = app._phrases_service.mark_sent
+    app._phrases_service.mark_sent = fail
+    # nothing is counted, the shard stays unfinished
+    assert app._send_shard_phrases(shard) is None
+    assert len(notified) == 1
+    app._phrases_service.mark_sent = mark_sent
+    with app_db.session() as session:
+        assert shard_service.count_unfinished(session, wakeup_time) == 1
+        assert OS.OutboxService().count(session) == 0
+        # the claim expired and was taken over
+        taken_over = shard_service.claim_shard(
+            session, wakeup_time, "b", dt.timedelta(0)
+        )
+    assert app._send_shard_phrases(shard) is None
+    with app_db.session() as session:
+        assert shard_service.count_unfinished(session, wakeup_time) == 1
+        assert OS.OutboxService().count(session) == 0
+    assert app._send_shard_phrases(taken_over) == {main.SendResult.SUCCESS: 1}
+    with app_db.session() as session:
+        assert shard_service.count_unfinished(session, wakeup_time) == 0
+        assert OS.OutboxService().count(session) == 1
@@ -8,7 +8,7 @@ class TimerThread:
     def __init__(
         self,
         get_next_wakeup_time: typing.Callable[[], dt.datetime],
-        callback: typing.Callable[[], None],
+        callback: typing.Callable[[dt.datetime], None],
     ):
         self._get_next_wakeup_time = get_next_wakeup_time
         self._callback = callback
@@ -38,7 +38,7 @@ class TimerThread:
     def _sleep(self, max_sleep: dt.timedelta):
         now = dt.datetime.now(tz=dt.UTC)
         if self._next_wakeup <= now:
-            self._callback()
+            self._callback(self._next_wakeup)
             self._next_wakeup = self._get_next_wakeup_time(now)
         assert self._next_wakeup > now
         sleep_time = min(self._next_wakeup - now, max_sleep)
@@ -0,0 +1,226 @@
+import collections
+import functools
+import itertools
+import json
+import os
+import pathlib
+import random
+import threading
+import time
+
+import sqlalchemy
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = (
+        "_tracer",
+        "name",
+        "attrs",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start_ns",
+    )
+
+    def __init__(self, tracer: "Tracer", name: str, attrs: dict):
+        self._tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._tracer._enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self._tracer._exit(self)
+        return False
+
+
+class Tracer:
+    """Records timed spans into a ring buffer.
+
+    Disabled tracer costs one attribute check per span. Sampling is decided
+    for root spans, nested spans follow the decision of their root.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self._spans = collections.deque(maxlen=100000)
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+    def configure(
+        self, *, enabled: bool = True, sample_rate: float = 1.0, buffer_size=100000
+    ):
+        self.sample_rate = sample_rate
+        self._spans = collections.deque(maxlen=buffer_size)
+        self.enabled = enabled
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name, attrs)
+
+    def spans(self) -> list[dict]:
+        return list(self._spans)
+
+    def clear(self):
+        self._spans.clear()
+
+    def export_json(self, path: pathlib.Path, clear: bool = True):
+        self._export(path, {"spans": self.spans()}, clear)
+
+    def export_chrome_trace(self, path: pathlib.Path, clear: bool = True):
+        """Writes spans in Trace Event Format, open it in chrome://tracing
+        or ui.perfetto.dev"""
+        pid = os.getpid()
+        events = []
+        for span in self.spans():
+            events.append(
+                {
+                    "name": span["name"],
+                    "ph": "X",
+                    "ts": span["start_ns"] / 1000,
+                    "dur": span["duration_ns"] / 1000,
+                    "pid": pid,
+                    "tid": span["thread_id"],
+                    "args": {
+                        **span["attrs"],
+                        "trace_id": span["trace_id"],
+                        "span_id": span["span_id"],
+                        "parent_id": span["parent_id"],
+                    },
+                }
+            )
+        threads = {s["thread_id"]: s["thread_name"] for s in self.spans()}
+        for tid, thread_name in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+            )
+        self._export(path, {"traceEvents": events}, clear)
+
+    def _export(self, path: pathlib.Path, content: dict, clear: bool):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(content, f, default=str)
+        if clear:
+            self.clear()
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, span: _Span):
+        stack = self._stack()
+        if stack:
+            parent = stack[-1]
+            if parent is None:
+                stack.append(None)
+                span.span_id = None
+                return
+            span.trace_id = parent.trace_id
+            span.parent_id = parent.span_id
+        else:
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                stack.append(None)
+                span.span_id = None
+                return
+            span.trace_id = next(self._ids)
+            span.parent_id = None
+        span.span_id = next(self._ids)
+        stack.append(span)
+        span.start_ns = time.perf_counter_ns()
+
+    def _exit(self, span: _Span):
+        self._stack().pop()
+        if span.span_id is None:
+            return
+        end_ns = time.perf_counter_ns()
+        thread = threading.current_thread()
+        self._spans.append(
+            {
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "thread_id": thread.ident,
+                "thread_name": thread.name,
+                "start_ns": span.start_ns,
+                "duration_ns": end_ns - span.start_ns,
+                "attrs": span.attrs,
+            }
+        )
+
+
+TRACER = Tracer()
+
+
+def span(name: str, **attrs):
+    return TRACER.span(name, **attrs)
+
+
+def traced(f):
+    """Records a span named after the function for every call"""
+    name = f.__qualname__
+
+    @functools.wraps(f)
+    def _impl(*args, **kwargs):
+        if not TRACER.enabled:
+            return f(*args, **kwargs)
+        with TRACER.span(name):
+            return f(*args, **kwargs)
+
+    return _impl
+
+
+def instrument_engine(engine, tracer: Tracer = TRACER):
+    """Records a span for every SQL statement executed by the engine"""
+
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        if not tracer.enabled:
+            return
+        span = tracer.span("sql", statement=statement[:200], executemany=many)
+        span.__enter__()
+        conn.info.setdefault("_tracing_spans", []).append(span)
+
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        spans = conn.info.get("_tracing_spans")
+        if spans:
+            spans.pop().__exit__(None, None, None)
+
+    def handle_error(context):
+        spans = context.connection and context.connection.info.get("_tracing_spans")
+        if spans:
+            spans.pop().__exit__(type(context.original_exception), None, None)
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", handle_error)
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+import sqlalchemy
+import sqlalchemy.exc
+
+import tracing
+from db import models
+import user_service as US
+
+
+@pytest.fixture
+def tracer():
+    tracing.TRACER.configure()
+    yield tracing.TRACER
+    tracing.TRACER.configure(enabled=False)
+
+
+def test_disabled_tracer():
+    tracer = tracing.Tracer()
+    with tracer.span("root") as span:
+        span.set(a=1)
+    assert tracer.spans() == []
+
+
+def test_nested_spans(tracer):
+    with tracer.span("root", a=1):
+        with tracer.span("child") as span:
+            span.set(b=2)
+        with pytest.raises(ValueError):
+            with tracer.span("failed"):
+                raise ValueError()
+    with tracer.span("other root"):
+        pass
+
+    child, failed, root, other = tracer.spans()
+    assert [s["name"] for s in (child, failed, root, other)] == [
+        "child",
+        "failed",
+        "root",
+        "other root",
+    ]
+    assert root["parent_id"] is None
+    assert root["attrs"] == {"a": 1}
+    assert child["attrs"] == {"b": 2}
+    assert failed["attrs"] == {"error": "ValueError"}
+    assert child["trace_id"] == failed["trace_id"] == root["trace_id"]
+    assert child["parent_id"] == failed["parent_id"] == root["span_id"]
+    assert other["trace_id"] != root["trace_id"]
+    assert root["duration_ns"] >= child["duration_ns"] + failed["duration_ns"]
+
+
+def test_sampling_and_ring_buffer(tracer):
+    tracer.configure(sample_rate=0)
+    with tracer.span("root"):
+        with tracer.span("child"):
+            pass
+    assert tracer.spans() == []
+
+    tracer.configure(buffer_size=3)
+    for i in range(5):
+        with tracer.span(str(i)):
+            pass
+    assert [s["name"] for s in tracer.spans()] == ["2", "3", "4"]
+
+
+def test_traced_services_and_sql(tracer, testing_db):
+    tracing.instrument_engine(testing_db.engine, tracer)
+    session = testing_db.session()
+    with tracer.span("root"):
+        US.UserService().get_or_create_user(session, 1, None)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        session.execute(sqlalchemy.text("SELECT * FROM unknown_table"))
+
+    spans = {s["name"]: s for s in tracer.spans()}
+    service_span = spans["UserService.get_or_create_user"]
+    assert service_span["parent_id"] == spans["root"]["span_id"]
+    sql_spans = [s for s in tracer.spans() if s["name"] == "sql"]
+    assert any(
+        "INSERT INTO user_account" in s["attrs"]["statement"]
+        and s["parent_id"] == service_span["span_id"]
+        for s in sql_spans
+    )
+    assert sql_spans[-1]["attrs"]["error"] == "OperationalError"
+    assert session.query(models.User).count() == 1
+
+
+def test_export_chrome_trace(tracer, tmp_path):
+    with tracer.span("root", chat_id=1):
+        with tracer.span("child"):
+            pass
+    path = tmp_path / "traces" / "trace.json"
+    tracer.export_chrome_trace(path)
+    assert tracer.spans() == []
+
+    events = json.loads(path.read_text())["traceEvents"]
+    complete = [e for e in events if e["ph"] == "X"]
+    assert [e["name"] for e in complete] == ["child", "root"]
+    assert complete[1]["args"]["chat_id"] == 1
+    assert complete[0]["ts"] >= complete[1]["ts"]
+    assert complete[0]["dur"] <= complete[1]["dur"]
+    assert [e["args"]["name"] for e in events if e["ph"] == "M"] == ["MainThread"]
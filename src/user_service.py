@@ -1,6 +1,9 @@
 from db import models
 import exceptions
+import tracing
+from sqlalchemy import func
 from sqlalchemy import select
+from sqlalchemy import update
 
 
 # TODO: make thread safe
@@ -8,11 +11,13 @@ class UserService:
     def __init__(self):
         pass
 
+    @tracing.traced
     def get_admin_chats(self, session) -> list[models.ChatId] | None:
         stmt = select(models.User).where(models.User._is_admin)
         admins = session.execute(stmt).all()
         return [u[0].chat_id for u in admins]
 
+    @tracing.traced
     def get_user(self, session, chat_id: models.ChatId) -> models.User | None:
         stmt = select(models.User).where(models.User.chat_id == chat_id)
         user = session.execute(stmt).one_or_none()
@@ -20,22 +25,96 @@ class UserService:
             return None
         return user[0]
 
-    def create_user(
-        self, session, chat_id: models.ChatId, username: str
+    @tracing.traced
+    def get_or_create_user(
+        self, session, chat_id: models.ChatId, username: str | None
     ) -> models.User:
-        # TODO: handle concurrent insertion of one user
-        # TODO: make session external to functions (see sqlalchemy docs)
-        user = models.User(chat_id=chat_id, username=username)
-        session.add(user)
+        # single upsert statement, so concurrent /start from one chat can't
+        # fail on the unique chat_id constraint
+        insert = models.dialect_insert(session)
+        stmt = insert(models.User).values(chat_id=chat_id, username=username)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.User.chat_id],
+            set_={
+                "username": func.coalesce(models.User.username, stmt.excluded.username)
+            },
+        ).returning(models.User)
+        user = session.scalars(
+            stmt, execution_options={"populate_existing": True}
+        ).one()
         session.commit()
-        session.refresh(user)
         return user
 
+    @tracing.traced
     def change_role(
         self, session, user: models.User, role: models.Role, state: bool
     ) -> None:
+        """Sets the role of the user, the caller commits it"""
         if role == models.Role.ADMIN and not user.is_admin():
             raise exceptions.RolesAreRequired(models.Role.ADMIN)
         # TODO: handle concurrent update
         user.set_role(role, state)
+
+    @tracing.traced
+    def reset_delivery_failures(self, session, user_ids) -> None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        session.execute(
+            update(models.User)
+            .where(
+                models.User.id.in_(user_ids),
+                models.User.delivery_failures.is_not(None),
+            )
+            .values(delivery_failures=None)
+        )
+        session.commit()
+
+    @tracing.traced
+    def record_delivery_failures(self, session, user_ids, max_failures: int) -> int:
+        """Counts a failed delivery for every user and unsubscribes users
+        failing max_failures times in a row, returns number of unsubscribed"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return 0
+        session.execute(
+            update(models.User)
+            .where(models.User.id.in_(user_ids))
+            .values(
+                delivery_failures=func.coalesce(models.User.delivery_failures, 0) + 1
+            )
+        )
+        unsubscribed = session.execute(
+            update(models.User)
+            .where(
+                models.User.id.in_(user_ids),
+                models.User.delivery_failures >= max_failures,
+                models.User._send_phrases,
+            )
+            .values(_send_phrases=False)
+        ).rowcount
+        session.commit()
+        return unsubscribed
+
+    @tracing.traced
+    def migrate_chat(self, session, user_id, new_chat_id: models.ChatId) -> bool:
+        """Moves the user to the new chat id of an upgraded group, returns
+        False if the new chat already has its own user"""
+        stmt = select(models.User.id).where(
+            models.User.chat_id == new_chat_id, models.User.id != user_id
+        )
+        if session.execute(stmt).first() is not None:
+            session.execute(
+                update(models.User)
+                .where(models.User.id == user_id)
+                .values(_send_phrases=False)
+            )
+            session.commit()
+            return False
+        session.execute(
+            update(models.User)
+            .where(models.User.id == user_id)
+            .values(chat_id=new_chat_id)
+        )
         session.commit()
+        return True
@@ -0,0 +1,132 @@
+import random
+import threading
+
+import sqlalchemy
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+
+from db import models
+import user_service as US
+
+
+def test_get_or_create_user(portable_db):
+    session = portable_db.session()
+    user_service = US.UserService()
+
+    user = user_service.get_or_create_user(session, 100, None)
+    assert user.chat_id == 100
+    assert user.username is None
+    assert not user.is_admin()
+    assert not user.send_phrases()
+
+    same_user = user_service.get_or_create_user(session, 100, "name")
+    assert same_user.id == user.id
+    assert same_user.username == "name"
+
+    # already known username isn't overwritten
+    same_user = user_service.get_or_create_user(session, 100, "other")
+    assert same_user.id == user.id
+    assert same_user.username == "name"
+
+    other_user = user_service.get_or_create_user(session, 200, "other")
+    assert other_user.id != user.id
+    assert session.query(models.User).count() == 2
+
+
+def test_get_or_create_user_concurrent(tmp_path):
+    engine = models.init_db(f"sqlite:///{tmp_path / 'iv.db'}")
+    create_session = scoped_session(sessionmaker(engine))
+    user_service = US.UserService()
+
+    n_threads = 16
+    n_iterations = 20
+    chat_ids = list(range(10))
+    barrier = threading.Barrier(n_threads)
+    results = [[] for _ in range(n_threads)]
+    errors = []
+
+    def worker(i):
+        order = chat_ids * (n_iterations // len(chat_ids))
+        random.shuffle(order)
+        barrier.wait()
+        try:
+            for chat_id in order:
+                with create_session() as session:
+                    user = user_service.get_or_create_user(session, chat_id, None)
+                    results[i].append((chat_id, user.id))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            create_session.remove()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    ids = {}
+    for result in results:
+        assert len(result) == n_iterations
+        for chat_id, user_id in result:
+            assert ids.setdefault(chat_id, user_id) == user_id
+    assert set(ids) == set(chat_ids)
+    with create_session() as session:
+        assert session.query(models.User).count() == len(chat_ids)
+    engine.dispose()
+
+
+def failing_users(session) -> set:
+    stmt = sqlalchemy.select(models.User.id).where(
+        models.User.delivery_failures.is_not(None)
+    )
+    return set(session.scalars(stmt))
+
+
+def test_delivery_failures(portable_db):
+    session = portable_db.session()
+    user_service = US.UserService()
+    users = [user_service.get_or_create_user(session, i, None) for i in range(3)]
+    for u in users:
+        user_service.change_role(session, u, models.Role.SEND_PHRASES, True)
+    session.commit()
+    ids = [u.id for u in users]
+
+    assert user_service.record_delivery_failures(session, ids[:2], 2) == 0
+    assert failing_users(session) == set(ids[:2])
+    user_service.reset_delivery_failures(session, ids[1:2])
+    assert failing_users(session) == {ids[0]}
+
+    assert user_service.record_delivery_failures(session, ids[:2], 2) == 1
+    session.expire_all()
+    assert [u.send_phrases() for u in users] == [False, True, True]
+
+    # subscribing again starts counting from scratch
+    user_service.change_role(session, users[0], models.Role.SEND_PHRASES, True)
+    session.commit()
+    assert failing_users(session) == {ids[1]}
+
+
+def test_migrate_chat(portable_db):
+    session = portable_db.session()
+    user_service = US.UserService()
+    group = user_service.get_or_create_user(session, -1, None)
+    user_service.change_role(session, group, models.Role.SEND_PHRASES, True)
+    other = user_service.get_or_create_user(session, -2, None)
+    user_service.change_role(session, other, models.Role.SEND_PHRASES, True)
+    session.commit()
+
+    # supergroup ids don't fit into 32 bits
+    supergroup = -1001234567890
+    assert user_service.migrate_chat(session, group.id, supergroup)
+    session.expire_all()
+    assert user_service.get_user(session, supergroup).id == group.id
+    assert user_service.get_user(session, -1) is None
+
+    # the supergroup already has its own user, the old one is unsubscribed
+    user_service.get_or_create_user(session, -1009876543210, None)
+    assert not user_service.migrate_chat(session, other.id, -1009876543210)
+    session.expire_all()
+    assert not other.send_phrases()
+    assert other.chat_id == -2